@@ -18,6 +18,8 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
+import queue
+import select
 import http.client
 import urllib.request, urllib.parse, urllib.error
 import hashlib
@@ -30,10 +32,42 @@ from xml.etree.ElementTree import XML
 log = logging.getLogger(__name__)
 
 class AmazonSES:
-    def __init__(self, accessKeyID, secretAccessKey):
+    # errors from sending a request which mean that it never reached the server, e.g. we couldn't connect; once the
+    # whole request has been written we never retry, since SES may have sent the email even if we got no response
+    _unsentRequestErrors = (http.client.CannotSendRequest, ConnectionError)
+
+    def __init__(self, accessKeyID, secretAccessKey, host='email.us-east-1.amazonaws.com', port=None, secure=True, timeout=30):
         self._accessKeyID = accessKeyID
         self._secretAccessKey = secretAccessKey
         self._responseParser = AmazonResponseParser()
+        self._host, self._port, self._secure, self._timeout = host, port, secure, timeout
+        self._connections = queue.LifoQueue()
+
+    def _newConnection(self):
+        connectionClass = http.client.HTTPSConnection if self._secure else http.client.HTTPConnection
+        return connectionClass(self._host, self._port, timeout=self._timeout)
+
+    @staticmethod
+    def _isStale(conn):
+        # an idle keep-alive connection becomes readable (with an EOF) once the server has closed it
+        return conn.sock is not None and bool(select.select([conn.sock], [], [], 0)[0])
+
+    def _getConnection(self):
+        while True:
+            try:
+                conn = self._connections.get_nowait()
+            except queue.Empty:
+                return self._newConnection()
+            if not self._isStale(conn):
+                return conn
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                break
 
     def _getSignature(self, dateValue):
         h = hmac.new(key=self._secretAccessKey.encode(), msg=dateValue.encode(), digestmod=hashlib.sha256)
@@ -52,13 +86,26 @@ class AmazonSES:
         if not params:
             params = {}
         params['Action'] = actionName        
-        #https://email.us-east-1.amazonaws.com/
-        conn = http.client.HTTPSConnection('email.us-east-1.amazonaws.com')
         params = urllib.parse.urlencode(params)
-        conn.request('POST', '/', params, self._getHeaders())
-        response = conn.getresponse()
+        # connections are kept alive and reused, skipping any which the server has closed in the meantime; if we
+        # still can't send the request, we retry exactly once on a brand new connection
+        conn = self._getConnection()
+        try:
+            try:
+                conn.request('POST', '/', params, self._getHeaders())
+            except self._unsentRequestErrors:
+                conn.close()
+                conn = self._newConnection()
+                conn.request('POST', '/', params, self._getHeaders())
+            response = conn.getresponse()
+        except:
+            conn.close()
+            raise
         responseResult = response.read()
-        conn.close()
+        if response.will_close:
+            conn.close()
+        else:
+            self._connections.put(conn)
         return self._responseParser.parse(actionName, response.status, response.reason, responseResult)
         
     def verifyEmailAddress(self, emailAddress):
@@ -1,6 +1,125 @@
 from uber.common import *
 
 
+class SentEmailIndex:
+    """
+    A compact record of which automated emails we've already sent (or queued), which can be checked with
+        (model_name, fk_id, ident) in index
+    just like the set of tuples we used to load from the Email table.
+
+    Instead of a set of tuples of strings, we keep a sorted bytes object of 16-byte UUIDs for each (model, ident)
+    and binary search it, which takes a small fraction of the memory.  Newly sent emails go into a small set of
+    pending ids which is merged into the sorted array once it gets big enough.  Rather than reloading everything on
+    every daemon run, refresh() only loads Email rows which were recorded since our last refresh; we do a full rebuild
+    every so often to pick up any Email rows which were deleted.
+    """
+
+    full_rebuild_interval = timedelta(hours=6)
+
+    # emails recorded by other processes may be committed a little after their "when" timestamp
+    refresh_overlap = timedelta(minutes=5)
+
+    max_pending = 1000
+
+    def __init__(self):
+        self.lock = RLock()
+        self.sent = {}
+        self.pending = defaultdict(set)
+        self.refreshed = self.rebuilt = None
+
+    @staticmethod
+    def _uuid_bytes(fk_id):
+        try:
+            return uuid.UUID(str(fk_id)).bytes
+        except ValueError:
+            return None
+
+    def __contains__(self, key):
+        model, fk_id, ident = key
+        fk_bytes = self._uuid_bytes(fk_id)
+        if fk_bytes is None:
+            return False
+        if fk_bytes in self.pending.get((model, ident), ()):
+            return True
+
+        ids = self.sent.get((model, ident), b'')
+        lo, hi = 0, len(ids) // 16
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = ids[16 * mid:16 * mid + 16]
+            if current == fk_bytes:
+                return True
+            elif current < fk_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return False
+
+    def __len__(self):
+        return sum(len(ids) // 16 for ids in self.sent.values()) + sum(len(ids) for ids in self.pending.values())
+
+    def add(self, model, fk_id, ident):
+        fk_bytes = self._uuid_bytes(fk_id)
+        if fk_bytes is not None:
+            with self.lock:
+                self.pending[model, ident].add(fk_bytes)
+                if len(self.pending[model, ident]) >= self.max_pending:
+                    self._merge(model, ident)
+
+    def _merge(self, model, ident):
+        # __contains__ doesn't take our lock, so every id must stay in either sent or pending throughout this
+        pending = self.pending.get((model, ident), set())
+        ids = self.sent.get((model, ident), b'')
+        merged = set(ids[i:i + 16] for i in range(0, len(ids), 16)).union(pending)
+        self.sent[model, ident] = b''.join(sorted(merged))
+        self.pending.pop((model, ident), None)
+
+    def refresh(self, session):
+        now = datetime.now(UTC)
+        with self.lock:
+            if not self.rebuilt or now - self.rebuilt > self.full_rebuild_interval:
+                self._rebuild(session)
+                self.rebuilt = now
+            else:
+                new_emails = session.query(Email.model, Email.fk_id, Email.ident) \
+                                    .filter(Email.when >= self.refreshed - self.refresh_overlap, Email.fk_id != None)
+                for model, fk_id, ident in new_emails:
+                    self.add(model, fk_id, ident)
+                for model, fk_id, ident in session.query(EmailOutbox.model, EmailOutbox.fk_id, EmailOutbox.ident) \
+                                                  .filter(EmailOutbox.failed == False):
+                    self.add(model, fk_id, ident)
+
+            self.refreshed = now
+
+    def _rebuild(self, session):
+        sent, current, ids = {}, None, []
+        emails = session.query(Email.model, Email.ident, Email.fk_id).filter(Email.fk_id != None) \
+                        .order_by(Email.model, Email.ident).yield_per(10000)
+        for model, ident, fk_id in emails:
+            if (model, ident) != current:
+                if current:
+                    sent[current] = b''.join(sorted(set(ids)))
+                current, ids = (model, ident), []
+            fk_bytes = self._uuid_bytes(fk_id)
+            if fk_bytes is not None:
+                ids.append(fk_bytes)
+        if current:
+            sent[current] = b''.join(sorted(set(ids)))
+
+        pending = defaultdict(set)
+        for model, fk_id, ident in session.query(EmailOutbox.model, EmailOutbox.fk_id, EmailOutbox.ident) \
+                                          .filter(EmailOutbox.failed == False):
+            fk_bytes = self._uuid_bytes(fk_id)
+            if fk_bytes is not None:
+                pending[model, ident].add(fk_bytes)
+
+        # as in _merge, we swap in sent before pending so that nothing we already had goes missing in between
+        self.sent = sent
+        self.pending = pending
+
+sent_email_index = SentEmailIndex()
+
+
 class AutomatedEmail:
     """
     Represents one category of emails that we send out.
@@ -19,7 +138,7 @@ class AutomatedEmail:
 
     def __init__(self, model, subject, template, filter, *, when=(),
                  sender=None, extra_data=None, cc=None, bcc=None,
-                 post_con=False, needs_approval=True, ident=None, allow_during_con=False):
+                 post_con=False, needs_approval=True, ident=None, allow_during_con=False, query_filter=None):
 
         self.subject = subject.format(EVENT_NAME=c.EVENT_NAME)
         self.ident = ident or self.subject
@@ -35,6 +154,10 @@ class AutomatedEmail:
         self.sender = sender or c.REGDESK_EMAIL
         self.when = listify(when)
 
+        # optional SQLAlchemy expression which every model instance passing our filter must also satisfy; this lets
+        # the daemon ask the database for a short list of candidates instead of checking every single row
+        self.query_filter = query_filter
+
         assert filter is not None
 
         if post_con:
@@ -51,6 +174,21 @@ class AutomatedEmail:
     def __repr__(self):
         return '<{}: {!r}>'.format(self.__class__.__name__, self.subject)
 
+    def filter_candidates(self, query):
+        """
+        Given a query for our model (i.e. one of our AutomatedEmail.queries), narrow it down using our query_filter
+        and exclude everything we've already sent this email to.  The results still need to be checked with
+        send_if_should(), since query_filter is only a necessary condition and not a sufficient one.
+        """
+        query = query.filter(self.query_filter)
+        # queued emails which SendQueuedEmailsJob gave up on don't count, so that they're queued again if still due
+        for sent, conditions in [(Email, []), (EmailOutbox, [EmailOutbox.failed == False])]:
+            query = query.filter(not_(sqlalchemy.exists().where(and_(sent.model == self.model.__name__,
+                                                                     sent.fk_id == self.model.id,
+                                                                     sent.ident == self.ident,
+                                                                     *conditions))))
+        return query
+
     def computed_subject(self, x):
         """
         Given a model instance, return an email subject email for that instance.
@@ -64,23 +202,24 @@ class AutomatedEmail:
         """
         Returns true if we have a record of previously sending this email to this model
 
-        NOTE: c.PREVIOUSLY_SENT_EMAILS is a cached property and will only update at the start of each daemon run.
+        NOTE: c.PREVIOUSLY_SENT_EMAILS is a cached property and will only update at the start of each daemon run,
+        though emails queued or sent during the run are added to it as we go.
         """
         return (model_inst.__class__.__name__, model_inst.id, self.ident) in c.PREVIOUSLY_SENT_EMAILS
 
-    def send_if_should(self, model_inst, raise_errors=False):
+    def send_if_should(self, model_inst, raise_errors=False, prechecked=False):
         """
         If it's OK to send an email of our category to this model instance (i.e. a particular Attendee) then send it.
         """
         try:
-            if self._should_send(model_inst):
+            if self._should_send(model_inst, prechecked=prechecked):
                 self.really_send(model_inst)
         except:
             log.error('error sending {!r} email to {}', self.subject, model_inst.email, exc_info=True)
             if raise_errors:
                 raise
 
-    def _should_send(self, model_inst):
+    def _should_send(self, model_inst, prechecked=False):
         """
         If True, we should generate an actual email created from our email category
         and send it to a particular model instance.
@@ -101,19 +240,38 @@ class AutomatedEmail:
           model_inst:  class Group: id #1251, name: "The Fighting Mongooses"
 
         :param model_inst: The model we've been requested to use (i.e. Attendee, Group, etc)
+        :param prechecked: If True, the caller has already checked the conditions which don't depend on the model
+                           instance (whether we can send at-con, the model type, and our date filters), so we don't
+                           check them again.
 
         :return: True if we should send this email to this model instance, False if not.
         """
 
         return all(condition() for condition in [
-            lambda: not c.AT_THE_CON or self.allow_during_con,
-            lambda: isinstance(model_inst, self.model),
+            lambda: prechecked or not c.AT_THE_CON or self.allow_during_con,
+            lambda: prechecked or isinstance(model_inst, self.model),
             lambda: getattr(model_inst, 'email', None),
             lambda: not self._already_sent(model_inst),
-            lambda: self.filters_run(model_inst),
+            lambda: self.filter(model_inst) if prechecked else self.filters_run(model_inst),
+            lambda: SendAllAutomatedEmailsJob.log_pending_match(self, model_inst),
             lambda: self.approved,
         ])
 
+    @property
+    def could_send_now(self):
+        """
+        Whether this category could send any emails at all right now, regardless of which model instance we're
+        looking at, i.e. whether it's allowed during the event and whether its date filters are currently active.
+        """
+        return (not c.AT_THE_CON or self.allow_during_con) and self._run_date_filters()
+
+    @property
+    def has_approval(self):
+        """
+        Like the "approved" property, except it has no side effects.
+        """
+        return not self.needs_approval or self.ident in c.EMAIL_APPROVED_IDENTS
+
     @property
     def approved(self):
         """
@@ -125,7 +283,7 @@ class AutomatedEmail:
         emails that would have been sent so we can report it via the UI later.
         """
 
-        approved_to_send = not self.needs_approval or self.ident in c.EMAIL_APPROVED_IDENTS
+        approved_to_send = self.has_approval
 
         if not approved_to_send:
             # log statistics about how many emails would have been sent if we had approval.
@@ -145,15 +303,33 @@ class AutomatedEmail:
         Doesn't perform any kind of checks at all if we should be sending this, just immediately sends the email
         no matter what.
 
+        When this is called by the automated email daemon, the email is rendered and queued in the EmailOutbox table
+        rather than being sent immediately; SendQueuedEmailsJob takes care of actually sending it.
+
         NOTE: use send_if_should() instead of calling this method unless you 100% know what you're doing.
         NOTE: send_email() fails if c.SEND_EMAILS is False
         """
         try:
             subject = self.computed_subject(model_instance)
             format = 'text' if self.template.endswith('.txt') else 'html'
-            send_email(self.sender, model_instance.email, subject,
-                       self.render(model_instance), format,
-                       model=model_instance, cc=self.cc, ident=self.ident)
+            body = self.render(model_instance)
+            running_daemon = SendAllAutomatedEmailsJob._currently_running_daemon_on_this_thread()
+            if running_daemon:
+                body = body.decode('utf-8') if isinstance(body, bytes) else body
+                running_daemon.enqueue(EmailOutbox(
+                    fk_id=model_instance.id,
+                    model=model_instance.__class__.__name__,
+                    ident=self.ident,
+                    sender=self.sender,
+                    dest=','.join(listify(model_instance.email)),
+                    cc=','.join(listify(self.cc)),
+                    bcc=','.join(listify(self.bcc)),
+                    subject=subject.format(EVENT_NAME=c.EVENT_NAME),
+                    body=body,
+                    format=format))
+            else:
+                send_email(self.sender, model_instance.email, subject, body, format,
+                           model=model_instance, cc=self.cc, ident=self.ident)
         except:
             log.error('error sending {!r} email to {}', self.subject, model_instance.email, exc_info=True)
             raise
@@ -175,13 +351,50 @@ class SendAllAutomatedEmailsJob:
 
     run_lock = threading.Lock()
 
+    # Most runs only look at Attendees and Groups which have changed since the previous run, using our Tracking table
+    # to tell which rows were touched.  Emails can also become eligible purely because time has passed (e.g. "30 days
+    # after registering"), so every so often we do a full sweep over everything.  These are the start times of the
+    # last successful run and the last successful full sweep; both are reset on restart, so our first run is always
+    # a full sweep.
+    watermark = None
+    last_full_sweep = None
+
+    # Tracking rows are written during a flush but may not be committed until a bit later, so we look back a little
+    # further than our watermark to avoid missing changes which were committed while our previous run was going.
+    watermark_overlap = timedelta(minutes=5)
+
+    # if more than this many rows have changed, it's cheaper to just look at everything
+    max_incremental_ids = 5000
+
+    # how many model instances we load into our session at a time
+    chunk_size = 1000
+
+    # Statistics about the emails which are waiting to be sent, computed during each full sweep; this maps each
+    # email category ident to the number of model instances which match that category and haven't been sent that
+    # email yet, along with a random sample of the ids of those model instances.  We display these on the
+    # emails/pending_examples page, which would otherwise need to run each filter on everything in the database.
+    pending_stats = {}
+    pending_stats_computed = None
+    pending_sample_size = 10
+
     @classmethod
     def send_all_emails(cls, raise_errors=False):
         """ Helper method to start a run of our automated email processing """
         cls().run(raise_errors)
 
+    @classmethod
+    def recompute_pending_stats(cls):
+        """
+        Starts a background thread which goes through everything in the database and recomputes our pending_stats
+        without actually sending any emails.  Returns False if the email daemon is already running.
+        """
+        if cls.run_lock.locked():
+            return False
+        Thread(target=cls().run, kwargs={'dry_run': True}, name='pending email stats', daemon=True).start()
+        return True
+
     @timed
-    def run(self, raise_errors=False):
+    def run(self, raise_errors=False, dry_run=False):
         """
         Do one run of our automated email service.  Call this periodically to send any emails that should go out
         automatically.
@@ -189,8 +402,10 @@ class SendAllAutomatedEmailsJob:
         This will NOT run if we're on-site, or not configured to send emails.
 
         :param raise_errors: If False, exceptions are squashed during email sending and we'll try the next email.
+        :param dry_run: If True, do a full sweep to compute our statistics about pending emails without sending any
+                        emails, even if we're not configured to send emails.
         """
-        if not (c.DEV_BOX or c.SEND_EMAILS):
+        if not (c.DEV_BOX or c.SEND_EMAILS or dry_run):
             return
 
         if not SendAllAutomatedEmailsJob.run_lock.acquire(blocking=False):
@@ -198,25 +413,38 @@ class SendAllAutomatedEmailsJob:
             return
 
         try:
-            self._run(raise_errors)
+            self._run(raise_errors, dry_run)
         finally:
             SendAllAutomatedEmailsJob.run_lock.release()
 
-    def _run(self, raise_errors):
+    def _run(self, raise_errors, dry_run=False):
         with Session() as session:
             # performance: we use request_cached_context() to force cache invalidation
             # of variables like c.EMAIL_APPROVED_IDENTS
             with request_cached_context(clear_cache_on_start=True):
-                self._init(session, raise_errors)
+                self._init(session, raise_errors, dry_run)
                 self._send_all_emails()
+                self._flush_outbox()
                 self._on_finished_run()
 
-    def _init(self, session, raise_errors):
+        # the emails we just queued are usually sent by the "send queued emails" daemon, but we might as well get a
+        # head start on sending them now that we're done querying the database
+        if not dry_run:
+            SendQueuedEmailsJob.send_queued_emails(raise_errors)
+
+    def _init(self, session, raise_errors, dry_run=False):
         self.session = session
         self.raise_errors = raise_errors
+        self.dry_run = dry_run
+        self.outbox = []
+        self.started = datetime.now(UTC)
+        self.changed_ids = None if dry_run or self._full_sweep_due() else self._get_changed_ids()
+        self.pending_stats = defaultdict(lambda: {'count': 0, 'sample': []})
         self.results = {
             'running': True,
             'completed': False,
+            'full_sweep': self.changed_ids is None,
+            'skipped_evaluations': 0,
             'categories': defaultdict(lambda: defaultdict(int))
         }
 
@@ -228,7 +456,124 @@ class SendAllAutomatedEmailsJob:
         self.results['running'] = False
         self.results['completed'] = True
 
+        if not self.results['full_sweep']:
+            # we only count unapproved emails during full sweeps (see _build_plan) so keep the last full sweep's counts
+            self.results['categories'] = SendAllAutomatedEmailsJob.last_result.get('categories', self.results['categories'])
+
         SendAllAutomatedEmailsJob.last_result = self.results
+        if self.results['full_sweep']:
+            SendAllAutomatedEmailsJob.pending_stats = dict(self.pending_stats)
+            SendAllAutomatedEmailsJob.pending_stats_computed = self.started
+        if not self.dry_run:
+            SendAllAutomatedEmailsJob.watermark = self.started
+            if self.results['full_sweep']:
+                SendAllAutomatedEmailsJob.last_full_sweep = self.started
+
+    def enqueue(self, queued_email):
+        """
+        Queue an EmailOutbox row to be saved.  We save these in batches with their own session, so that the daemon's
+        session (which has a ton of attendees and groups loaded) never needs to be committed partway through a run.
+        """
+        self.outbox.append(queued_email)
+        sent_email_index.add(queued_email.model, queued_email.fk_id, queued_email.ident)
+        if len(self.outbox) >= 100:
+            self._flush_outbox()
+
+    @staticmethod
+    def _replace_failed(session, queued):
+        """
+        Deletes any rows for these emails which SendQueuedEmailsJob gave up on, since we don't count those as sent;
+        we're queueing these emails again because they're still due, e.g. the attendee has fixed their address.
+        """
+        keys = [and_(EmailOutbox.model == qe.model, EmailOutbox.fk_id == qe.fk_id, EmailOutbox.ident == qe.ident)
+                for qe in queued]
+        if keys:
+            session.query(EmailOutbox).filter(EmailOutbox.failed == True, or_(*keys)).delete(synchronize_session=False)
+
+    def _flush_outbox(self):
+        queued, self.outbox = self.outbox, []
+        try:
+            with Session() as session:
+                self._replace_failed(session, queued)
+                session.add_all(queued)
+        except sqlalchemy.exc.IntegrityError:
+            # at least one of these was already queued (e.g. by another process), so add them one at a time
+            for queued_email in queued:
+                try:
+                    with Session() as session:
+                        self._replace_failed(session, [queued_email])
+                        session.add(queued_email)
+                except sqlalchemy.exc.IntegrityError:
+                    log.warn('skipping {!r} email to {} which was already queued', queued_email.ident, queued_email.dest)
+
+    def _full_sweep_due(self):
+        cls = SendAllAutomatedEmailsJob
+        if not cls.watermark or not cls.last_full_sweep or not c.AUTOMATED_EMAIL_FULL_SWEEP_MINUTES:
+            return True
+        return self.started - cls.last_full_sweep >= timedelta(minutes=c.AUTOMATED_EMAIL_FULL_SWEEP_MINUTES)
+
+    def _get_changed_ids(self):
+        """
+        Returns a dictionary mapping each model in AutomatedEmail.queries to the set of ids of those model instances
+        which have been touched since our last run, according to the Tracking table.  In addition to the rows which
+        were changed directly, we also include rows which are linked to them (e.g. the attendee whose shift was
+        changed, or the group of an attendee who was changed and vice versa), since our email filters routinely look
+        at those relationships.
+
+        Returns None if we should just do a full sweep instead, e.g. because an email category was approved since
+        our last run or because there are so many changes that filtering on them wouldn't save us anything.
+        """
+        tracking_writer.write_queued()
+        names = {model.__name__: model for model in AutomatedEmail.queries}
+        tables = {model.__tablename__: model for model in AutomatedEmail.queries}
+        changed_ids = {model: set() for model in AutomatedEmail.queries}
+
+        since = SendAllAutomatedEmailsJob.watermark - SendAllAutomatedEmailsJob.watermark_overlap
+        changes = self.session.query(Tracking.model, Tracking.fk_id, Tracking.links).filter(Tracking.when >= since)
+        for model_name, fk_id, links in changes:
+            if model_name == ApprovedEmail.__name__:
+                return None
+            if model_name in names:
+                changed_ids[names[model_name]].add(fk_id)
+            for table, id in Tracking.parse_links(links):
+                if table in tables:
+                    changed_ids[tables[table]].add(id)
+
+        if Attendee in changed_ids and Group in changed_ids and changed_ids[Group]:
+            group_ids = list(changed_ids[Group])
+            for i in range(0, len(group_ids), 500):
+                members = self.session.query(Attendee.id).filter(Attendee.group_id.in_(group_ids[i:i + 500]))
+                changed_ids[Attendee].update(id for [id] in members)
+
+        if sum(len(ids) for ids in changed_ids.values()) > SendAllAutomatedEmailsJob.max_incremental_ids:
+            return None
+
+        return changed_ids
+
+    def _iterate(self, model, model_instances):
+        """
+        Iterates over the results of one of our AutomatedEmail.queries, narrowed down to only those model instances
+        which have changed since our last run unless this is a full sweep.
+
+        Our queries usually return a SQLAlchemy Query, which we fetch in fixed-size chunks ordered by id, expunging
+        everything from our session after each chunk is processed; otherwise we'd end up with every attendee, group,
+        shift, and job in the database loaded into our session by the end of the run.  We also accept plain lists.
+        """
+        ids = None if self.changed_ids is None else self.changed_ids.get(model, set())
+        if not isinstance(model_instances, Query):
+            yield from (mi for mi in model_instances if ids is None or mi.id in ids)
+            return
+
+        if ids is None:
+            queries = [model_instances]
+        else:
+            ids = sorted(ids)
+            queries = [model_instances.filter(model.id.in_(ids[i:i + 500])) for i in range(0, len(ids), 500)]
+
+        for query in queries:
+            for chunk in query.keyset_chunks(self.chunk_size):
+                yield from chunk
+                self.session.expunge_all()
 
     def _send_all_emails(self):
         """
@@ -248,24 +593,86 @@ class SendAllAutomatedEmailsJob:
         If that automated email decides the time is right (i.e. it hasn't sent the email already, the attendee has a
         valid email address, email has been approved for sending, and a bunch of other stuff), then it will actually
         send an email for this model instance.
+
+        Unless this is a full sweep, we only look at model instances which have changed since our last run; see
+        _get_changed_ids() for the details.
+
+        Email categories with a query_filter get their own query which only returns candidates for that category,
+        so we skip those categories when looping over everything.  (We can only do this when our query function
+        returns an actual Query; otherwise we check those categories the slow way along with everything else.)
         """
+        plan = self._build_plan()
         for model, query_fn in AutomatedEmail.queries.items():
+            email_categories = plan[model]
+            if not email_categories:
+                continue
+
             model_instances = query_fn(self.session)
-            for model_instance in model_instances:
+
+            if isinstance(model_instances, Query):
+                for email_category in [ec for ec in email_categories if ec.query_filter is not None]:
+                    self._send_candidate_emails(email_category, model, model_instances)
+                email_categories = [ec for ec in email_categories if ec.query_filter is None]
+                if not email_categories:
+                    continue
+
+            for model_instance in self._iterate(model, model_instances):
                 sleep(0.01)  # throttle CPU usage
-                self._send_any_emails_for(model_instance)
+                self._send_any_emails_for(model_instance, email_categories)
 
-    def _send_any_emails_for(self, model_instance):
+    def _build_plan(self):
         """
-        Go through every email category in the system and ask it if it wants to send any email on behalf of this
-        particular model instance.
+        Figure out up front which email categories we need to check for each of the models in AutomatedEmail.queries,
+        since a lot of the checks we'd otherwise make for every single model instance will have the same answer for
+        the entire run.  We leave out categories which:
+        -> are for a different model
+        -> aren't allowed to send during the event, if we're at the event
+        -> have date filters which aren't currently active
+        -> haven't been approved yet, unless this is a full sweep (we still evaluate those during full sweeps so we
+           can report how many emails are waiting on approval)
+
+        The categories we return have already been prechecked; see AutomatedEmail._should_send().
+        """
+        plan = {}
+        for model in AutomatedEmail.queries:
+            plan[model] = [ec for ec in AutomatedEmail.instances.values()
+                           if issubclass(model, ec.model)
+                           and ec.could_send_now
+                           and (self.results['full_sweep'] or ec.has_approval)]
+        return plan
+
+    def _send_candidate_emails(self, email_category, model, query):
+        """
+        Send an email category's emails using its query_filter to only look at the model instances which might want
+        them, rather than asking the category about every single model instance.
+        """
+        for model_instance in self._iterate(model, email_category.filter_candidates(query)):
+            self._check(email_category, model_instance)
+
+    def _check(self, email_category, model_instance):
+        if self.dry_run:
+            try:
+                email_category._should_send(model_instance, prechecked=True)
+            except:
+                log.error('error checking {!r} email for {}', email_category.subject, model_instance.email, exc_info=True)
+                if self.raise_errors:
+                    raise
+        else:
+            email_category.send_if_should(model_instance, self.raise_errors, prechecked=True)
+
+    def _send_any_emails_for(self, model_instance, email_categories):
+        """
+        Ask each of the given email categories if it wants to send any email on behalf of this particular model
+        instance.  These categories come from our per-run plan, so we keep track of how many checks we were able to
+        skip by not asking every category in the system.
 
         An example of a model + category combo to check:
           email_category: "You {attendee.name} have registered for our event!"
           model_instance:  Attendee #42
         """
-        for email_category in AutomatedEmail.instances.values():
-            email_category.send_if_should(model_instance, self.raise_errors)
+        self.results['skipped_evaluations'] += len(AutomatedEmail.instances) - len(email_categories)
+        for email_category in email_categories:
+            self._check(email_category, model_instance)
 
     @classmethod
     def _currently_running_daemon_on_this_thread(cls):
@@ -277,6 +684,31 @@ class SendAllAutomatedEmailsJob:
         if running_daemon:
             running_daemon._increment_unsent_because_unapproved_count(automated_email_category)
 
+    @classmethod
+    def log_pending_match(cls, automated_email_category, model_inst):
+        """
+        Called for every model instance which we haven't sent an email to but which matches that email's filters.
+        Always returns True so that this can be called as one of the conditions in AutomatedEmail._should_send().
+        """
+        running_daemon = cls._currently_running_daemon_on_this_thread()
+        if running_daemon and running_daemon.results['full_sweep']:
+            running_daemon._add_pending_match(automated_email_category, model_inst)
+        return True
+
+    def _add_pending_match(self, automated_email_category, model_inst):
+        """
+        Count this model instance and maybe include it in the category's random sample (using reservoir sampling, so
+        every matching model instance has the same chance of being in the sample no matter how many there are).
+        """
+        stats = self.pending_stats[automated_email_category.ident]
+        stats['count'] += 1
+        if len(stats['sample']) < self.pending_sample_size:
+            stats['sample'].append(model_inst.id)
+        else:
+            i = randrange(stats['count'])
+            if i < self.pending_sample_size:
+                stats['sample'][i] = model_inst.id
+
     def _increment_unsent_because_unapproved_count(self, automated_email_category):
         """
         Log information that a particular email wanted to send out an email, but could not because it didn't have
@@ -288,24 +720,161 @@ class SendAllAutomatedEmailsJob:
         self.results['categories'][automated_email_category.ident]['unsent_because_unapproved'] += 1
 
 
+def _and_query_filter(condition, query_filter=None):
+    return condition if query_filter is None else and_(condition, query_filter)
+
+
+class SendQueuedEmailsJob:
+    """
+    Sends the automated emails which the email daemon has queued in the EmailOutbox table.
+
+    We claim a batch of rows and commit before sending anything, then send the whole batch, then replace the rows
+    which were sent with Email rows in a single transaction.  Rows which fail to send are retried with exponential
+    backoff.  If we crash after claiming a batch but before recording the results, we have no way of knowing which of
+    those emails actually went out, so rather than risk sending duplicates we mark those rows as failed once their
+    claim is old enough.
+    """
+
+    run_lock = threading.Lock()
+
+    batch_size = 50
+    max_attempts = 8
+    stale_claim = timedelta(hours=1)
+
+    # SES error codes which mean that the message itself will never be accepted, so there's no point in retrying;
+    # other errors (notably Throttling, which SES also reports as a 'Sender' error) are retried with backoff
+    permanent_error_codes = {'MessageRejected', 'InvalidParameterValue', 'MailFromDomainNotVerified'}
+
+    @classmethod
+    def send_queued_emails(cls, raise_errors=False):
+        cls().run(raise_errors)
+
+    @timed
+    def run(self, raise_errors=False):
+        if not (c.DEV_BOX or c.SEND_EMAILS):
+            return
+
+        if not SendQueuedEmailsJob.run_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._fail_stale_claims()
+            while self._send_batch():
+                pass
+        except:
+            log.error('unexpected error sending queued emails', exc_info=True)
+            if raise_errors:
+                raise
+        finally:
+            SendQueuedEmailsJob.run_lock.release()
+
+    def _fail_stale_claims(self):
+        with Session() as session:
+            session.query(EmailOutbox).filter(EmailOutbox.claim != None,
+                                              EmailOutbox.claimed < datetime.now(UTC) - self.stale_claim) \
+                                      .update({'failed': True, 'last_error': 'interrupted while sending; not retrying in case it was sent'},
+                                              synchronize_session=False)
+
+    def _claim_batch(self):
+        claim = str(uuid4())
+        now = datetime.now(UTC)
+        with Session() as session:
+            ids = [id for [id] in session.query(EmailOutbox.id)
+                                         .filter(EmailOutbox.failed == False,
+                                                 EmailOutbox.claim == None,
+                                                 EmailOutbox.next_attempt <= now)
+                                         .order_by(EmailOutbox.queued)
+                                         .limit(self.batch_size)]
+            if ids:
+                session.query(EmailOutbox).filter(EmailOutbox.id.in_(ids), EmailOutbox.claim == None) \
+                                          .update({'claim': claim, 'claimed': now}, synchronize_session=False)
+        return claim if ids else None
+
+    def _send_batch(self):
+        """
+        Claim and send one batch of queued emails, returning False once there's nothing left to send.
+        """
+        claim = self._claim_batch()
+        if not claim:
+            return False
+
+        with Session() as session:
+            queued = session.query(EmailOutbox).filter_by(claim=claim).order_by(EmailOutbox.queued).all()
+            try:
+                results = self._send(queued)
+            except:
+                # none of these got as far as the transport, so we put them back in the queue rather than leaving
+                # them claimed, since _fail_stale_claims would eventually mark them as failed without sending them
+                for queued_email in queued:
+                    queued_email.claim = queued_email.claimed = None
+                session.commit()
+                raise
+
+            sent = []
+            for queued_email, result in zip(queued, results):
+                if isinstance(result, Exception):
+                    self._retry_later(queued_email, result)
+                else:
+                    sent.append(queued_email)
+
+            session.add_all([queued_email.to_email() for queued_email in sent])
+            for queued_email in sent:
+                session.delete(queued_email)
+        return True
+
+    def _send(self, queued):
+        """
+        Returns a list the same length as the list of EmailOutbox rows passed in, which contains an exception for
+        each email which failed to send.
+        """
+        results, batch = [None] * len(queued), []
+        for i, queued_email in enumerate(queued):
+            to, cc, bcc = [allowed_recipients([addr for addr in addrs.split(',') if addr])
+                           for addrs in [queued_email.dest, queued_email.cc, queued_email.bcc]]
+            if c.SEND_EMAILS and to:
+                batch.append((i, dict(source=queued_email.sender, to=to, cc=cc, bcc=bcc, subject=queued_email.subject,
+                                      body=queued_email.body, format=queued_email.format)))
+            else:
+                log.error('email sending turned off, so unable to send {!r} email to {}', queued_email.ident, queued_email.dest)
+
+        if batch:
+            for (i, email), result in zip(batch, get_email_transport().send_batch([email for i, email in batch])):
+                results[i] = result
+        return results
+
+    def _retry_later(self, queued_email, error):
+        log.error('unable to send {!r} email to {}: {!r}', queued_email.ident, queued_email.dest, error)
+        queued_email.attempts += 1
+        queued_email.last_error = repr(error)
+        queued_email.claim = queued_email.claimed = None
+        if queued_email.attempts >= self.max_attempts or getattr(error, 'code', None) in self.permanent_error_codes:
+            queued_email.failed = True
+        else:
+            queued_email.next_attempt = datetime.now(UTC) + timedelta(minutes=2 ** queued_email.attempts)
+
+
 class StopsEmail(AutomatedEmail):
-    def __init__(self, subject, template, filter, **kwargs):
-        AutomatedEmail.__init__(self, Attendee, subject, template, lambda a: a.staffing and filter(a), sender=c.STAFF_EMAIL, **kwargs)
+    def __init__(self, subject, template, filter, query_filter=None, **kwargs):
+        AutomatedEmail.__init__(self, Attendee, subject, template, lambda a: a.staffing and filter(a), sender=c.STAFF_EMAIL,
+                                query_filter=_and_query_filter(Attendee.staffing == True, query_filter), **kwargs)
 
 
 class GuestEmail(AutomatedEmail):
-    def __init__(self, subject, template, filter=lambda a: True, **kwargs):
-        AutomatedEmail.__init__(self, Attendee, subject, template, lambda a: a.badge_type == c.GUEST_BADGE and filter(a), sender=c.GUEST_EMAIL, **kwargs)
+    def __init__(self, subject, template, filter=lambda a: True, query_filter=None, **kwargs):
+        AutomatedEmail.__init__(self, Attendee, subject, template, lambda a: a.badge_type == c.GUEST_BADGE and filter(a), sender=c.GUEST_EMAIL,
+                                query_filter=_and_query_filter(Attendee.badge_type == c.GUEST_BADGE, query_filter), **kwargs)
 
 
 class GroupEmail(AutomatedEmail):
-    def __init__(self, subject, template, filter, **kwargs):
-        AutomatedEmail.__init__(self, Group, subject, template, lambda g: not g.is_dealer and filter(g), sender=c.REGDESK_EMAIL, **kwargs)
+    def __init__(self, subject, template, filter, query_filter=None, **kwargs):
+        AutomatedEmail.__init__(self, Group, subject, template, lambda g: not g.is_dealer and filter(g), sender=c.REGDESK_EMAIL,
+                                query_filter=_and_query_filter(not_(Group.is_dealer), query_filter), **kwargs)
 
 
 class MarketplaceEmail(AutomatedEmail):
-    def __init__(self, subject, template, filter, **kwargs):
-        AutomatedEmail.__init__(self, Group, subject, template, lambda g: g.is_dealer and filter(g), sender=c.MARKETPLACE_EMAIL, **kwargs)
+    def __init__(self, subject, template, filter, query_filter=None, **kwargs):
+        AutomatedEmail.__init__(self, Group, subject, template, lambda g: g.is_dealer and filter(g), sender=c.MARKETPLACE_EMAIL,
+                                query_filter=_and_query_filter(Group.is_dealer, query_filter), **kwargs)
 
 
 class DeptChecklistEmail(AutomatedEmail):
@@ -351,18 +920,22 @@ ident naming RULES:
 
 AutomatedEmail(Attendee, '{EVENT_NAME} payment received', 'reg_workflow/attendee_confirmation.html',
          lambda a: a.paid == c.HAS_PAID,
+         query_filter=Attendee.paid == c.HAS_PAID,
          needs_approval=False, allow_during_con=True)
 
 AutomatedEmail(Group, '{EVENT_NAME} group payment received', 'reg_workflow/group_confirmation.html',
          lambda g: g.amount_paid == g.cost and g.cost != 0,
+         query_filter=and_(Group.amount_paid == Group.cost, Group.cost != 0),
          needs_approval=False)
 
 AutomatedEmail(Attendee, '{EVENT_NAME} group registration confirmed', 'reg_workflow/attendee_confirmation.html',
          lambda a: a.group and a != a.group.leader and not a.placeholder,
+         query_filter=and_(Attendee.group_id != None, Attendee.placeholder == False),
          needs_approval=False, allow_during_con=True)
 
 AutomatedEmail(Attendee, '{EVENT_NAME} extra payment received', 'reg_workflow/group_donation.txt',
          lambda a: a.paid == c.PAID_BY_GROUP and a.amount_extra and a.amount_paid == a.amount_extra,
+         query_filter=and_(Attendee.paid == c.PAID_BY_GROUP, Attendee.amount_extra > 0),
          needs_approval=False)
 
 
@@ -385,24 +958,29 @@ AutomatedEmail(Group, 'Last chance to pre-assign {EVENT_NAME} group badges', 're
 
 MarketplaceEmail('Your {EVENT_NAME} Dealer registration has been approved', 'dealers/approved.html',
                  lambda g: g.status == c.APPROVED,
+                 query_filter=Group.status == c.APPROVED,
                  needs_approval=False)
 
 MarketplaceEmail('Reminder to pay for your {EVENT_NAME} Dealer registration', 'dealers/payment_reminder.txt',
                  lambda g: g.status == c.APPROVED and days_after(30, g.approved)() and g.is_unpaid,
+                 query_filter=and_(Group.status == c.APPROVED, Group.cost > 0, Group.amount_paid == 0),
                  needs_approval=False)
 
 MarketplaceEmail('Your {EVENT_NAME} Dealer registration is due in one week', 'dealers/payment_reminder.txt',
                  lambda g: g.status == c.APPROVED and g.is_unpaid,
+                 query_filter=and_(Group.status == c.APPROVED, Group.cost > 0, Group.amount_paid == 0),
                  when=days_before(7, c.DEALER_PAYMENT_DUE, 2),
                  needs_approval=False)
 
 MarketplaceEmail('Last chance to pay for your {EVENT_NAME} Dealer registration', 'dealers/payment_reminder.txt',
                  lambda g: g.status == c.APPROVED and g.is_unpaid,
+                 query_filter=and_(Group.status == c.APPROVED, Group.cost > 0, Group.amount_paid == 0),
                  when=days_before(2, c.DEALER_PAYMENT_DUE),
                  needs_approval=False)
 
 MarketplaceEmail('{EVENT_NAME} Dealer waitlist has been exhausted', 'dealers/waitlist_closing.txt',
                  lambda g: g.status == c.WAITLISTED,
+                 query_filter=Group.status == c.WAITLISTED,
                  when=days_after(0, c.DEALER_WAITLIST_CLOSED),
                  ident='uber_marketplace_waitlist_exhausted')
 
@@ -421,34 +999,42 @@ MarketplaceEmail('{EVENT_NAME} Dealer waitlist has been exhausted', 'dealers/wai
 
 AutomatedEmail(Attendee, '{EVENT_NAME} Panelist Badge Confirmation', 'placeholders/panelist.txt',
                lambda a: a.placeholder and a.first_name and a.last_name and a.ribbon == c.PANELIST_RIBBON,
+               query_filter=and_(Attendee.placeholder == True, Attendee.ribbon == c.PANELIST_RIBBON),
                sender=c.PANELS_EMAIL)
 
 AutomatedEmail(Attendee, '{EVENT_NAME} Guest Badge Confirmation', 'placeholders/guest.txt',
                lambda a: a.placeholder and a.first_name and a.last_name and a.badge_type == c.GUEST_BADGE,
+               query_filter=and_(Attendee.placeholder == True, Attendee.badge_type == c.GUEST_BADGE),
                sender=c.GUEST_EMAIL)
 
 AutomatedEmail(Attendee, '{EVENT_NAME} Dealer Information Required', 'placeholders/dealer.txt',
                lambda a: a.placeholder and a.is_dealer and a.group.status == c.APPROVED,
+               query_filter=and_(Attendee.placeholder == True, Attendee.group_id != None),
                sender=c.MARKETPLACE_EMAIL)
 
 StopsEmail('Want to staff {EVENT_NAME} again?', 'placeholders/imported_volunteer.txt',
-           lambda a: a.placeholder and a.staffing and a.registered_local <= c.PREREG_OPEN)
+           lambda a: a.placeholder and a.staffing and a.registered_local <= c.PREREG_OPEN,
+           query_filter=Attendee.placeholder == True)
 
 StopsEmail('{EVENT_NAME} Volunteer Badge Confirmation', 'placeholders/volunteer.txt',
            lambda a: a.placeholder and a.first_name and a.last_name
-                                      and a.registered_local > c.PREREG_OPEN)
+                                      and a.registered_local > c.PREREG_OPEN,
+           query_filter=Attendee.placeholder == True)
 
 AutomatedEmail(Attendee, '{EVENT_NAME} Badge Confirmation', 'placeholders/regular.txt',
                lambda a: a.placeholder and a.first_name and a.last_name
                                        and (c.AT_THE_CON or a.badge_type not in [c.GUEST_BADGE, c.STAFF_BADGE]
                                        and a.ribbon not in [c.DEALER_RIBBON, c.PANELIST_RIBBON, c.VOLUNTEER_RIBBON]),
+               query_filter=Attendee.placeholder == True,
                allow_during_con=True)
 
 AutomatedEmail(Attendee, '{EVENT_NAME} Badge Confirmation Reminder', 'placeholders/reminder.txt',
-               lambda a: days_after(7, a.registered)() and a.placeholder and a.first_name and a.last_name and not a.is_dealer)
+               lambda a: days_after(7, a.registered)() and a.placeholder and a.first_name and a.last_name and not a.is_dealer,
+               query_filter=Attendee.placeholder == True)
 
 AutomatedEmail(Attendee, 'Last Chance to Accept Your {EVENT_NAME} Badge', 'placeholders/reminder.txt',
                lambda a: a.placeholder and a.first_name and a.last_name and not a.is_dealer,
+               query_filter=Attendee.placeholder == True,
                when=days_before(7, c.PLACEHOLDER_DEADLINE))
 
 
@@ -1,4 +1,9 @@
 from uber.common import *
+import fcntl
+import tempfile
+from array import array
+from time import monotonic
+from contextlib import contextmanager
 
 
 def check_range(badge_num, badge_type):
@@ -39,16 +44,11 @@ def detect_duplicates():
         subject = c.EVENT_NAME + ' Duplicates Report for ' + localized_now().strftime('%Y-%m-%d')
         with Session() as session:
             if session.no_email(subject):
-                grouped = defaultdict(list)
-                for a in session.query(Attendee).filter(Attendee.first_name != '')\
-                        .filter(Attendee.badge_status == c.COMPLETED_STATUS).options(joinedload(Attendee.group))\
-                        .order_by(Attendee.registered):
-                    if not a.group or a.group.status not in [c.WAITLISTED, c.UNAPPROVED]:
-                        grouped[a.full_name, a.email.lower()].append(a)
+                dupes = defaultdict(list)
+                for a in session.duplicate_attendees():
+                    dupes[a.full_name.lower(), a.email.lower()].append(a)
 
-                dupes = {k: v for k, v in grouped.items() if len(v) > 1}
-
-                for who, attendees in dupes.items():
+                for who, attendees in list(dupes.items()):
                     paid = [a for a in attendees if a.paid == c.HAS_PAID]
                     unpaid = [a for a in attendees if a.paid == c.NOT_PAID]
                     if len(paid) == 1 and len(attendees) == 1 + len(unpaid):
@@ -98,64 +98,84 @@ def check_unassigned():
 # TODO: perhaps a check_leaderless() for checking for leaderless groups, since those don't get emails
 
 
-# run through all badges and check 2 things:
-# 1) there are no gaps in badge numbers
-# 2) all badge numbers are in the ranges set by c.BADGE_RANGES
-# note: does not do any duplicates checking, that's a different pre-existing check
-def badge_consistency_check(session):
-    errors = []
-
-    # check 1, see if anything is out of range, or has a duplicate badge number
-    badge_nums_seen = []
-
-    attendees = session.query(Attendee)\
-        .filter(Attendee.first_name != '')\
-        .filter(Attendee.badge_num != 0)\
-        .order_by('badge_num')\
-        .all()
+def iter_badge_consistency_problems(session):
+    """
+    Runs through all badges and yields an error message as soon as we find each of these problems:
+    1) badge numbers which are outside the range set by c.BADGE_RANGES for their badge type
+    2) badge numbers which have been assigned to more than one attendee
+    3) gaps in the badge numbers of each badge type
 
-    for attendee in attendees:
-        out_of_range_error = check_range(attendee.badge_num, attendee.badge_type)
+    We let the database compare each badge with the one before it (both overall and within its badge type) using
+    window functions, so this is a single pass over the attendee table no matter how many badges we have.
+    """
+    name = Attendee.first_name + ' ' + Attendee.last_name
+    order = [Attendee.badge_num, Attendee.id]
+    by_type = {'partition_by': Attendee.badge_type, 'order_by': order}
+    badges = session.query(
+        Attendee.badge_num,
+        Attendee.badge_type,
+        name.label('full_name'),
+        func.lag(Attendee.badge_num).over(order_by=order).label('prev_badge_num'),
+        func.lag(Attendee.badge_num).over(**by_type).label('prev_type_badge_num'),
+        func.lag(name).over(**by_type).label('prev_type_full_name')
+    ).filter(Attendee.first_name != '', Attendee.badge_num != 0).order_by(*order)
+
+    for a in badges.yield_per(1000):
+        out_of_range_error = check_range(a.badge_num, a.badge_type)
         if out_of_range_error:
-            msg = '{a.full_name}: badge #{a.badge_num}: {err}'.format(a=attendee, err=out_of_range_error)
-            errors.append(msg)
-
-        if attendee.badge_num in badge_nums_seen:
-            msg = '{a.full_name}: badge #{a.badge_num}: Has been assigned the same badge number ' \
-                  'of another badge, which is not supposed to happen'.format(a=attendee)
-            errors.append(msg)
-
-        badge_nums_seen.append(attendee.badge_num)
+            yield '{a.full_name}: badge #{a.badge_num}: {err}'.format(a=a, err=out_of_range_error)
 
-    # check 2: see if there are any gaps in each of the badge ranges
-    for badge_type_val, badge_type_desc in c.BADGE_OPTS:
-        prev_badge_num = -1
-        prev_attendee_name = ""
+        if a.badge_num == a.prev_badge_num:
+            yield '{a.full_name}: badge #{a.badge_num}: Has been assigned the same badge number ' \
+                  'of another badge, which is not supposed to happen'.format(a=a)
 
-        attendees = session.query(Attendee) \
-            .filter_by(badge_type=badge_type_val)\
-            .filter(Attendee.first_name != '') \
-            .filter(Attendee.badge_num != 0) \
-            .order_by('badge_num') \
-            .all()
+        if a.badge_type in c.BADGES and a.prev_type_badge_num is not None and a.badge_num - 1 != a.prev_type_badge_num:
+            yield 'gap in badge sequence between {} badge# {}({}) and badge# {}({})'.format(
+                c.BADGES[a.badge_type], a.prev_type_badge_num, a.prev_type_full_name, a.badge_num, a.full_name)
 
-        for attendee in attendees:
-            if prev_badge_num == -1:
-                prev_badge_num = attendee.badge_num
-                prev_attendee_name = attendee.full_name
-                continue
 
-            if attendee.badge_num - 1 != prev_badge_num:
-                msg = "gap in badge sequence between " + badge_type_desc + " " + \
-                      "badge# " + str(prev_badge_num) + "(" + prev_attendee_name + ")" + " and " + \
-                      "badge# " + str(attendee.badge_num) + "(" + attendee.full_name + ")"
-
-                errors.append(msg)
+def badge_consistency_check(session):
+    return list(iter_badge_consistency_problems(session))
 
-            prev_badge_num = attendee.badge_num
-            prev_attendee_name = attendee.full_name
 
-    return errors
+class BadgeConsistencyCheckJob:
+    """
+    Runs iter_badge_consistency_problems in a background thread so that the devtools page doesn't have to wait for
+    it to finish, and collects the problems as they're found so that the page can show them while the check runs.
+    """
+    lock = RLock()
+    thread = None
+    started = finished = None
+    problems = []
+
+    @classmethod
+    def running(cls):
+        return bool(cls.thread and cls.thread.is_alive())
+
+    @classmethod
+    def start(cls):
+        """
+        Starts the check in the background, returning False if it was already running.
+        """
+        with cls.lock:
+            if cls.running():
+                return False
+            cls.started, cls.finished, cls.problems = datetime.now(UTC), None, []
+            cls.thread = Thread(target=cls._run, name='badge consistency check', daemon=True)
+            cls.thread.start()
+            return True
+
+    @classmethod
+    def _run(cls):
+        try:
+            with Session() as session:
+                for problem in iter_badge_consistency_problems(session):
+                    cls.problems.append(problem)
+        except:
+            log.error('unexpected error running the badge consistency check', exc_info=True)
+            cls.problems.append('The badge consistency check failed before it could finish; check the logs for details')
+        finally:
+            cls.finished = datetime.now(UTC)
 
 
 def needs_badge_num(attendee=None, badge_type=None):
@@ -180,3 +200,366 @@ def needs_badge_num(attendee=None, badge_type=None):
                    and attendee.paid != c.NOT_PAID and attendee.badge_status != c.INVALID_STATUS
         else:
             return badge_type in c.PREASSIGNED_BADGE_TYPES
+
+
+class BadgeNumberRange:
+    """
+    Tracks which numbers in a single badge type's range are in use, using a Fenwick tree of used numbers so that we can
+    both mark a number used / unused and find the lowest unused number in O(log n) time.  We also keep a count of how
+    many attendees have each number, so that removing one of two attendees with a duplicate number doesn't free it.
+    """
+    def __init__(self, start, end, badge_nums=()):
+        self.start, self.end = start, end
+        self.size = end - start + 1
+        self.tree = array('l', [0] * (self.size + 1))
+        self.counts = defaultdict(int)
+        self.built = datetime.now(UTC)
+        for badge_num in badge_nums:
+            self.add(badge_num)
+
+    def _update(self, badge_num, delta):
+        i = badge_num - self.start + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def add(self, badge_num):
+        if self.start <= badge_num <= self.end:
+            self.counts[badge_num] += 1
+            if self.counts[badge_num] == 1:
+                self._update(badge_num, 1)
+
+    def remove(self, badge_num):
+        if self.counts.get(badge_num):
+            self.counts[badge_num] -= 1
+            if not self.counts[badge_num]:
+                del self.counts[badge_num]
+                self._update(badge_num, -1)
+
+    def lowest_free(self):
+        """
+        Returns the lowest unused number in this range, or one past the end of the range if every number is in use.
+        We walk down the tree, skipping over each block of numbers which is entirely in use.
+        """
+        pos, step = 0, 1 << self.size.bit_length()
+        while step:
+            if pos + step <= self.size and self.tree[pos + step] == step:
+                pos += step
+            step >>= 1
+        return self.start + pos
+
+
+# the implementation of auto_badge_num which BadgeNumberIndex agrees with, from before any plugin could override it
+_reference_auto_badge_num = Session.SessionMixin.auto_badge_num
+
+
+class BadgeNumberIndex:
+    """
+    In-memory index of the badge numbers in use for each badge type, so that we can hand out the next badge number
+    without loading every badge number in the range like Session.auto_badge_num() does, which still exists as the
+    reference implementation and the fallback whenever this index looks wrong.  If a plugin has overridden
+    auto_badge_num() then we always use that instead, since this index only knows how to do what ours does.
+
+    Each badge type's range is built from the database the first time it's needed (we warm these up on startup), and
+    then kept up-to-date by our session listeners, which record the badge changes made in each flush and apply them
+    here once they're committed.  Since other processes can also change badge numbers, we double-check every number we
+    hand out against the database, and we rebuild each range from the database every so often regardless.
+    """
+
+    rebuild_interval = timedelta(minutes=10)
+
+    def __init__(self):
+        self.lock = RLock()
+        self.ranges = {}
+
+    def reset(self):
+        with self.lock:
+            self.ranges.clear()
+
+    def invalidate(self, badge_type):
+        with self.lock:
+            self.ranges.pop(badge_type, None)
+
+    def _range(self, badge_type):
+        start, end = c.BADGE_RANGES[badge_type]
+        with self.lock:
+            badge_range = self.ranges.get(badge_type)
+            if not badge_range or (badge_range.start, badge_range.end) != (start, end) \
+                    or datetime.now(UTC) - badge_range.built > self.rebuild_interval:
+                with Session() as session:
+                    badge_nums = [num for [num] in session.query(Attendee.badge_num).filter(
+                        Attendee.badge_type == badge_type, Attendee.badge_num >= start, Attendee.badge_num <= end)]
+                badge_range = self.ranges[badge_type] = BadgeNumberRange(start, end, badge_nums)
+            return badge_range
+
+    def apply(self, changes):
+        """
+        Takes a list of (badge_type, badge_num, delta) tuples, where the delta is 1 for a badge number being assigned
+        and -1 for a badge number being freed up.  We ignore badge types we haven't built a range for yet, since those
+        will be read fresh from the database when they're first needed.
+        """
+        with self.lock:
+            for badge_type, badge_num, delta in changes:
+                badge_range = self.ranges.get(badge_type)
+                if badge_range:
+                    (badge_range.add if delta > 0 else badge_range.remove)(badge_num)
+
+    def lowest_free(self, badge_type):
+        with self.lock:
+            return self._range(badge_type).lowest_free()
+
+    def next_badge_num(self, session, badge_type):
+        """
+        Returns the same thing as session.auto_badge_num(badge_type), using this index when we can.  We check the
+        number from the index against the database by counting the distinct numbers from the start of the range up
+        to and including it, which tells us both that it isn't taken and that every lower number is, since another
+        process may have used this number or freed up a lower one.  If not then the index is out-of-date, so we
+        rebuild that range next time and fall back to auto_badge_num() this time.
+        """
+        if getattr(session.auto_badge_num, '__func__', None) is not _reference_auto_badge_num:
+            return session.auto_badge_num(badge_type)
+
+        start, end = c.BADGE_RANGES[badge_type]
+        badge_num = self.lowest_free(badge_type)
+        if badge_num > end or badge_num - start != session.query(func.count(sqlalchemy.distinct(Attendee.badge_num))).filter(
+                Attendee.badge_type == badge_type, Attendee.badge_num >= start, Attendee.badge_num <= badge_num).scalar():
+            self.invalidate(badge_type)
+            return session.auto_badge_num(badge_type)
+        return badge_num
+
+badge_num_index = BadgeNumberIndex()
+
+
+def badge_num_changes(session):
+    """
+    Returns the (badge_type, badge_num, delta) tuples for the BadgeNumberIndex that describe the Attendee changes
+    being flushed in this session.  This must be called during a flush, since it uses the history of each attendee.
+    """
+    changes = []
+    for attendee in chain(session.new, session.dirty, session.deleted):
+        if isinstance(attendee, Attendee):
+            old_badge = None if attendee in session.new else (attendee.orig_value_of('badge_type'), attendee.orig_value_of('badge_num'))
+            new_badge = None if attendee in session.deleted else (attendee.badge_type, attendee.badge_num)
+            if old_badge != new_badge:
+                if old_badge and old_badge[1]:
+                    changes.append(old_badge + (-1,))
+                if new_badge and new_badge[1]:
+                    changes.append(new_badge + (1,))
+    return changes
+
+
+@on_startup
+def _build_badge_num_index():
+    if c.NUMBERED_BADGES:
+        try:
+            for badge_type in c.BADGE_RANGES:
+                badge_num_index.lowest_free(badge_type)
+        except:
+            log.warn('unable to build our badge number index on startup, we will try again when it is first used',
+                     exc_info=True)
+
+
+class BadgeLocks:
+    """
+    Locks each badge type whose numbers might be changed by a session flush, so that two threads or processes can't
+    hand out the same badge number at the same time, while flushes which don't touch any badges don't lock anything.
+    Within this process we use an RLock for each badge type.  Across processes, we use a Postgres advisory lock for
+    each badge type when we're running on Postgres, which is held until the end of the transaction, or a lock file
+    for each badge type otherwise.  We always acquire badge types in sorted order to avoid deadlocks.
+
+    The RLocks (and lock files) are only held for the length of a flush.  On Postgres we take each advisory lock before
+    the RLock for that badge type, so a thread never waits on an advisory lock while holding the RLock which the
+    advisory lock's owner needs for its next flush.  Advisory locks belong to a connection, so a second session in the
+    same thread can't take one which the first session holds without deadlocking; instead it relies on the first
+    session's lock, and takes its own as soon as the first session's transaction ends.
+
+    We also keep track of how often and for how long we had to wait for each of these locks, which is shown on the
+    diagnostics page.
+    """
+
+    # the first key for our Postgres advisory locks, to avoid colliding with anything else using advisory locks
+    pg_lock_namespace = 0xBAD6E
+
+    # the Attendee columns which can change whether an attendee needs a badge number, or which number they get
+    badge_attrs = ['badge_num', 'badge_type', 'badge_status', 'paid', 'checked_in']
+
+    def __init__(self):
+        self.lock = RLock()
+        self.locks = {}
+        self.lock_files = {}
+        self.local = threading.local()
+        self.stats = {}
+
+    @property
+    def uses_postgres(self):
+        return Session.engine.dialect.name == 'postgresql'
+
+    def _lock_for(self, badge_type):
+        with self.lock:
+            if badge_type not in self.locks:
+                self.locks[badge_type] = RLock()
+            return self.locks[badge_type]
+
+    def _lock_file_for(self, badge_type):
+        with self.lock:
+            if badge_type not in self.lock_files:
+                lock_dir = c.BADGE_LOCK_DIR or tempfile.gettempdir()
+                self.lock_files[badge_type] = open(join(lock_dir, 'uber-badge-{}.lock'.format(badge_type)), 'a')
+            return self.lock_files[badge_type]
+
+    @property
+    def _held(self):
+        if not hasattr(self.local, 'held'):
+            self.local.held = defaultdict(int)
+        return self.local.held
+
+    @property
+    def _pg_holders(self):
+        """
+        Maps each badge type to the sessions in this thread which are relying on our advisory lock for it; the first
+        of these is the one whose connection actually holds the lock.
+        """
+        if not hasattr(self.local, 'pg_holders'):
+            self.local.pg_holders = defaultdict(list)
+        return self.local.pg_holders
+
+    def badge_types_for(self, session):
+        """
+        Returns the set of badge types which might be affected by flushing this session, which includes the old and
+        new badge types of every new or deleted attendee and every attendee whose badge-related columns changed.
+        """
+        badge_types = set()
+        for attendee in chain(session.new, session.dirty, session.deleted):
+            if isinstance(attendee, Attendee):
+                if attendee in session.new or attendee in session.deleted \
+                        or any(get_history(attendee, attr).has_changes() for attr in self.badge_attrs) \
+                        or (needs_badge_num(attendee) and not attendee.badge_num):
+                    badge_types.add(get_real_badge_type(attendee.badge_type))
+                    if attendee not in session.new:
+                        badge_types.add(attendee.orig_value_of('badge_type'))
+        return {badge_type for badge_type in badge_types if badge_type is not None}
+
+    def _record(self, badge_type, waited, contended):
+        with self.lock:
+            stats = self.stats.setdefault(badge_type, {'acquired': 0, 'contended': 0, 'total_wait': 0.0, 'max_wait': 0.0})
+            stats['acquired'] += 1
+            stats['contended'] += contended
+            stats['total_wait'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+
+    def _take_advisory_lock(self, session, badge_type):
+        """
+        Takes the Postgres advisory lock for this badge type on the session's connection, returning whether we had to
+        wait for it.  This is held until the end of the session's transaction.
+        """
+        key = [self.pg_lock_namespace, badge_type]
+        if session.execute(sqlalchemy.select([func.pg_try_advisory_xact_lock(*key)])).scalar():
+            return False
+        session.execute(sqlalchemy.select([func.pg_advisory_xact_lock(*key)]))
+        return True
+
+    def _lock_advisory(self, session, badge_type):
+        holders = self._pg_holders[badge_type]
+        if session in holders:
+            return False
+
+        contended = False
+        if not holders:
+            contended = self._take_advisory_lock(session, badge_type)
+        holders.append(session)
+        session.info.setdefault('pg_badge_locks', set()).add(badge_type)
+        return contended
+
+    def _acquire_one(self, session, badge_type):
+        started = monotonic()
+        contended = self.uses_postgres and self._lock_advisory(session, badge_type)
+
+        lock = self._lock_for(badge_type)
+        if not lock.acquire(blocking=False):
+            contended = True
+            lock.acquire()
+
+        try:
+            if not self.uses_postgres and not self._held[badge_type]:
+                lock_file = self._lock_file_for(badge_type)
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    contended = True
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except:
+            lock.release()
+            raise
+
+        self._held[badge_type] += 1
+        self._record(badge_type, monotonic() - started, contended)
+
+    def _release_one(self, badge_type):
+        self._held[badge_type] -= 1
+        if not self._held[badge_type] and not self.uses_postgres:
+            fcntl.flock(self._lock_file_for(badge_type), fcntl.LOCK_UN)
+        self._lock_for(badge_type).release()
+
+    def _acquire_all(self, session, badge_types):
+        acquired = []
+        try:
+            for badge_type in sorted(badge_types):
+                self._acquire_one(session, badge_type)
+                acquired.append(badge_type)
+        except:
+            for badge_type in reversed(acquired):
+                self._release_one(badge_type)
+            raise
+        return acquired
+
+    def acquire(self, session):
+        """
+        Called before each flush to lock every badge type affected by that flush.  The locks we acquire are recorded
+        in the session so that release() can release exactly those locks.
+        """
+        session.info.setdefault('badge_locks', []).append(self._acquire_all(session, self.badge_types_for(session)))
+
+    @contextmanager
+    def locked(self, session, *badge_types):
+        """
+        Locks the given badge types for the duration of a with block, for changing badge numbers without a flush,
+        e.g. with the UPDATE in Session.shift_badges().  Flushes inside the block don't wait on these locks, since
+        we already hold them.  As with a flush, any advisory locks are held until the end of the transaction.
+        """
+        acquired = self._acquire_all(session, badge_types)
+        try:
+            yield
+        finally:
+            for badge_type in reversed(acquired):
+                self._release_one(badge_type)
+
+    def release(self, session):
+        """
+        Called after each flush, and after a flush fails, to release the locks acquired by that flush.  Postgres
+        advisory locks are held until the end of the transaction no matter what, so we only release those from
+        end_transaction().
+        """
+        for acquired in reversed(session.info.pop('badge_locks', [])):
+            for badge_type in reversed(acquired):
+                self._release_one(badge_type)
+
+    def end_transaction(self, session):
+        """
+        Called once the session's transaction has been committed, rolled back, or closed, at which point Postgres has
+        released its advisory locks.  If another session in this thread was relying on one of those, it takes its own.
+        """
+        for badge_type in session.info.pop('pg_badge_locks', set()):
+            holders = self._pg_holders[badge_type]
+            was_holding = bool(holders) and holders[0] is session
+            if session in holders:
+                holders.remove(session)
+            if was_holding and holders:
+                self._take_advisory_lock(holders[0], badge_type)
+
+    def describe(self):
+        with self.lock:
+            return '\n'.join('{}: acquired {} times, waited {} times, {:.3f} seconds total wait, {:.3f} seconds max wait'.format(
+                c.BADGES.get(badge_type, badge_type), stats['acquired'], stats['contended'], stats['total_wait'], stats['max_wait'])
+                for badge_type, stats in sorted(self.stats.items())) or 'no badge locks acquired yet'
+
+badge_locks = BadgeLocks()
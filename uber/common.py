@@ -6,9 +6,12 @@ import json
 import math
 import html
 import uuid
+import gzip
+import zlib
 import string
 import socket
 import random
+import base64
 import zipfile
 import inspect
 import decimal
@@ -30,10 +33,11 @@ from xml.dom import minidom
 from random import randrange
 from contextlib import closing
 from time import sleep, mktime
+from queue import Queue, Empty, Full
 from io import StringIO, BytesIO
 from itertools import chain, count
 from collections import defaultdict, OrderedDict
-from urllib.parse import quote, urlparse, parse_qsl, urljoin
+from urllib.parse import quote, urlparse, parse_qsl, urljoin, urlencode
 from datetime import date, time, datetime, timedelta
 from threading import Thread, RLock, local, current_thread
 from os.path import abspath, basename, dirname, exists, join
@@ -54,23 +58,25 @@ import sqlalchemy
 from sqlalchemy.sql import case
 from sqlalchemy.event import listen
 from sqlalchemy.ext import declarative
+from sqlalchemy.dialects import postgresql
 from sqlalchemy import func, or_, and_, not_
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql.expression import FunctionElement
-from sqlalchemy.orm.attributes import get_history, instance_state
-from sqlalchemy.schema import Column, ForeignKey, UniqueConstraint
+from sqlalchemy.orm.attributes import get_history, instance_state, set_committed_value
+from sqlalchemy.schema import Column, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import Query, relationship, joinedload, subqueryload, backref
 from sqlalchemy.types import Boolean, Integer, Float, TypeDecorator, Date, Numeric
 
-from sideboard.lib import log, parse_config, entry_point, listify, DaemonTask, serializer, cached_property, request_cached_property, stopped, on_startup, services, threadlocal
+from sideboard.lib import log, parse_config, entry_point, listify, DaemonTask, serializer, cached_property, request_cached_property, stopped, on_startup, on_shutdown, services, threadlocal
 from sideboard.lib.sa import declarative_base, SessionManager, UTCDateTime, UUID, CoerceUTF8 as UnicodeText
 
 import uber
 import uber as sa  # used to avoid circular dependency import issues for SQLAlchemy models
 from uber.amazon_ses import AmazonSES, EmailMessage  # TODO: replace this after boto adds Python 3 support
 from uber.config import c, Config, SecretConfig
+from uber.email_transport import *
 from uber.utils import *
 from uber.reports import *
 from uber.decorators import *
@@ -82,4 +88,5 @@ from uber import custom_tags
 from uber import server
 from uber import sep_commands
 from uber.tests import import_test_data
+from uber.tests import benchmarks
 import uber.api
@@ -322,8 +322,14 @@ class Config(_Overridable):
 
     @request_cached_property
     def PREVIOUSLY_SENT_EMAILS(self):
+        """
+        Supports checking whether a (model, fk_id, ident) tuple is in it for every automated email we've sent,
+        including the ones which have been queued for sending but which haven't gone out yet.  This is kept up to
+        date incrementally rather than loaded from scratch; see SentEmailIndex for details.
+        """
         with sa.Session() as session:
-            return set(session.query(sa.Email.model, sa.Email.fk_id, sa.Email.ident))
+            sa.sent_email_index.refresh(session)
+        return sa.sent_email_index
 
     def __getattr__(self, name):
         if name.split('_')[0] in ['BEFORE', 'AFTER']:
@@ -0,0 +1,266 @@
+from uber.common import *
+import smtplib
+from abc import ABC, abstractmethod
+from time import monotonic
+from email.utils import formatdate, make_msgid
+from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.  Tokens are added continuously at the given rate (per second) up to a
+    maximum of one second's worth, and each call to acquire() blocks until it can take a token.  This lets us send in
+    bursts up to our allowed rate rather than sleeping a fixed amount of time after every single email.
+    """
+    def __init__(self, rate):
+        self.lock = RLock()
+        self.rate = self.capacity = self.tokens = max(float(rate), 0.1)
+        self.last_refill = monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            self.rate = self.capacity = max(float(rate), 0.1)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class EmailTransport(ABC):
+    """
+    Base class for the different ways we can send email, which is configured with the EMAIL_TRANSPORT setting.
+    Subclasses must implement send(), and may override send_batch() if they can do better than sending each email
+    in turn, and close() if they hold onto any connections.
+    """
+
+    @abstractmethod
+    def send(self, source, to, subject, body, format='text', cc=(), bcc=()):
+        """
+        Sends a single email to the given list of addresses, with format being either 'text' or 'html', and returns
+        whatever identifies the sent message for this transport; raises an exception if the email wasn't sent.
+        """
+
+    def send_batch(self, emails):
+        """
+        Takes a list of dictionaries of keyword arguments to send(), sends them all, and returns a list of the same
+        length.  Each element of that list is either the result of sending that email, or the exception which was
+        raised when we tried to send it, so one failure doesn't prevent the rest of the batch from going out.
+        """
+        results = []
+        for email in emails:
+            try:
+                results.append(self.send(**email))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def make_message(source, to, subject, body, format='text', cc=()):
+        message = MIMEText(body, 'plain' if format == 'text' else 'html', 'utf-8')
+        message['Subject'] = subject
+        message['From'] = source
+        message['To'] = ', '.join(to)
+        if cc:
+            message['Cc'] = ', '.join(cc)
+        message['Date'] = formatdate(localtime=True)
+        message['Message-ID'] = make_msgid()
+        return message
+
+
+class SESTransport(EmailTransport):
+    """
+    Sends emails through Amazon SES, reusing keep-alive connections and limiting ourselves to the maximum send rate
+    which Amazon reports via GetSendQuota.  Use send() to send a single email from the current thread, or send_batch()
+    to send a list of emails concurrently from a small pool of worker threads.
+    """
+
+    # how often we re-check our send quota with Amazon
+    quota_refresh_interval = timedelta(hours=1)
+
+    def __init__(self, access_key, secret_key, host='email.us-east-1.amazonaws.com', port=None, secure=True,
+                 workers=None, default_rate=None):
+        self.ses = AmazonSES(access_key, secret_key, host=host, port=port, secure=secure)
+        self.bucket = TokenBucket(default_rate or c.EMAIL_MAX_SEND_RATE)
+        self.workers = workers or c.EMAIL_SENDING_THREADS
+        self.quota_checked = None
+        self.quota_lock = RLock()
+        self._executor = None
+
+    def refresh_quota(self):
+        """
+        Updates our rate limit with the maximum send rate from our SES account.  If we can't get our quota then we
+        keep using whatever rate we were already using, which starts out as c.EMAIL_MAX_SEND_RATE.
+        """
+        with self.quota_lock:
+            now = datetime.now(UTC)
+            if self.quota_checked and now - self.quota_checked < self.quota_refresh_interval:
+                return
+            self.quota_checked = now
+
+        try:
+            quota = self.ses.getSendQuota()
+        except:
+            log.warn('unable to get our SES send quota, sending at {} emails per second', self.bucket.rate, exc_info=True)
+        else:
+            if quota and quota.maxSendRate > 0:
+                self.bucket.set_rate(quota.maxSendRate)
+
+    def send(self, source, to, subject, body, format='text', cc=(), bcc=()):
+        if self.ses._accessKeyID:
+            self.refresh_quota()
+        self.bucket.acquire()
+        message = EmailMessage(subject=subject, **{'bodyText' if format == 'text' else 'bodyHtml': body})
+        return self.ses.sendEmail(source=source, toAddresses=to, ccAddresses=cc, bccAddresses=bcc, message=message)
+
+    @property
+    def executor(self):
+        with self.quota_lock:
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def send_batch(self, emails):
+        """
+        Like EmailTransport.send_batch() except that we send these concurrently.
+        """
+        futures = []
+        for email in emails:
+            try:
+                futures.append(self.executor.submit(self.send, **email))
+            except Exception as e:
+                futures.append(e)
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future if isinstance(future, Exception) else future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self):
+        with self.quota_lock:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        self.ses.close()
+
+
+class SMTPTransport(EmailTransport):
+    """
+    Sends emails through an SMTP server, keeping a single connection open and reusing it for every email we send,
+    and reconnecting if the server has closed it in the meantime.  This can also be pointed at a local SMTP server
+    which just logs or discards emails, e.g. for load testing our email pipeline without any network access.
+    """
+
+    def __init__(self, host, port=25, username='', password='', use_tls=False, timeout=30):
+        self.host, self.port, self.username, self.password = host, port, username, password
+        self.use_tls, self.timeout = use_tls, timeout
+        self.lock = RLock()
+        self.connection = None
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def send(self, source, to, subject, body, format='text', cc=(), bcc=()):
+        message = self.make_message(source, to, subject, body, format, cc)
+        with self.lock:
+            for attempt in [1, 2]:
+                reused = self.connection is not None
+                if not reused:
+                    self.connection = self._connect()
+                try:
+                    return self.connection.sendmail(source, list(to) + list(cc) + list(bcc), message.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    self.connection = None
+                    if not reused:
+                        raise
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                try:
+                    self.connection.quit()
+                except smtplib.SMTPException:
+                    pass
+                self.connection = None
+
+
+class FileTransport(EmailTransport):
+    """
+    Doesn't actually send any emails; instead each email is written to its own .eml file in a directory, which is
+    handy for development and for load testing our email pipeline without any network access.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, source, to, subject, body, format='text', cc=(), bcc=()):
+        message = self.make_message(source, to, subject, body, format, cc)
+        if bcc:
+            message['Bcc'] = ', '.join(bcc)
+        filename = join(self.directory, '{}-{}.eml'.format(datetime.now(UTC).strftime('%Y%m%d%H%M%S%f'), uuid4().hex))
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(message.as_string())
+        return filename
+
+
+_email_transports = {}
+_email_transports_lock = RLock()
+
+
+def _make_email_transport(kind, *settings):
+    if kind == 'smtp':
+        return SMTPTransport(*settings)
+    elif kind == 'file':
+        return FileTransport(*settings)
+    else:
+        return SESTransport(*settings)
+
+
+def get_email_transport():
+    """
+    Returns the shared transport we use to send all of our emails, as configured by the EMAIL_TRANSPORT setting.
+    We keep one around per configuration so that its connections and rate limiting are shared by every thread that
+    sends email.
+    """
+    key = {
+        'smtp': ('smtp', c.SMTP_HOST, c.SMTP_PORT, c.SMTP_USERNAME, c.SMTP_PASSWORD, c.SMTP_USE_TLS),
+        'file': ('file', c.EMAIL_FILE_DIR),
+    }.get(c.EMAIL_TRANSPORT, ('ses', c.AWS_ACCESS_KEY, c.AWS_SECRET_KEY))
+
+    with _email_transports_lock:
+        if key not in _email_transports:
+            _email_transports[key] = _make_email_transport(*key)
+        return _email_transports[key]
+
+
+@on_shutdown
+def _close_email_transports():
+    with _email_transports_lock:
+        for transport in _email_transports.values():
+            transport.close()
+        _email_transports.clear()
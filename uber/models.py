@@ -115,22 +115,163 @@ class Choice(TypeDecorator):
                 return int(value)
 
 
+class has_choice(FunctionElement):
+    """
+    SQL for MultiChoice.Comparator.has_choice(), which checks whether a MultiChoice column includes an option.
+
+    On Postgres we treat the column as an integer array, which indexed MultiChoice columns have a GIN index on (see
+    _create_multichoice_indexes).  Elsewhere, indexed MultiChoice columns have their options copied into the
+    multi_choice_value table, and for anything else we fall back to searching the comma-separated string.  Either
+    way we only match whole options, unlike .contains(), which e.g. matches "12" when looking for "2".
+
+    If the multi_choice_value rows for a column have been marked stale (see MultiChoiceValue.mark_stale) then we
+    search the comma-separated strings of that column as well, so we still find everything until they're rebuilt.
+    """
+    type = Boolean()
+    name = 'has_choice'
+
+
+def _delimited_like(column, choice):
+    delimited = sqlalchemy.literal(',', UnicodeText).concat(column).concat(',')
+    return delimited.like(sqlalchemy.literal('%,', UnicodeText).concat(choice).concat(',%'))
+
+
+@compiles(has_choice)
+def default_has_choice(element, compiler, **kw):
+    column, choice = element.clauses.clauses
+    if column.type.indexed:
+        values, table = MultiChoiceValue.__table__, getattr(column.table, 'element', column.table)
+        this_column = and_(values.c.table_name == table.name, values.c.column_name == column.name)
+        indexed = sqlalchemy.select([values.c.row_id]).where(and_(this_column, values.c.value == choice))
+        stale = sqlalchemy.exists().where(and_(this_column, values.c.row_id == MultiChoiceValue.stale_row_id))
+        unindexed = sqlalchemy.select([column.table.c.id]).where(and_(stale, _delimited_like(column, choice))) \
+                              .correlate(None)
+        return compiler.process(column.table.c.id.in_(sqlalchemy.union_all(indexed, unindexed)), **kw)
+    else:
+        return compiler.process(_delimited_like(column, choice), **kw)
+
+
+@compiles(has_choice, 'postgresql')
+def pg_has_choice(element, compiler, **kw):
+    column, choice = element.clauses.clauses
+    return compiler.process(MultiChoice.as_array(column).contains(postgresql.array([choice])), **kw)
+
+
 class MultiChoice(TypeDecorator):
     """
     Utility class for storing the results of a group of checkboxes.  Each value
     is represented by an integer, so we store them as a comma-separated string.
     This can be marginally more convenient than a many-to-many table.  Like the
     Choice class, this takes an array of tuples of integers and strings.
+
+    Pass indexed=True for columns which we often filter on with has_choice(),
+    e.g. Attendee.assigned_depts.has_choice(c.ARCADE); see has_choice above.
     """
     impl = UnicodeText
 
-    def __init__(self, choices, **kwargs):
+    class Comparator(TypeDecorator.Comparator):
+        def has_choice(self, choice):
+            return has_choice(self.expr, int(choice))
+
+    comparator_factory = Comparator
+
+    def __init__(self, choices, *, indexed=False, **kwargs):
+        self.indexed = indexed
         self.choices = choices
         TypeDecorator.__init__(self, **kwargs)
 
+    @property
+    def choices(self):
+        return self._choices
+
+    @choices.setter
+    def choices(self, choices):
+        """
+        Our options may be replaced after the column is defined (e.g. our tests use their own departments), so we
+        recompute our lookup tables whenever that happens.
+        """
+        self._choices = choices
+        self.labels = dict(choices)
+        self.bits = {val: 1 << i for i, val in enumerate(self.labels)}
+
+    def parse(self, value):
+        """
+        Returns a tuple of the valid integer options in a stored value, along with a bitmask of those options with
+        one bit per option (as numbered in self.bits), which lets us check whether a value includes an option
+        without scanning the list.
+        """
+        ints = tuple(int(i) for i in str(value).split(',') if int(i) in self.labels) if value else ()
+        mask = 0
+        for i in ints:
+            mask |= self.bits[i]
+        return ints, mask
+
+    def mask(self, choices):
+        """Returns the bitmask of the given options, ignoring any which aren't options of this column."""
+        mask = 0
+        for choice in choices:
+            mask |= self.bits.get(choice, 0)
+        return mask
+
     def process_bind_param(self, value, dialect):
         return value if isinstance(value, str) else ','.join(value)
 
+    @staticmethod
+    def as_array(column):
+        """Returns a Postgres expression of the given MultiChoice column as an integer array."""
+        return sqlalchemy.cast(func.string_to_array(column, sqlalchemy.literal_column("','")), postgresql.ARRAY(Integer))
+
+
+def _coerce_float(value):
+    return float(value)
+
+
+def _coerce_choice(value):
+    return None if value == '' else int(float(value))
+
+
+def _coerce_integer(value):
+    return int(float(value))
+
+
+def _coerce_datetime(value):
+    return c.EVENT_TIMEZONE.localize(datetime.strptime(value, c.TIMESTAMP_FORMAT))
+
+
+def _coerce_date(value):
+    return datetime.strptime(value, c.DATE_FORMAT).date()
+
+
+class FormBindingPlan:
+    """
+    Everything MagModel.apply() needs to know about a model's columns in order to set them from form parameters,
+    worked out once per model (and per restricted/unrestricted mode) rather than for every column on every request.
+
+    coercers maps the name of each column which may be set to a function which converts a submitted string into
+    that column's type, or None if the string is used as is.  bools and checkgroups are the Boolean and MultiChoice
+    columns which are set even if they weren't submitted in restricted mode, and columns is every column name.
+    """
+    def __init__(self, model, restricted):
+        self.columns = frozenset(model.__table__.columns.keys())
+        self.bools = frozenset(model.regform_bools if restricted else ())
+        self.checkgroups = frozenset(model.regform_checkgroups if restricted else ())
+        allowed = model.unrestricted if restricted else self.columns
+        self.coercers = {column.name: self.coercer(column) for column in model.__table__.columns
+                         if column.name in allowed and column.name != 'id'}
+
+    @staticmethod
+    def coercer(column):
+        if isinstance(column.type, Float):
+            return _coerce_float
+        elif isinstance(column.type, Choice):
+            return _coerce_choice
+        elif isinstance(column.type, Integer):
+            return _coerce_integer
+        elif isinstance(column.type, UTCDateTime):
+            return _coerce_datetime
+        elif isinstance(column.type, Date):
+            return _coerce_date
+
 
 @declarative_base
 class MagModel:
@@ -150,14 +291,39 @@ class MagModel:
     def _class_attrs(self):
         return {name: getattr(self.__class__, name) for name in dir(self.__class__)}
 
+    @classmethod
+    def _compile_class_registry(cls):
+        """
+        Finds the names of this class's presave and predelete adjustments (in the order they were defined) and of its
+        cost properties.  Calling dir() and getattr() on every attribute of the class (which evaluates all of our
+        class properties) used to be the most expensive part of every presave, so we do this once per class and
+        again whenever Session.model_mixin adds new attributes to the class.
+        """
+        attrs = {}
+        for klass in reversed(cls.__mro__):
+            attrs.update(vars(klass))
+
+        registry = {
+            'cost_property_names': tuple(sorted(name for name, attr in attrs.items() if isinstance(attr, cost_property))),
+            'indexed_multichoices': tuple(name for name, column in cls.__table__.columns.items()
+                                          if isinstance(column.type, MultiChoice) and column.type.indexed)
+        }
+        for label in ['presave_adjustment', 'predelete_adjustment']:
+            callbacks = [(getattr(attr, label), name) for name, attr in attrs.items()
+                         if hasattr(attr, '__call__') and hasattr(attr, label)]
+            registry[label] = tuple(name for order, name in sorted(callbacks))
+        cls._class_registry = registry
+        return registry
+
+    @classmethod
+    def _get_class_registry(cls):
+        return cls.__dict__.get('_class_registry') or cls._compile_class_registry()
+
     def _invoke_adjustment_callbacks(self, label):
-        callbacks = []
-        for name, attr in self._class_attrs.items():
-            if hasattr(attr, '__call__') and hasattr(attr, label):
-                callbacks.append(getattr(self, name))
-        callbacks.sort(key=lambda f: getattr(f, label))
-        for func in callbacks:
-            func()
+        for name in self._get_class_registry()[label]:
+            func = getattr(self, name)
+            if hasattr(func, label):  # our tests sometimes replace an adjustment to disable it
+                func()
 
     def presave_adjustments(self):
         self._invoke_adjustment_callbacks('presave_adjustment')
@@ -190,7 +356,7 @@ class MagModel:
     @property
     def cost_property_names(self):
         """Returns the names of all cost properties on this model."""
-        return [name for name, attr in self._class_attrs.items() if isinstance(attr, cost_property)]
+        return self._get_class_registry()['cost_property_names']
 
     @property
     def default_cost(self):
@@ -261,11 +427,21 @@ class MagModel:
 
     @property
     def created(self):
-        return self.get_tracking_by_instance(self, action=c.CREATED, last_only=True)
+        return self.latest_tracking(c.CREATED)
 
     @property
     def last_updated(self):
-        return self.get_tracking_by_instance(self, action=c.UPDATED, last_only=True)
+        return self.latest_tracking(c.UPDATED)
+
+    def latest_tracking(self, action):
+        """
+        Returns the most recent Tracking record of the given action for this instance, which we remember so that
+        templates can use e.g. attendee.created.who and attendee.created.when without querying twice.
+        """
+        cache = self.__dict__.setdefault('_latest_tracking', {})
+        if action not in cache:
+            cache[action] = self.get_tracking_by_instance(self, action=action, last_only=True)
+        return cache[action]
 
     @property
     def db_id(self):
@@ -304,8 +480,7 @@ class MagModel:
         Returns: A list of integers or an empty list if val is falsey.
 
         """
-        choices = dict(self.get_field(name).type.choices)
-        return [int(i) for i in str(val).split(',') if int(i) in choices] if val else []
+        return list(self._parse_multichoice(name, val)[0])
 
     @suffix_property
     def _label(self, name, val):
@@ -329,26 +504,76 @@ class MagModel:
 
     @suffix_property
     def _labels(self, name, val):
-        ints = getattr(self, name + '_ints')
-        labels = dict(self.get_field(name).type.choices)
-        return sorted(labels[i] for i in ints)
+        labels = self.get_field(name).type.labels
+        return sorted(labels[i] for i in self._parse_multichoice(name, val)[0])
 
-    def __getattr__(self, name):
-        suffixed = suffix_property.check(self, name)
-        if suffixed is not None:
-            return suffixed
+    @suffix_property
+    def _mask(self, name, val):
+        """
+        Returns the bitmask of the options in a MultiChoice column; see MultiChoice.parse() and MultiChoice.mask().
+        """
+        return self._parse_multichoice(name, val)[1]
 
-        try:
-            [multi] = [col for col in self.__table__.columns if isinstance(col.type, MultiChoice)]
-            choice = getattr(c, name)
-            assert choice in [val for val, desc in multi.type.choices]
-        except:
-            pass
-        else:
-            return choice in getattr(self, multi.name + '_ints')
+    def _parse_multichoice(self, name, val):
+        """
+        Returns MultiChoice.parse() of the given value of one of our MultiChoice columns.  Some of these columns are
+        checked in loops over every staffer, so we remember the parsed value of each column on this instance until
+        the column is set to something else.
+        """
+        cache = self.__dict__.setdefault('_multichoice_cache', {})
+        if name not in cache or cache[name][0] != val:
+            cache[name] = (val, self.get_field(name).type.parse(val))
+        return cache[name][1]
 
-        if name.startswith('is_'):
-            return self.__class__.__name__.lower() == name[3:]
+    def multichoice_contains(self, name, choice):
+        """
+        Returns whether the MultiChoice column with the given name includes the given option, checking its bitmask
+        rather than searching the list of its options.
+        """
+        return bool(getattr(self, name + '_mask') & self.get_field(name).type.bits.get(choice, 0))
+
+    @classmethod
+    def _getattr_resolvers(cls, name):
+        """
+        Returns a tuple of functions which __getattr__ should try in order to look up the given attribute name, each
+        of which takes an instance and returns the value, or None if the next function should be tried.  Templates
+        and reports look up attributes like these thousands of times per page, so we work out which kind of name
+        this is once per class and remember it in a dispatch table, including names which aren't anything at all.
+
+        A MultiChoice check like attendee.ARCADE only works with the options from our config file, not with values
+        which are computed on the fly by the Config class.
+        """
+        dispatch = cls.__dict__.get('_getattr_dispatch')
+        if dispatch is None:
+            dispatch = cls._getattr_dispatch = {}
+        if name in dispatch:
+            return dispatch[name]
+
+        resolvers = []
+        if not name.startswith('_'):
+            suffix = '_' + name.rsplit('_', 1)[-1]
+            prop_func = getattr(cls, suffix, None)
+            if getattr(prop_func, '_is_suffix_property', False):
+                field_name = name[:-len(suffix)]
+                resolvers.append(lambda self: prop_func(self, field_name, getattr(self, field_name)))
+
+        multis = [col for col in cls.__table__.columns if isinstance(col.type, MultiChoice)]
+        choice = vars(c).get(name)
+        if len(multis) == 1 and isinstance(choice, int) and choice in multis[0].type.labels:
+            ints_name = multis[0].name + '_ints'
+            resolvers.append(lambda self: choice in getattr(self, ints_name))
+        elif name.startswith('is_'):
+            is_model = cls.__name__.lower() == name[3:]
+            resolvers.append(lambda self: is_model)
+
+        dispatch[name] = tuple(resolvers)
+        return dispatch[name]
+
+    def __getattr__(self, name):
+        for resolver in self._getattr_resolvers(name):
+            value = resolver(self)
+            if value is not None:
+                return value
 
         raise AttributeError(self.__class__.__name__ + '.' + name)
 
@@ -356,45 +581,47 @@ class MagModel:
         query = self.session.query(Tracking).filter_by(fk_id=instance.id, action=action).order_by(Tracking.when.desc())
         return query.first() if last_only else query.all()
 
+    @classmethod
+    def _get_binding_plan(cls, restricted):
+        plans = cls.__dict__.get('_binding_plans')
+        if plans is None:
+            plans = cls._binding_plans = {}
+        if restricted not in plans:
+            plans[restricted] = FormBindingPlan(cls, restricted)
+        return plans[restricted]
+
     def apply(self, params, *, bools=(), checkgroups=(), restricted=True, ignore_csrf=True):
         """
         Args:
             restricted (bool): if true, restrict any changes only to fields which we allow attendees to set on their own
                 if false, allow changes to any fields.
         """
-        bools = self.regform_bools if restricted else bools
-        checkgroups = self.regform_checkgroups if restricted else checkgroups
-        for column in self.__table__.columns:
-            if (not restricted or column.name in self.unrestricted) and column.name in params and column.name != 'id':
-                if isinstance(params[column.name], list):
-                    value = ','.join(map(str, params[column.name]))
-                elif isinstance(params[column.name], bool):
-                    value = params[column.name]
-                else:
-                    value = str(params[column.name]).strip()
-
-                try:
-                    if isinstance(column.type, Float):
-                        value = float(value)
-                    elif isinstance(column.type, Choice) and value == '':
-                        value = None
-                    elif isinstance(column.type, (Choice, Integer)):
-                        value = int(float(value))
-                    elif isinstance(column.type, UTCDateTime):
-                        value = c.EVENT_TIMEZONE.localize(datetime.strptime(value, c.TIMESTAMP_FORMAT))
-                    elif isinstance(column.type, Date):
-                        value = datetime.strptime(value, c.DATE_FORMAT).date()
-                except:
-                    pass
-
-                setattr(self, column.name, value)
+        plan = self._get_binding_plan(bool(restricted))
+        bools = plan.bools if restricted else bools
+        checkgroups = plan.checkgroups if restricted else checkgroups
+        for name, value in params.items():
+            if name in plan.coercers:
+                if isinstance(value, list):
+                    value = ','.join(map(str, value))
+                elif not isinstance(value, bool):
+                    value = str(value).strip()
+
+                coercer = plan.coercers[name]
+                if coercer:
+                    try:
+                        value = coercer(value)
+                    except:
+                        pass
+
+                setattr(self, name, value)
 
         if cherrypy.request.method.upper() == 'POST':
-            for column in self.__table__.columns:
-                if column.name in bools:
-                    setattr(self, column.name, column.name in params and bool(int(params[column.name])))
-                elif column.name in checkgroups and column.name not in params:
-                    setattr(self, column.name, '')
+            for name in bools:
+                if name in plan.columns:
+                    setattr(self, name, name in params and bool(int(params[name])))
+            for name in checkgroups:
+                if name in plan.columns and name not in bools and name not in params:
+                    setattr(self, name, '')
 
             if not ignore_csrf:
                 check_csrf(params.get('csrf_token'))
@@ -464,6 +691,23 @@ class Session(SessionManager):
         def iexact(self, **filters):
             return self.filter(*[func.lower(getattr(self.model, attr)) == func.lower(val) for attr, val in filters.items()])
 
+        def keyset_chunks(self, size=1000):
+            """
+            Yields the results of this query as lists of at most "size" model instances, ordered by id (any other
+            ordering is discarded).  Each chunk is fetched with its own query which picks up after the last id of
+            the previous chunk, so unlike yield_per() this works with eager loading, and callers can expunge each
+            chunk from the session once they're done with it to keep memory usage flat.
+            """
+            query = self.order_by(None).order_by(self.model.id)
+            last_id = None
+            while True:
+                chunk = (query if last_id is None else query.filter(self.model.id > last_id)).limit(size).all()
+                if chunk:
+                    yield chunk
+                if len(chunk) < size:
+                    break
+                last_id = chunk[-1].id
+
     class SessionMixin:
         def admin_attendee(self):
             return self.admin_account(cherrypy.session['account_id']).attendee
@@ -503,7 +747,26 @@ class Session(SessionManager):
             return self.query(AdminAccount).join(Attendee).filter(func.lower(Attendee.email) == func.lower(email)).one()
 
         def no_email(self, subject):
-            return not self.query(Email).filter_by(subject=subject).all()
+            return not self.query(sqlalchemy.exists().where(Email.subject == subject)).scalar()
+
+        def duplicate_attendees(self):
+            """
+            Returns the completed attendees who share a name and email address (ignoring case) with at least one other
+            completed attendee, ordered by when they registered.  Attendees in waitlisted or unapproved groups aren't
+            counted.  We let the database find the duplicated names and emails rather than loading every attendee.
+            """
+            name = func.lower(Attendee.first_name + ' ' + Attendee.last_name)
+            email = func.lower(Attendee.email)
+            candidates = self.query(Attendee).outerjoin(Group, Attendee.group_id == Group.id).filter(
+                Attendee.first_name != '',
+                Attendee.badge_status == c.COMPLETED_STATUS,
+                or_(Attendee.group_id == None, Group.status.notin_([c.WAITLISTED, c.UNAPPROVED])))
+
+            duplicated = candidates.with_entities(name.label('name'), email.label('email')) \
+                .group_by(name, email).having(func.count(Attendee.id) > 1).subquery()
+
+            return candidates.join(duplicated, and_(name == duplicated.c.name, email == duplicated.c.email)) \
+                .options(joinedload(Attendee.group)).order_by(Attendee.registered).all()
 
         def lookup_attendee(self, first_name, last_name, email, zip_code):
             email = normalize_email(email)
@@ -522,15 +785,16 @@ class Session(SessionManager):
             the badge type's range.
             :return:
             """
+            from uber.badge_funcs import badge_num_index
             badge_type = get_real_badge_type(badge_type)
 
-            new_badge_num = self.auto_badge_num(badge_type)
+            next_badge_num = new_badge_num = badge_num_index.next_badge_num(self, badge_type)
             # Adjusts the badge number based on badges in the session
             for attendee in [m for m in chain(self.new, self.dirty) if isinstance(m, Attendee)]:
                 if attendee.badge_type == badge_type and attendee.badge_num is not None\
                         and attendee.badge_num <= c.BADGE_RANGES[badge_type][1]\
-                        and attendee.badge_num <= self.auto_badge_num(badge_type):
-                    new_badge_num = max(self.auto_badge_num(badge_type), 1 + attendee.badge_num)
+                        and attendee.badge_num <= next_badge_num:
+                    new_badge_num = max(next_badge_num, 1 + attendee.badge_num)
 
             assert new_badge_num < c.BADGE_RANGES[badge_type][1], 'There are no more badge numbers available in this range!'
 
@@ -581,9 +845,12 @@ class Session(SessionManager):
 
         def auto_badge_num(self, badge_type):
             """
-            Gets the next available badge number for a badge type's range.
+            Gets the next available badge number for a badge type's range.  We normally use the much faster
+            badge_num_index instead, but this is still the reference implementation which that index should agree with,
+            and the fallback we use whenever the index turns out to be out-of-date.
 
-            Plugins can override the logic here if need be without worrying about handling dirty sessions.
+            Plugins can override the logic here if need be without worrying about handling dirty sessions.  If they do,
+            get_next_badge_num() calls the override every time instead of using our badge_num_index.
 
             :param badge_type: Used as a starting point if no badges of the same type exist, and to select badges within
             a specific range.
@@ -615,13 +882,79 @@ class Session(SessionManager):
             assert len(direction) < 2, 'you cannot specify both up and down parameters'
             down = (not direction['up']) if 'up' in direction else direction.get('down', True)
             shift = -1 if down else 1
-            for a in self.query(Attendee).filter(Attendee.badge_type == badge_type,
-                                                 Attendee.badge_num is not None,
-                                                 Attendee.badge_num >= badge_num,
-                                                 Attendee.badge_num <= until):
-                a.badge_num += shift
+            in_range = and_(Attendee.badge_type == badge_type,
+                            Attendee.badge_num >= badge_num,
+                            Attendee.badge_num <= until)
+
+            # neither of these goes through a flush right away, so we take the badge lock which a flush would take
+            from uber.badge_funcs import badge_locks
+            with badge_locks.locked(self, badge_type):
+                if not self._can_shift_in_bulk(badge_type, badge_num, until, shift):
+                    # these changes are tracked for each attendee when they're flushed, like any other change
+                    for a in self.query(Attendee).filter(in_range):
+                        a.badge_num += shift
+                    return True
+
+                ids = [id for [id] in self.query(Attendee.id).filter(in_range).order_by(Attendee.badge_num)]
+                if ids:
+                    if Session.engine.dialect.name == 'postgresql':
+                        # the UniqueConstraint on badge_num in Attendee.__table_args__ is deferred, so it doesn't
+                        # matter if numbers overlap partway through this UPDATE
+                        self.query(Attendee).filter(in_range).update({Attendee.badge_num: Attendee.badge_num + shift},
+                                                                     synchronize_session=False)
+                    else:
+                        # SQLite can't defer that constraint and checks it row-by-row, so we move everything out of
+                        # the way first
+                        self.query(Attendee).filter(in_range).update({Attendee.badge_num: -(Attendee.badge_num + shift)},
+                                                                     synchronize_session=False)
+                        self.query(Attendee).filter(Attendee.badge_type == badge_type,
+                                                    Attendee.badge_num < 0,
+                                                    Attendee.badge_num >= -(until + shift),
+                                                    Attendee.badge_num <= -(badge_num + shift)) \
+                                            .update({Attendee.badge_num: -Attendee.badge_num}, synchronize_session=False)
+
+                    self._sync_shifted_badges(badge_type, badge_num, until, shift)
+                    self.info.setdefault('badge_types_shifted', set()).add(badge_type)
+                    tracking = Tracking.badge_shift(ids, badge_type, badge_num, until, shift)
+                    self.add_all([tracking] + tracking.link_records())
+                    self.info.setdefault('tracking_actors', set()).add(tracking.who)
             return True
 
+        def _can_shift_in_bulk(self, badge_type, badge_num, until, shift):
+            """
+            Attendee.__table_args__ has a UniqueConstraint on badge_num, which is deferred until we commit on Postgres,
+            so there shift_badges can always use a single UPDATE.  SQLite (e.g. in development) can't defer it, so
+            we can only shift in bulk if none of the numbers we're shifting into belong to some other badge.
+            Otherwise we shift each attendee in the session one at a time, the way we always used to, which defers
+            the problem to when the session is flushed, by which time the badge in the way has usually been deleted
+            or given a different number.
+            """
+            if Session.engine.dialect.name == 'postgresql':
+                return True
+            lowest, highest = badge_num + shift, until + shift
+            return not self.query(sqlalchemy.exists().where(and_(
+                Attendee.badge_num >= lowest,
+                Attendee.badge_num <= highest,
+                not_(and_(Attendee.badge_type == badge_type,
+                          Attendee.badge_num >= badge_num,
+                          Attendee.badge_num <= until))))).scalar()
+
+        def _sync_shifted_badges(self, badge_type, badge_num, until, shift):
+            """
+            After shifting badge numbers with an UPDATE, the attendees already loaded into this session still have
+            their old numbers, so we update them to match the database without marking them as changed.  Attendees
+            whose badge number has already been changed in this session are shifted like any other change, the same as
+            shift_badges used to do, so that we don't lose the shift when the session is flushed.
+            """
+            for a in list(self.identity_map.values()):
+                if isinstance(a, Attendee) and 'badge_num' in a.__dict__ and 'badge_type' in a.__dict__:
+                    if a.orig_value_of('badge_type') == badge_type and a.orig_value_of('badge_num') is not None \
+                            and badge_num <= a.orig_value_of('badge_num') <= until:
+                        if get_history(a, 'badge_num').has_changes():
+                            a.badge_num += shift
+                        else:
+                            set_committed_value(a, 'badge_num', a.badge_num + shift)
+
         def change_badge(self, attendee, badge_type, badge_num=None):
             """
             Badges should always be assigned a number if they're marked as
@@ -669,6 +1002,16 @@ class Session(SessionManager):
             attendee.badge_type = badge_type
             return 'Badge updated'
 
+        def tracked_changes(self, model, id):
+            """
+            Returns a query of the Tracking records for changes to the given model instance or anything linked to it,
+            e.g. all of the changes to an attendee along with any changes to their shifts.
+            """
+            linked = self.query(TrackingLink.tracking_id).filter_by(table_name=model.__tablename__, fk_id=id)
+            return self.query(Tracking).filter(or_(Tracking.id.in_(linked),
+                                                   and_(Tracking.model == model.__name__, Tracking.fk_id == id))) \
+                                       .order_by(Tracking.when)
+
         def valid_attendees(self):
             return self.query(Attendee).filter(Attendee.badge_status != c.INVALID_STATUS)
 
@@ -871,6 +1214,11 @@ class Session(SessionManager):
                     target.__table__.c.replace(attr)
                 else:
                     setattr(target, name, attr)
+
+        if hasattr(target, '_compile_class_registry'):
+            target._compile_class_registry()
+            target._getattr_dispatch = {}
+            target._binding_plans = {}
         return target
 
 
@@ -949,10 +1297,14 @@ class Group(MagModel, TakesPaymentMixin):
         else:
             return badge_being_claimed.badge_type_label
 
-    @property
+    @hybrid_property
     def is_dealer(self):
         return bool(self.tables and self.tables != '0' and (not self.registered or self.amount_paid or self.cost))
 
+    @is_dealer.expression
+    def is_dealer(cls):
+        return and_(cls.tables > 0, or_(cls.registered == None, cls.amount_paid != 0, cls.cost != 0))
+
     @property
     def is_unpaid(self):
         return self.cost > 0 and self.amount_paid == 0
@@ -1053,7 +1405,7 @@ class Attendee(MagModel, TakesPaymentMixin):
     ec_phone      = Column(UnicodeText)
     cellphone     = Column(UnicodeText)
 
-    interests   = Column(MultiChoice(c.INTEREST_OPTS))
+    interests   = Column(MultiChoice(c.INTEREST_OPTS, indexed=True))
     found_how   = Column(UnicodeText)
     comments    = Column(UnicodeText)
     for_review  = Column(UnicodeText, admin_only=True)
@@ -1086,9 +1438,9 @@ class Attendee(MagModel, TakesPaymentMixin):
     badge_printed_name = Column(UnicodeText)
 
     staffing          = Column(Boolean, default=False)
-    requested_depts   = Column(MultiChoice(c.JOB_INTEREST_OPTS))
-    assigned_depts    = Column(MultiChoice(c.JOB_LOCATION_OPTS), admin_only=True)
-    trusted_depts     = Column(MultiChoice(c.JOB_LOCATION_OPTS), admin_only=True)
+    requested_depts   = Column(MultiChoice(c.JOB_INTEREST_OPTS, indexed=True))
+    assigned_depts    = Column(MultiChoice(c.JOB_LOCATION_OPTS, indexed=True), admin_only=True)
+    trusted_depts     = Column(MultiChoice(c.JOB_LOCATION_OPTS, indexed=True), admin_only=True)
     nonshift_hours    = Column(Integer, default=0, admin_only=True)
     past_years        = Column(UnicodeText, admin_only=True)
     can_work_setup    = Column(Boolean, default=False, admin_only=True)
@@ -1207,7 +1559,7 @@ class Attendee(MagModel, TakesPaymentMixin):
                 self.paid = c.NEED_NOT_PAY
 
         # remove trusted status from any dept we are not assigned to
-        self.trusted_depts = ','.join(str(td) for td in self.trusted_depts_ints if td in self.assigned_depts_ints)
+        self.trusted_depts = ','.join(str(td) for td in self.trusted_depts_ints if self.assigned_to(td))
 
     @presave_adjustment
     def _email_adjustment(self):
@@ -1493,7 +1845,8 @@ class Attendee(MagModel, TakesPaymentMixin):
 
     @property
     def takes_shifts(self):
-        return bool(self.staffing and set(self.assigned_depts_ints) - set(c.SHIFTLESS_DEPTS))
+        shiftless = self.get_field('assigned_depts').type.mask(c.SHIFTLESS_DEPTS)
+        return bool(self.staffing and self.assigned_depts_mask & ~shiftless)
 
     @property
     def hours(self):
@@ -1554,20 +1907,20 @@ class Attendee(MagModel, TakesPaymentMixin):
         return wh + self.nonshift_hours
 
     def requested(self, department):
-        return department in self.requested_depts_ints
+        return self.multichoice_contains('requested_depts', department)
 
     def assigned_to(self, department):
-        return int(department or 0) in self.assigned_depts_ints
+        return self.multichoice_contains('assigned_depts', int(department or 0))
 
     def trusted_in(self, department):
-        return int(department or 0) in self.trusted_depts_ints
+        return self.multichoice_contains('trusted_depts', int(department or 0))
 
     @property
     def trusted_somewhere(self):
         """
         :return: True if this Attendee is trusted in at least 1 department
         """
-        return len(self.trusted_depts_ints) > 0
+        return bool(self.trusted_depts_mask)
 
     def has_shifts_in(self, department):
         return any(shift.job.location == department for shift in self.shifts)
@@ -1774,8 +2127,8 @@ class Job(MagModel):
         :param: order_by: order by another Attendee attribute
         """
         return (self.session.query(Attendee)
-                .filter(Attendee.assigned_depts.contains(str(self.location)))
-                .filter(*[Attendee.trusted_depts.contains(str(self.location))] if self.restricted else [])
+                .filter(Attendee.assigned_depts.has_choice(self.location))
+                .filter(*[Attendee.trusted_depts.has_choice(self.location)] if self.restricted else [])
                 .filter_by(**{'staffing': True} if staffing_only else {})
                 .order_by(order_by)
                 .all())
@@ -1863,7 +2216,7 @@ class Email(MagModel):
     ident   = Column(UnicodeText)
     model   = Column(UnicodeText)
     when    = Column(UTCDateTime, default=lambda: datetime.now(UTC))
-    subject = Column(UnicodeText)
+    subject = Column(UnicodeText, index=True)
     dest    = Column(UnicodeText)
     body    = Column(UnicodeText)
 
@@ -1895,8 +2248,101 @@ class Email(MagModel):
             return SafeString(self.body.replace('\n', '<br/>'))
 
 
+class EmailOutbox(MagModel):
+    """
+    Automated emails which have been rendered by the email daemon but not yet sent.  Rows are claimed by the sender
+    before we try to send them and are replaced by an Email row once they've been sent, so each email is sent at most
+    once even if we crash partway through.  See SendQueuedEmailsJob for the details.
+    """
+    fk_id        = Column(UUID)
+    model        = Column(UnicodeText)
+    ident        = Column(UnicodeText)
+    sender       = Column(UnicodeText)
+    dest         = Column(UnicodeText)
+    cc           = Column(UnicodeText, default='')
+    bcc          = Column(UnicodeText, default='')
+    subject      = Column(UnicodeText)
+    body         = Column(UnicodeText)
+    format       = Column(UnicodeText, default='text')
+    queued       = Column(UTCDateTime, default=lambda: datetime.now(UTC))
+    attempts     = Column(Integer, default=0)
+    next_attempt = Column(UTCDateTime, default=lambda: datetime.now(UTC))
+    claim        = Column(UnicodeText, nullable=True)
+    claimed      = Column(UTCDateTime, nullable=True)
+    failed       = Column(Boolean, default=False)
+    last_error   = Column(UnicodeText, default='')
+
+    _repr_attr_names = ['subject']
+    __table_args__ = (
+        UniqueConstraint('model', 'fk_id', 'ident', name='_email_outbox_uniq'),
+    )
+
+    def to_email(self):
+        return Email(fk_id=self.fk_id, model=self.model, ident=self.ident,
+                     subject=self.subject, dest=self.dest, body=self.body)
+
+
+class MultiChoiceValue(MagModel):
+    """
+    On databases other than Postgres, we keep one row here for each option of each indexed MultiChoice column of each
+    row, so that MultiChoice.Comparator.has_choice() can find e.g. the staffers assigned to a department with an
+    index rather than by searching every attendee's comma-separated list of departments.  This is kept up to date
+    by _index_multichoice_values after every flush, and can be rebuilt from scratch with rebuild().
+
+    Changes which don't go through a session flush, e.g. query.update() or raw SQL, aren't copied in here, so after
+    making those to an indexed MultiChoice column, call mark_stale() or run the index_multichoice_columns command.
+    """
+    table_name  = Column(UnicodeText)
+    column_name = Column(UnicodeText)
+    row_id      = Column(UUID, index=True)
+    value       = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_multi_choice_value_lookup', 'table_name', 'column_name', 'value'),
+    )
+
+    # a row with this row_id means that the other rows for its column can't be trusted until we rebuild()
+    stale_row_id = '00000000-0000-0000-0000-000000000000'
+
+    @classmethod
+    def mark_stale(cls, columns):
+        """
+        Takes (table_name, column_name) tuples and records that our rows for those columns are out-of-date, so that
+        has_choice() searches those columns directly until the next rebuild().  We do this with a connection of our
+        own, so this must not be called while a session has uncommitted changes to this table.
+        """
+        with Session.engine.begin() as connection:
+            connection.execute(cls.__table__.insert(), [{'id': str(uuid4()), 'table_name': table_name, 'value': 0,
+                                                         'column_name': column_name, 'row_id': cls.stale_row_id}
+                                                        for table_name, column_name in columns])
+        log.error('marked our index of MultiChoice values stale for {}; run index_multichoice_columns to rebuild it',
+                  ', '.join('.'.join(column) for column in sorted(columns)))
+
+    @classmethod
+    def indexed_columns(cls):
+        return [column for table in cls.metadata.sorted_tables for column in table.columns
+                if isinstance(column.type, MultiChoice) and column.type.indexed]
+
+    @classmethod
+    def values(cls, table_name, column, row_id, value):
+        return [{'table_name': table_name, 'column_name': column.name, 'row_id': row_id, 'value': choice}
+                for choice in column.type.parse(value)[0]]
+
+    @classmethod
+    def rebuild(cls, connection):
+        """
+        Replaces everything in this table with the options currently set in every indexed MultiChoice column.
+        """
+        connection.execute(cls.__table__.delete())
+        for column in cls.indexed_columns():
+            rows = connection.execute(sqlalchemy.select([column.table.c.id, column]).where(column != '')).fetchall()
+            values = [value for id, choices in rows for value in cls.values(column.table.name, column, id, choices)]
+            for i in range(0, len(values), 5000):
+                connection.execute(cls.__table__.insert(), values[i:i + 5000])
+
+
 class PageViewTracking(MagModel):
-    when = Column(UTCDateTime, default=lambda: datetime.now(UTC))
+    when = Column(UTCDateTime, default=lambda: datetime.now(UTC), index=True)
     who = Column(UnicodeText)
     page = Column(UnicodeText)
     what = Column(UnicodeText)
@@ -1940,6 +2386,27 @@ class Tracking(MagModel):
     data     = Column(UnicodeText)
     snapshot = Column(UnicodeText)
 
+    __table_args__ = (
+        Index('ix_tracking_when_id', 'when', 'id'),
+    )
+
+    snapshot_prefix = 'zlib:'
+
+    @classmethod
+    def compress_snapshot(cls, snapshot):
+        """
+        Snapshots are most of our tracking data, so we store them zlib-compressed (and base64-encoded, since this is
+        a text column).  Records written before we did this may still have plain JSON snapshots.
+        """
+        return cls.snapshot_prefix + base64.b64encode(zlib.compress(snapshot.encode('utf-8'))).decode('ascii')
+
+    @property
+    def snapshot_values(self):
+        snapshot = self.snapshot or '{}'
+        if snapshot.startswith(self.snapshot_prefix):
+            snapshot = zlib.decompress(base64.b64decode(snapshot[len(self.snapshot_prefix):])).decode('utf-8')
+        return json.loads(snapshot)
+
     @classmethod
     def format(cls, values):
         return ', '.join('{}={}'.format(k, v) for k, v in values.items())
@@ -1951,94 +2418,410 @@ class Tracking(MagModel):
             if column.name == 'hashed':
                 return '<bcrypted>'
             elif isinstance(column.type, MultiChoice):
-                opts = dict(column.type.choices)
+                opts = column.type.labels
                 return repr('' if not value else (','.join(opts[int(opt)] for opt in value.split(',') if int(opt or 0) in opts)))
             elif isinstance(column.type, Choice) and value not in [None, '']:
-                return repr(dict(column.type.choices).get(int(value), '<nonstandard>'))
+                return repr(column.type.choices.get(int(value), '<nonstandard>'))
             else:
                 return s
         except Exception as e:
             raise ValueError('error formatting {} ({!r})'.format(column.name, value)) from e
 
+    @classmethod
+    def changes(cls, instance):
+        """
+        Returns a dictionary mapping the name of each column of this instance which has been changed to its old
+        and new values.  This is cheap enough to do during a flush; differences() formats these for display.
+
+        SQLAlchemy keeps the committed values of only the attributes which have been modified, so we only look at
+        those rather than checking the history of every column.  Attributes can be set to the same value they
+        already had, which still counts as modified, so we double-check that each value actually changed.
+        """
+        changes = {}
+        columns = instance.__table__.columns
+        for attr in list(instance_state(instance).committed_state):
+            if attr in columns:
+                new_val = getattr(instance, attr)
+                old_val = instance.orig_value_of(attr)
+                if old_val != new_val:
+                    changes[attr] = (old_val, new_val)
+        return changes
+
     @classmethod
     def differences(cls, instance):
+        return cls.format_differences(instance.__table__, cls.changes(instance))
+
+    @classmethod
+    def format_differences(cls, table, changes):
         diff = {}
-        for attr, column in instance.__table__.columns.items():
-            new_val = getattr(instance, attr)
-            old_val = instance.orig_value_of(attr)
-            if old_val != new_val:
-                """
-                important note: here we try and show the old vs new value for something that has been changed
-                so that we can report it in the tracking page.
-
-                Sometimes, however, if we changed the type of the value in the database (via a database migration)
-                the old value might not be able to be shown as the new type (i.e. it used to be a string, now it's int).
-                In that case, we won't be able to show a representation of the old value and instead we'll log it as
-                '<ERROR>'.  In theory the database migration SHOULD be the thing handling this, but if it doesn't, it
-                becomes our problem to deal with.
-
-                We are overly paranoid with exception handling here because the tracking code should be made to
-                never, ever, ever crash, even if it encounters insane/old data that really shouldn't be our problem.
-                """
-                try:
-                    old_val_repr = cls.repr(column, old_val)
-                except Exception as e:
-                    log.error("tracking repr({}) failed on old value".format(attr), exc_info=True)
-                    old_val_repr = "<ERROR>"
+        for attr, (old_val, new_val) in changes.items():
+            column = table.columns[attr]
+            """
+            important note: here we try and show the old vs new value for something that has been changed
+            so that we can report it in the tracking page.
 
-                try:
-                    new_val_repr = cls.repr(column, new_val)
-                except Exception as e:
-                    log.error("tracking repr({}) failed on new value".format(attr), exc_info=True)
-                    new_val_repr = "<ERROR>"
+            Sometimes, however, if we changed the type of the value in the database (via a database migration)
+            the old value might not be able to be shown as the new type (i.e. it used to be a string, now it's int).
+            In that case, we won't be able to show a representation of the old value and instead we'll log it as
+            '<ERROR>'.  In theory the database migration SHOULD be the thing handling this, but if it doesn't, it
+            becomes our problem to deal with.
+
+            We are overly paranoid with exception handling here because the tracking code should be made to
+            never, ever, ever crash, even if it encounters insane/old data that really shouldn't be our problem.
+            """
+            try:
+                old_val_repr = cls.repr(column, old_val)
+            except Exception as e:
+                log.error("tracking repr({}) failed on old value".format(attr), exc_info=True)
+                old_val_repr = "<ERROR>"
 
-                diff[attr] = "'{} -> {}'".format(old_val_repr, new_val_repr)
+            try:
+                new_val_repr = cls.repr(column, new_val)
+            except Exception as e:
+                log.error("tracking repr({}) failed on new value".format(attr), exc_info=True)
+                new_val_repr = "<ERROR>"
+
+            diff[attr] = "'{} -> {}'".format(old_val_repr, new_val_repr)
         return diff
 
     @classmethod
-    def track(cls, action, instance):
+    def parse_links(cls, links):
+        """
+        Returns a list of (table name, id) pairs for the model instances in a Tracking.links string.
+        """
+        return re.findall(r'(\w+)\(([^)]+)\)', links or '')
+
+    @classmethod
+    def link_values(cls, tracking_id, links):
+        return [{'id': str(uuid4()), 'tracking_id': tracking_id, 'table_name': table_name, 'fk_id': fk_id}
+                for table_name, fk_id in cls.parse_links(links)]
+
+    def link_records(self):
+        return [TrackingLink(**values) for values in self.link_values(self.id, self.links)]
+
+    @classmethod
+    def current_who(cls):
+        if sys.argv == ['']:
+            return 'server admin'
+        else:
+            return AdminAccount.admin_name() or (current_thread().name if current_thread().daemon else 'non-admin')
+
+    @classmethod
+    def badge_shift(cls, ids, badge_type, badge_num, until, shift):
+        """
+        Returns a single Tracking record summarizing a call to Session.shift_badges, which updates badge numbers
+        in bulk rather than tracking each attendee's change individually.  We link every shifted attendee so that
+        anything which looks for changes to a particular attendee (like our automated emails) still sees these.
+        """
+        return Tracking(
+            model=Attendee.__name__,
+            fk_id=ids[0],
+            which='{} {} badges'.format(len(ids), c.BADGES[badge_type]),
+            who=cls.current_who(),
+            page=c.PAGE_PATH,
+            links=', '.join('{}({})'.format(Attendee.__tablename__, id) for id in ids),
+            action=c.AUTO_BADGE_SHIFT,
+            data="badge_num='{:+d}' for badges {} - {}".format(shift, badge_num, until))
+
+    @classmethod
+    def capture(cls, action, instance):
+        """
+        Captures the raw information we need to track this action on this instance, which must be done right away
+        since the instance may have changed again by the time we get around to writing the Tracking record.  This is
+        called during every flush, so we only read values here; formatting them is left to values_from_capture(),
+        which the tracking_writer usually calls from a background thread.  Returns None if there is nothing to track.
+        """
+        columns = {attr: getattr(instance, attr) for attr in instance.__table__.columns.keys()}
+        changes = None
+        if action == c.UPDATED:
+            changes = cls.changes(instance)
+            if not changes:
+                return None
+
+        return {
+            'table': instance.__table__,
+            'model': instance.__class__.__name__,
+            'fk_id': instance.id,
+            'when': datetime.now(UTC),
+            'which': repr(instance),
+            'who': cls.current_who(),
+            'page': c.PAGE_PATH,
+            'action': action,
+            'columns': columns,
+            'changes': changes
+        }
+
+    @classmethod
+    def values_from_capture(cls, captured):
+        """
+        Returns the column values of the Tracking record for something returned by capture().
+        """
+        table, columns, action = captured['table'], captured['columns'], captured['action']
         if action in [c.CREATED, c.UNPAID_PREREG, c.EDITED_PREREG]:
-            vals = {attr: cls.repr(column, getattr(instance, attr)) for attr, column in instance.__table__.columns.items()}
-            data = cls.format(vals)
+            data = cls.format({attr: cls.repr(table.columns[attr], value) for attr, value in columns.items()})
         elif action == c.UPDATED:
-            diff = cls.differences(instance)
+            diff = cls.format_differences(table, captured['changes'])
             data = cls.format(diff)
             if len(diff) == 1 and 'badge_num' in diff:
                 action = c.AUTO_BADGE_SHIFT
-            elif not data:
-                return
         else:
-            data = 'id={}'.format(instance.id)
+            data = 'id={}'.format(captured['fk_id'])
+
         links = ', '.join(
-            '{}({})'.format(list(column.foreign_keys)[0].column.table.name, getattr(instance, name))
-            for name, column in instance.__table__.columns.items()
-            if column.foreign_keys and getattr(instance, name)
+            '{}({})'.format(list(column.foreign_keys)[0].column.table.name, columns[name])
+            for name, column in table.columns.items()
+            if column.foreign_keys and columns[name]
         )
 
-        if sys.argv == ['']:
-            who = 'server admin'
+        return {
+            'id': str(uuid4()),
+            'model': captured['model'],
+            'fk_id': captured['fk_id'],
+            'when': captured['when'],
+            'who': captured['who'],
+            'page': captured['page'],
+            'which': captured['which'],
+            'links': links,
+            'action': action,
+            'data': data,
+            'snapshot': cls.compress_snapshot(json.dumps(columns, cls=serializer))
+        }
+
+    @classmethod
+    def track(cls, action, instance):
+        captured = cls.capture(action, instance)
+        if captured:
+            tracking_writer.write([captured], instance.session)
+
+
+class TrackingLink(MagModel):
+    """
+    One row for each model instance listed in a Tracking record's links, so that the history pages can look up the
+    changes related to an attendee or group with an index rather than searching through every Tracking.links string.
+    """
+    tracking_id = Column(UUID, ForeignKey('tracking.id', ondelete='cascade'), index=True)
+    table_name  = Column(UnicodeText)
+    fk_id       = Column(UUID, index=True)
+
+
+class TrackingActor(MagModel):
+    """
+    One row for each distinct Tracking.who, which is what the feed page offers to filter by; this is maintained by
+    the tracking_writer so that we don't need a DISTINCT over the entire tracking table every time that page loads.
+    """
+    who = Column(UnicodeText, unique=True)
+
+    _repr_attr_names = ['who']
+
+Tracking.UNTRACKED = [Tracking, TrackingLink, TrackingActor, Email, EmailOutbox, PageViewTracking, MultiChoiceValue]
+
+
+class TrackingWriter:
+    """
+    Writes Tracking records.  Formatting and inserting these used to happen during every flush, which made bulk
+    changes several times slower, so once the server has started we instead put what we've captured onto a bounded
+    queue, and a daemon thread periodically formats and inserts everything on that queue in batches.  Changes made
+    in a session are only queued once that session commits, so we never track changes which were rolled back.
+
+    In synchronous mode, which is what we use in tests and scripts, or if the queue is ever full, we add the
+    Tracking records to the session being flushed like we used to.
+    """
+    max_queued = 10000
+    batch_size = 500
+
+    def __init__(self):
+        self.synchronous = True
+        self.queue = Queue(maxsize=self.max_queued)
+        self.lock = RLock()
+        self.actors = set()
+
+    def _add(self, captured, session=None):
+        trackings = [Tracking(**Tracking.values_from_capture(record)) for record in captured]
+        trackings.extend(link for tracking in list(trackings) for link in tracking.link_records())
+        if session:
+            session.add_all(trackings)
         else:
-            who = AdminAccount.admin_name() or (current_thread().name if current_thread().daemon else 'non-admin')
-
-        def _insert(session):
-            session.add(Tracking(
-                model=instance.__class__.__name__,
-                fk_id=instance.id,
-                which=repr(instance),
-                who=who,
-                page=c.PAGE_PATH,
-                links=links,
-                action=action,
-                data=data,
-                snapshot=json.dumps(instance.to_dict(), cls=serializer)
-            ))
-        if instance.session:
-            _insert(instance.session)
+            with Session() as session:
+                session.add_all(trackings)
+
+    def write(self, captured, session=None):
+        """
+        Writes Tracking records for the given list of things returned by Tracking.capture(), either by queueing them
+        or by adding them to the given session (or to a new session if none is given) in synchronous mode.
+        """
+        if not captured:
+            return
+        elif self.synchronous:
+            self._add(captured, session)
         else:
+            for i, record in enumerate(captured):
+                try:
+                    self.queue.put_nowait(record)
+                except Full:
+                    log.warn('tracking queue is full, writing {} tracking records synchronously', len(captured) - i)
+                    self._add(captured[i:])
+                    break
+
+    def write_queued(self):
+        """
+        Formats and inserts everything currently on our queue, in batches.  This is run periodically by a daemon
+        thread and on shutdown.
+        """
+        with self.lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                if not batch:
+                    return
+
+                try:
+                    rows = [Tracking.values_from_capture(captured) for captured in batch]
+                    links = [link for row in rows for link in Tracking.link_values(row['id'], row['links'])]
+                    with Session() as session:
+                        session.execute(Tracking.__table__.insert(), rows)
+                        if links:
+                            session.execute(TrackingLink.__table__.insert(), links)
+                except:
+                    log.error('unable to write {} tracking records', len(batch), exc_info=True)
+
+    def record_actors(self, names):
+        """
+        Makes sure there's a TrackingActor for each of the given names.  We remember which ones we've already seen,
+        so this almost never needs to touch the database.  This must not be called mid-transaction, since it uses
+        its own session.
+        """
+        names = {name for name in names if name} - self.actors
+        if not names:
+            return
+
+        try:
             with Session() as session:
-                _insert(session)
+                existing = {who for [who] in session.query(TrackingActor.who).filter(TrackingActor.who.in_(names))}
+                session.add_all([TrackingActor(who=who) for who in names - existing])
+        except sqlalchemy.exc.IntegrityError:
+            log.debug('tracking actors {} were recorded by someone else first', names)
+        else:
+            self.actors.update(names)
+
+tracking_writer = TrackingWriter()
+
+
+class TrackingArchive:
+    """
+    Moves Tracking and PageViewTracking records older than c.TRACKING_RETENTION_DAYS out of the database and into
+    gzipped JSON-lines files in c.TRACKING_ARCHIVE_DIR, and reads them back for the history pages.
+
+    Each batch of records gets its own file, which is completely written before we delete those records, so a crash
+    can at worst leave some records both archived and still in the database; we ignore the duplicates when reading.
+    """
+    batch_size = 10000
+    when_format = '%Y%m%d%H%M%S%f'
+
+    def __init__(self):
+        self.lock = RLock()
+
+    @property
+    def directory(self):
+        return c.TRACKING_ARCHIVE_DIR
+
+    def run(self):
+        """
+        Archives everything older than our retention period, returning how many records of each model we archived.
+        This is run periodically by a daemon thread and by the archive_tracking command.
+        """
+        if not c.TRACKING_RETENTION_DAYS:
+            return {}
+
+        cutoff = datetime.now(UTC) - timedelta(days=c.TRACKING_RETENTION_DAYS)
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            return {model.__name__: self._archive(model, cutoff) for model in [Tracking, PageViewTracking]}
+
+    def _archive(self, model, cutoff):
+        table, total = model.__table__, 0
+        while not stopped.is_set():
+            with Session() as session:
+                rows = session.execute(table.select().where(table.c.when < cutoff)
+                                                     .order_by(table.c.when, table.c.id)
+                                                     .limit(self.batch_size)).fetchall()
+                if not rows:
+                    break
+
+                filename = join(self.directory, '{}-{}-{}.jsonl.gz'.format(
+                    table.name, rows[0].when.astimezone(UTC).strftime(self.when_format), rows[0].id))
+                with gzip.open(filename + '.tmp', 'wt', encoding='utf-8') as f:
+                    for row in rows:
+                        f.write(json.dumps(self._to_json(table, row)) + '\n')
+                os.rename(filename + '.tmp', filename)
+
+                last = rows[-1]
+                archived = and_(table.c.when < cutoff, or_(table.c.when < last.when,
+                                                           and_(table.c.when == last.when, table.c.id <= last.id)))
+                if model is Tracking:
+                    archived_ids = sqlalchemy.select([table.c.id]).where(archived)
+                    session.execute(TrackingLink.__table__.delete().where(TrackingLink.tracking_id.in_(archived_ids)))
+                session.execute(table.delete().where(archived))
+            total += len(rows)
+        return total
+
+    def _to_json(self, table, row):
+        values = {}
+        for column in table.columns:
+            value = row[column]
+            if value is not None and isinstance(column.type, UTCDateTime):
+                value = value.astimezone(UTC).strftime(self.when_format)
+            values[column.name] = value
+        return values
+
+    def _from_json(self, model, values):
+        for name, column in model.__table__.columns.items():
+            if values.get(name) and isinstance(column.type, UTCDateTime):
+                values[name] = datetime.strptime(values[name], self.when_format).replace(tzinfo=UTC)
+        return model(**values)
+
+    def read(self, model):
+        """
+        Yields a dictionary of the column values of every archived record of the given model, oldest first.
+        """
+        seen = set()
+        for filename in sorted(glob(join(self.directory, model.__tablename__ + '-*.jsonl.gz'))):
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    values = json.loads(line)
+                    if values['id'] not in seen:
+                        seen.add(values['id'])
+                        yield values
+
+    def tracked_changes(self, model, id):
+        """
+        Returns the archived Tracking records for the given model instance or anything linked to it, like
+        Session.tracked_changes() does for the records still in the database.  This reads every archive file, so
+        we only do it when someone asks to see archived changes.
+        """
+        link = '{}({})'.format(model.__tablename__, id)
+        return [self._from_json(Tracking, values) for values in self.read(Tracking)
+                if (values['model'] == model.__name__ and values['fk_id'] == id) or link in (values['links'] or '')]
+
+    def pageviews(self, what):
+        return [self._from_json(PageViewTracking, values) for values in self.read(PageViewTracking)
+                if values['what'] == what]
+
+tracking_archive = TrackingArchive()
+
+
+@on_startup
+def _start_tracking_writer():
+    tracking_writer.synchronous = c.SYNCHRONOUS_TRACKING
+
 
-Tracking.UNTRACKED = [Tracking, Email, PageViewTracking]
+@on_shutdown
+def _stop_tracking_writer():
+    tracking_writer.synchronous = True
+    tracking_writer.write_queued()
 
 
 def _make_getter(model):
@@ -2062,14 +2845,15 @@ def _make_getter(model):
     return getter
 
 
-def _acquire_badge_lock(session, context, instances='deprecated'):
-    c.BADGE_LOCK.acquire()
+def _acquire_badge_locks(session, context, instances='deprecated'):
+    from uber.badge_funcs import badge_locks
+    badge_locks.acquire(session)
 
 
 @swallow_exceptions
 def _presave_adjustments(session, context, instances='deprecated'):
     """
-    precondition: c.BADGE_LOCK is acquired already.
+    precondition: the badge locks for this flush are acquired already.
     """
     for model in chain(session.dirty, session.new):
         model.presave_adjustments()
@@ -2077,47 +2861,150 @@ def _presave_adjustments(session, context, instances='deprecated'):
         model.predelete_adjustments()
 
 
-def _release_badge_lock(session, context):
+def _release_badge_locks(session, *args):
+    from uber.badge_funcs import badge_locks
     try:
-        c.BADGE_LOCK.release()
+        badge_locks.release(session)
     except:
-        log.error('failed releasing c.BADGE_LOCK after session flush; this should never actually happen, but we want '
-                  'to just keep going if it ever does')
+        log.error('failed releasing badge locks after session flush; this should never actually happen, but we want '
+                  'to just keep going if it ever does', exc_info=True)
 
 
-def _release_badge_lock_on_error(*args, **kwargs):
-    try:
-        c.BADGE_LOCK.release()
-    except:
-        log.warn('failed releasing c.BADGE_LOCK on db error; these errors should not happen in the first place and we '
-                 'do not expect releasing the lock to fail when they do, but we still want to keep going if/when this '
-                 'does occur')
+def _end_badge_lock_transaction(session, transaction):
+    from uber.badge_funcs import badge_locks
+    if transaction.parent is None:
+        try:
+            badge_locks.end_transaction(session)
+        except:
+            log.error('failed releasing badge locks at the end of a transaction', exc_info=True)
 
 
 @swallow_exceptions
 def _track_changes(session, context, instances='deprecated'):
+    captured = []
     for action, instances in {c.CREATED: session.new, c.UPDATED: session.dirty, c.DELETED: session.deleted}.items():
         for instance in instances:
             if instance.__class__ not in Tracking.UNTRACKED:
-                Tracking.track(action, instance)
+                captured.append(Tracking.capture(action, instance))
+    captured = [record for record in captured if record]
+    session.info.setdefault('tracking_actors', set()).update(record['who'] for record in captured)
+
+    if tracking_writer.synchronous:
+        tracking_writer.write(captured, session)
+    else:
+        session.info.setdefault('tracking', []).extend(captured)
+
+
+@swallow_exceptions
+def _write_tracking(session):
+    tracking_writer.write(session.info.pop('tracking', []))
+    tracking_writer.record_actors(session.info.pop('tracking_actors', ()))
+
+
+def _discard_tracking(session, *args):
+    session.info.pop('tracking', None)
+    session.info.pop('tracking_actors', None)
+
+
+@swallow_exceptions
+def _record_badge_num_changes(session, context):
+    from uber.badge_funcs import badge_num_changes
+    session.info.setdefault('badge_num_changes', []).extend(badge_num_changes(session))
+
+
+@swallow_exceptions
+def _apply_badge_num_changes(session):
+    from uber.badge_funcs import badge_num_index
+    badge_num_index.apply(session.info.pop('badge_num_changes', []))
+    for badge_type in session.info.pop('badge_types_shifted', []):
+        badge_num_index.invalidate(badge_type)
+
+
+def _discard_badge_num_changes(session, *args):
+    session.info.pop('badge_num_changes', None)
+    session.info.pop('badge_types_shifted', None)
+
+
+@swallow_exceptions
+def _index_multichoice_values(session, context):
+    """
+    If we can't update the multi_choice_value rows for a column then we mark them stale once this session commits,
+    since we can't write anything else to the database from here; see MultiChoiceValue.mark_stale().
+    """
+    if Session.engine.dialect.name == 'postgresql':
+        return
+
+    values = MultiChoiceValue.__table__
+    for instance in chain(session.new, session.dirty, session.deleted):
+        for name in instance._get_class_registry()['indexed_multichoices']:
+            if instance in session.new or get_history(instance, name).has_changes() or instance in session.deleted:
+                try:
+                    column = instance.__table__.columns[name]
+                    session.execute(values.delete().where(and_(values.c.table_name == instance.__tablename__,
+                                                               values.c.column_name == name,
+                                                               values.c.row_id == instance.id)))
+                    if instance not in session.deleted:
+                        rows = MultiChoiceValue.values(instance.__tablename__, column, instance.id, getattr(instance, name))
+                        if rows:
+                            session.execute(values.insert(), rows)
+                except Exception:
+                    log.error('unable to index {}.{} for {!r}', instance.__tablename__, name, instance, exc_info=True)
+                    session.info.setdefault('stale_multichoices', set()).add((instance.__tablename__, name))
+
+
+@swallow_exceptions
+def _mark_stale_multichoices(session):
+    stale = session.info.pop('stale_multichoices', None)
+    if stale:
+        MultiChoiceValue.mark_stale(stale)
+
+
+def _discard_stale_multichoices(session, *args):
+    # a rollback undoes the changes we couldn't index along with everything else
+    session.info.pop('stale_multichoices', None)
+
+
+def _create_multichoice_indexes(metadata, connection, **kw):
+    """
+    Indexes our indexed MultiChoice columns whenever we create any tables, which sideboard does on every startup,
+    so that existing databases get these indexes too; see has_choice.  On Postgres we add a GIN index on each column
+    as an integer array.  Elsewhere we fill in the multi_choice_value table if it's empty, e.g. if it's new.
+    """
+    if connection.dialect.name == 'postgresql':
+        for column in MultiChoiceValue.indexed_columns():
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1}_choices ON {0} USING gin '
+                               '((string_to_array({1}, \',\')::int[]))'.format(column.table.name, column.name))
+    elif not connection.execute(sqlalchemy.select([MultiChoiceValue.id]).limit(1)).first():
+        MultiChoiceValue.rebuild(connection)
+listen(MagModel.metadata, 'after_create', _create_multichoice_indexes)
 
 
 def register_session_listeners():
     """
-    NOTE 1: IMPORTANT!!! Because we are locking our c.BADGE_LOCK at the start of this, all of these functions MUST NOT
-    THROW ANY EXCEPTIONS.  If they do throw exceptions, the chain of hooks will not be completed, and the lock won't
-    be released, resulting in a deadlock and heinous, horrible, and hard to debug server lockup.
+    NOTE 1: IMPORTANT!!! Because we lock the badge types affected by each flush at the start of this, all of these
+    functions MUST NOT THROW ANY EXCEPTIONS.  If they do throw exceptions, the chain of hooks will not be completed, and
+    the locks won't be released until the session is rolled back, resulting in a deadlock and heinous, horrible, and
+    hard to debug server lockup.
 
     You MUST use the @swallow_exceptions decorator on ALL functions
-    between _acquire_badge_lock and _release_badge_lock in order to prevent them from throwing exceptions.
+    between _acquire_badge_locks and _release_badge_locks in order to prevent them from throwing exceptions.
 
     NOTE 2: The order in which we register these listeners matters.
     """
-    listen(Session.session_factory, 'before_flush', _acquire_badge_lock)
+    listen(Session.session_factory, 'before_flush', _acquire_badge_locks)
     listen(Session.session_factory, 'before_flush', _presave_adjustments)
     listen(Session.session_factory, 'after_flush', _track_changes)
-    listen(Session.session_factory, 'after_flush', _release_badge_lock)
-    listen(Session.engine, 'dbapi_error', _release_badge_lock_on_error)
+    listen(Session.session_factory, 'after_flush', _index_multichoice_values)
+    listen(Session.session_factory, 'after_flush', _record_badge_num_changes)
+    listen(Session.session_factory, 'after_flush', _release_badge_locks)
+    listen(Session.session_factory, 'after_soft_rollback', _release_badge_locks)
+    listen(Session.session_factory, 'after_commit', _apply_badge_num_changes)
+    listen(Session.session_factory, 'after_commit', _write_tracking)
+    listen(Session.session_factory, 'after_commit', _mark_stale_multichoices)
+    listen(Session.session_factory, 'after_rollback', _discard_badge_num_changes)
+    listen(Session.session_factory, 'after_rollback', _discard_tracking)
+    listen(Session.session_factory, 'after_rollback', _discard_stale_multichoices)
+    listen(Session.session_factory, 'after_transaction_end', _end_badge_lock_transaction)
 register_session_listeners()
 
 
@@ -74,3 +74,140 @@ def reset_uber_db():
     assert c.DEV_BOX, 'reset_uber_db is only available on development boxes'
     Session.initialize_db(drop=True, modify_tables=True)
     insert_admin()
+
+
+@entry_point
+def backfill_tracking_links():
+    """
+    Populates the tracking_link table from the links column of every Tracking record which doesn't already have its
+    links in that table, e.g. those written before the table existed.  This is safe to run more than once, and to run
+    while sideboard servers are running.
+    """
+    Session.initialize_db(modify_tables=True)
+    with Session() as session:
+        has_links = sqlalchemy.exists().where(TrackingLink.tracking_id == Tracking.id)
+        query = session.query(Tracking.id, Tracking.links).filter(Tracking.links != '', not_(has_links)) \
+                                                          .order_by(Tracking.id)
+        last_id, total = None, 0
+        while True:
+            rows = (query if last_id is None else query.filter(Tracking.id > last_id)).limit(1000).all()
+            if not rows:
+                break
+            links = [link for id, links in rows for link in Tracking.link_values(id, links)]
+            if links:
+                session.execute(TrackingLink.__table__.insert(), links)
+            session.commit()
+            last_id, total = rows[-1].id, total + len(links)
+            print('Backfilled {} tracking links so far...'.format(total))
+        print('Done backfilling {} tracking links'.format(total))
+
+
+@entry_point
+def index_tracking_feed():
+    """
+    Adds the indexes used by the registration feed page to an existing tracking table (new databases get the
+    (when, id) index when the table is created) and fills in the tracking_actor table from every Tracking record
+    written before that table existed.  On Postgres this also creates the pg_trgm extension, if we're allowed to, and
+    trigram indexes on the columns the feed searches, so that its keyword search doesn't have to scan every row.
+
+    This is safe to run more than once, and to run while sideboard servers are running.
+    """
+    Session.initialize_db(modify_tables=True)
+    statements = ['CREATE INDEX IF NOT EXISTS ix_tracking_when_id ON tracking ("when", id)']
+    with closing(Session.engine.connect()) as connection:
+        if Session.engine.dialect.name == 'postgresql':
+            # Postgres can build indexes without blocking writes, but not inside a transaction
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm'] + statements + [
+                'CREATE INDEX IF NOT EXISTS ix_tracking_data_trgm ON tracking USING gin (data gin_trgm_ops)',
+                'CREATE INDEX IF NOT EXISTS ix_tracking_which_trgm ON tracking USING gin (which gin_trgm_ops)'
+            ]
+            statements = [s.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY') for s in statements]
+        for statement in statements:
+            print(statement)
+            connection.execute(statement)
+
+    with Session() as session:
+        known = session.query(TrackingActor.who)
+        actors = [who for [who] in session.query(Tracking.who).filter(Tracking.who != None, Tracking.who.notin_(known))
+                                                              .distinct()]
+        session.add_all([TrackingActor(who=who) for who in actors])
+    print('Done; recorded {} tracking actors'.format(len(actors)))
+
+
+@entry_point
+def archive_tracking():
+    """
+    Moves Tracking and PageViewTracking records older than tracking_retention_days into gzipped JSON-lines files in
+    tracking_archive_dir.  Sideboard servers also do this every hour, but this is handy for archiving a large backlog
+    of old records, e.g. the first time retention is turned on.
+    """
+    Session.initialize_db(modify_tables=True)
+    if not c.TRACKING_RETENTION_DAYS:
+        print('tracking_retention_days is 0, so we keep every tracking record in the database')
+    for model, total in sorted(tracking_archive.run().items()):
+        print('Archived {} {} records to {}'.format(total, model, tracking_archive.directory))
+
+
+@entry_point
+def compress_tracking_snapshots():
+    """
+    Compresses the snapshots of every Tracking record which was written before we started compressing them.  This is
+    safe to run more than once, and to run while sideboard servers are running.
+    """
+    Session.initialize_db(modify_tables=True)
+    update = Tracking.__table__.update().where(Tracking.id == sqlalchemy.bindparam('_id')) \
+                                        .values(snapshot=sqlalchemy.bindparam('_snapshot'))
+    with Session() as session:
+        query = session.query(Tracking.id, Tracking.snapshot) \
+                       .filter(Tracking.snapshot != '', not_(Tracking.snapshot.startswith(Tracking.snapshot_prefix))) \
+                       .order_by(Tracking.id)
+        last_id, total = None, 0
+        while True:
+            rows = (query if last_id is None else query.filter(Tracking.id > last_id)).limit(1000).all()
+            if not rows:
+                break
+            session.execute(update, [{'_id': id, '_snapshot': Tracking.compress_snapshot(snapshot)} for id, snapshot in rows])
+            session.commit()
+            last_id, total = rows[-1].id, total + len(rows)
+            print('Compressed {} tracking snapshots so far...'.format(total))
+        print('Done compressing {} tracking snapshots'.format(total))
+
+
+@entry_point
+def index_multichoice_columns():
+    """
+    Rebuilds the multi_choice_value table, which lets us filter on indexed MultiChoice columns like
+    Attendee.assigned_depts on databases other than Postgres.  Sideboard servers create and fill in that table when
+    it's new, and keep it up to date after that, but this is needed if those columns are ever changed by something
+    other than our sessions, e.g. raw SQL.  On Postgres those columns are indexed directly, so there's nothing to do.
+    """
+    Session.initialize_db(modify_tables=True)
+    with Session.engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            print('Postgres indexes MultiChoice columns directly, so there is nothing to rebuild')
+        else:
+            MultiChoiceValue.rebuild(connection)
+            print('Rebuilt the multi_choice_value table')
+
+
+@entry_point
+def failed_emails():
+    """
+    Lists the queued automated emails which SendQueuedEmailsJob gave up on sending, with the last error for each.
+    The email daemon queues these again on its own if they're still due, but pass "retry" as an argument to queue
+    every one of them to be sent again right away.
+    """
+    Session.initialize_db(modify_tables=True)
+    retry = sys.argv[1:] == ['retry']
+    with Session() as session:
+        failed = session.query(EmailOutbox).filter_by(failed=True).order_by(EmailOutbox.queued).all()
+        for queued_email in failed:
+            print('{} {!r} to {} after {} attempts: {}'.format(queued_email.queued.strftime('%Y-%m-%d %H:%M'),
+                  queued_email.ident, queued_email.dest, queued_email.attempts, queued_email.last_error))
+            if retry:
+                queued_email.failed = False
+                queued_email.attempts = 0
+                queued_email.claim = queued_email.claimed = None
+                queued_email.next_attempt = datetime.now(UTC)
+        print('{} failed emails{}'.format(len(failed), ', queued to be sent again' if retry and failed else ''))
@@ -106,6 +106,9 @@ DaemonTask(detect_duplicates, interval=300,         name="mail dupes")
 DaemonTask(check_placeholders, interval=300,        name="mail placeh")
 
 DaemonTask(SendAllAutomatedEmailsJob.send_all_emails, interval=300,   name="send emails")
+DaemonTask(SendQueuedEmailsJob.send_queued_emails, interval=30,        name="send queued")
+DaemonTask(tracking_writer.write_queued, interval=1,                  name="tracking")
+DaemonTask(tracking_archive.run, interval=3600,                        name="track archive")
 
 # TODO: this should be replaced by something a little cleaner, but it can be a useful debugging tool
 # DaemonTask(lambda: log.error(Session.engine.pool.status()), interval=5)
@@ -54,7 +54,7 @@ class Root:
 
     def bulk(self, session, location=None, **params):
         location = None if location == 'All' else int(location or c.JOB_LOCATION_OPTS[0][0])
-        attendees = session.staffers().filter(*[Attendee.assigned_depts.contains(str(location))] if location else []).all()
+        attendees = session.staffers().filter(*[Attendee.assigned_depts.has_choice(location)] if location else []).all()
         for attendee in attendees:
             attendee.trusted_here = attendee.trusted_in(location) if location else attendee.trusted_somewhere
             attendee.hours_here = sum(shift.job.weighted_hours for shift in attendee.shifts if shift.job.location == location) if location else attendee.weighted_hours
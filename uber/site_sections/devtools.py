@@ -47,16 +47,18 @@ class Root:
             'diagnostics_data': gather_diagnostics_status_information(),
         }
 
-    def badge_number_consistency_check(self, session, run_check=None):
-        errors = []
-
+    def badge_number_consistency_check(self, run_check=None):
         if run_check:
-            errors = badge_consistency_check(session)
+            BadgeConsistencyCheckJob.start()
+            raise HTTPRedirect('badge_number_consistency_check')
 
+        errors = list(BadgeConsistencyCheckJob.problems)
         return {
             'errors_found': len(errors) > 0,
             'errors': errors,
-            'ran_check': run_check,
+            'running': BadgeConsistencyCheckJob.running(),
+            'started': BadgeConsistencyCheckJob.started,
+            'ran_check': BadgeConsistencyCheckJob.finished,
         }
 
 
@@ -68,3 +70,8 @@ def database_pool_information():
 @register_diagnostics_status_function
 def global_badge_lock():
     return 'c.BADGE_LOCK = ' + repr(c.BADGE_LOCK)
+
+
+@register_diagnostics_status_function
+def badge_lock_waits():
+    return badge_locks.describe()
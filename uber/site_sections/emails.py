@@ -43,26 +43,40 @@ class Root:
             'last_job_completed': last_job_completed
         }
 
-    def pending_examples(self, session, ident):
-        count = 0
-        examples = []
+    def pending_examples(self, session, ident, message=''):
+        """
+        The email daemon records how many model instances match each email category along with a small random sample
+        of them every time it looks at everything in the database, so we just render that sample here.
+        """
         email = AutomatedEmail.instances[ident]
-        for x in AutomatedEmail.queries[email.model](session):
-            if email.filters_run(x):
-                count += 1
-                url = {
-                    Group: '../groups/form?id={}',
-                    Attendee: '../registration/form?id={}'
-                }.get(x.__class__, '').format(x.id)
-                if len(examples) < 10:
-                    examples.append([url, email.render(x)])
+        stats = SendAllAutomatedEmailsJob.pending_stats.get(ident, {'count': 0, 'sample': []})
+
+        examples = []
+        for x in session.query(email.model).filter(email.model.id.in_(stats['sample'])) if stats['sample'] else []:
+            url = {
+                Group: '../groups/form?id={}',
+                Attendee: '../registration/form?id={}'
+            }.get(x.__class__, '').format(x.id)
+            examples.append([url, email.render(x)])
 
         return {
-            'count': count,
+            'ident': ident,
+            'message': message,
+            'count': stats['count'],
             'examples': examples,
             'subject': email.subject,
+            'computed': SendAllAutomatedEmailsJob.pending_stats_computed,
+            'running': SendAllAutomatedEmailsJob.run_lock.locked()
         }
 
+    @csrf_protected
+    def recompute_pending_stats(self, ident):
+        if SendAllAutomatedEmailsJob.recompute_pending_stats():
+            message = 'Pending emails are being recomputed in the background; refresh this page in a few minutes'
+        else:
+            message = 'The email daemon is already running; refresh this page in a few minutes'
+        raise HTTPRedirect('pending_examples?ident={}&message={}', ident, message)
+
     def test_email(self, session, subject=None, body=None, from_address=None, to_address=None, **params):
         """
         Testing only: send a test email as a system user
@@ -65,7 +65,7 @@ class Root:
             'email': email
         }
 
-    def history(self, session, id):
+    def history(self, session, id, archived=''):
         group = session.group(id)
 
         if group.leader:
@@ -75,14 +75,18 @@ class Root:
         else:
             emails = {}
 
+        changes = session.tracked_changes(Group, id).all()
+        pageviews = session.query(PageViewTracking).filter(PageViewTracking.what == "Group id={}".format(id)).all()
+        if archived:
+            changes = tracking_archive.tracked_changes(Group, id) + changes
+            pageviews = tracking_archive.pageviews("Group id={}".format(id)) + pageviews
+
         return {
             'group': group,
+            'archived': archived,
             'emails': emails,
-            'changes': session.query(Tracking)
-                .filter(or_(Tracking.links.like('%group({})%'.format(id)),
-                            and_(Tracking.model == 'Group', Tracking.fk_id == id)))
-                .order_by(Tracking.when).all(),
-            'pageviews': session.query(PageViewTracking).filter(PageViewTracking.what == "Group id={}".format(id))
+            'changes': changes,
+            'pageviews': pageviews
         }
 
     @ajax
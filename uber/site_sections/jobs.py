@@ -87,7 +87,7 @@ class Root:
 
     def staffers(self, session, location=None, message=''):
         location = None if location == 'All' else int(location or c.JOB_LOCATION_OPTS[0][0])
-        attendees = session.staffers().filter(*[Attendee.assigned_depts.contains(str(location))] if location else []).all()
+        attendees = session.staffers().filter(*[Attendee.assigned_depts.has_choice(location)] if location else []).all()
         for attendee in attendees:
             attendee.trusted_here = attendee.trusted_in(location) if location else attendee.trusted_somewhere
             attendee.hours_here = sum(shift.job.weighted_hours for shift in attendee.shifts if shift.job.location == location) if location else attendee.weighted_hours
@@ -231,7 +231,7 @@ class Root:
                 (a.id, a.full_name)
                 for a in session.query(Attendee)
                                 .filter(Attendee.email != '',
-                                         ~Attendee.assigned_depts.contains(str(location)))
+                                         ~Attendee.assigned_depts.has_choice(location))
                                 .order_by(Attendee.full_name).all()
             ]
         }
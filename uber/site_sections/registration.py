@@ -33,6 +33,46 @@ def check_atd(func):
     return checking_at_the_door
 
 
+class FeedCounts:
+    """
+    Counting every matching Tracking record on each load of the feed page gets slow once the tracking table has
+    millions of rows, so we stop counting at a limit and remember each count for a little while.
+    """
+    limit = 10000
+    expiration = timedelta(minutes=1)
+
+    def __init__(self):
+        self.lock = RLock()
+        self.counts = {}
+
+    def count(self, query, key):
+        """
+        Returns the number of rows in the query (or self.limit if there are at least that many) using the cached
+        count for the given key if we have one which hasn't expired.
+        """
+        now = datetime.now(UTC)
+        with self.lock:
+            counted, count = self.counts.get(key, (None, None))
+            if counted and now - counted < self.expiration:
+                return count
+
+        count = query.limit(self.limit).count()
+        with self.lock:
+            self.counts[key] = (now, count)
+        return count
+
+feed_counts = FeedCounts()
+
+
+def feed_cursor(tracking):
+    return '{}_{}'.format(tracking.when.astimezone(UTC).strftime('%Y%m%d%H%M%S%f'), tracking.id)
+
+
+def parse_feed_cursor(cursor):
+    when, id = cursor.split('_', 1)
+    return datetime.strptime(when, '%Y%m%d%H%M%S%f').replace(tzinfo=UTC), id
+
+
 @all_renderable(c.PEOPLE, c.REG_AT_CON)
 class Root:
     def index(self, session, message='', page='0', search_text='', uploaded_id='', order='last_first', invalid=''):
@@ -179,19 +219,22 @@ class Root:
 
         return png_file_output
 
-    def history(self, session, id):
+    def history(self, session, id, archived=''):
         attendee = session.attendee(id, allow_invalid=True)
+        changes = session.tracked_changes(Attendee, id).all()
+        pageviews = session.query(PageViewTracking).filter(PageViewTracking.what == "Attendee id={}".format(id)).all()
+        if archived:
+            changes = tracking_archive.tracked_changes(Attendee, id) + changes
+            pageviews = tracking_archive.pageviews("Attendee id={}".format(id)) + pageviews
         return {
             'attendee':  attendee,
+            'archived':  archived,
             'emails':    session.query(Email)
                                 .filter(or_(Email.dest == attendee.email,
                                             and_(Email.model == 'Attendee', Email.fk_id == id)))
                                 .order_by(Email.when).all(),
-            'changes':   session.query(Tracking)
-                                .filter(or_(Tracking.links.like('%attendee({})%'.format(id)),
-                                            and_(Tracking.model == 'Attendee', Tracking.fk_id == id)))
-                                .order_by(Tracking.when).all(),
-            'pageviews': session.query(PageViewTracking).filter(PageViewTracking.what == "Attendee id={}".format(id))
+            'changes':   changes,
+            'pageviews': pageviews
         }
 
     @log_pageview
@@ -824,25 +867,49 @@ class Root:
         session.delete(shift)
         raise HTTPRedirect('shifts?id={}&message={}', shift.attendee.id, 'Staffer unassigned from shift')
 
-    def feed(self, session, page='1', who='', what='', action=''):
-        feed = session.query(Tracking).filter(Tracking.action != c.AUTO_BADGE_SHIFT).order_by(Tracking.when.desc())
+    def feed(self, session, before='', after='', who='', what='', action=''):
+        """
+        Pages through the feed newest-first using the (when, id) of the first or last record on the current page
+        rather than an OFFSET, so that every page is a quick index scan no matter how far back we go.
+        """
+        feed = session.query(Tracking).filter(Tracking.action != c.AUTO_BADGE_SHIFT)
         what = what.strip()
         if who:
             feed = feed.filter_by(who=who)
         if what:
-            like = '%' + what + '%'  # SQLAlchemy should have an icontains for this
+            like = '%' + what + '%'  # on Postgres this uses the trigram indexes created by index_tracking_feed
             feed = feed.filter(or_(Tracking.data.ilike(like), Tracking.which.ilike(like)))
         if action:
             feed = feed.filter_by(action=action)
+        count = feed_counts.count(feed, (who, what, action))
+
+        if after:
+            when, id = parse_feed_cursor(after)
+            page = feed.filter(or_(Tracking.when > when, and_(Tracking.when == when, Tracking.id > id))) \
+                       .order_by(Tracking.when, Tracking.id).limit(101).all()
+            has_newer, has_older = len(page) > 100, True
+            page = list(reversed(page[:100]))
+        else:
+            if before:
+                when, id = parse_feed_cursor(before)
+                feed = feed.filter(or_(Tracking.when < when, and_(Tracking.when == when, Tracking.id < id)))
+            page = feed.order_by(Tracking.when.desc(), Tracking.id.desc()).limit(101).all()
+            has_newer, has_older = bool(before), len(page) > 100
+            page = page[:100]
+
+        filters = {'who': who, 'what': what, 'action': action}
         return {
             'who': who,
             'what': what,
-            'page': page,
             'action': action,
-            'count': feed.count(),
-            'feed': get_page(page, feed),
+            'count': count,
+            'count_limited': count >= feed_counts.limit,
+            'feed': page,
+            'newer': page and has_newer and 'feed?' + urlencode(dict(filters, after=feed_cursor(page[0]))),
+            'older': page and has_older and 'feed?' + urlencode(dict(filters, before=feed_cursor(page[-1]))),
+            'newest': (before or after) and 'feed?' + urlencode(filters),
             'action_opts': [opt for opt in c.TRACKING_OPTS if opt[0] != c.AUTO_BADGE_SHIFT],
-            'who_opts': [who for [who] in session.query(Tracking).distinct().order_by(Tracking.who).values(Tracking.who)]
+            'who_opts': [who for [who] in session.query(TrackingActor.who).order_by(TrackingActor.who)]
         }
 
     def staffers(self, session, message='', order='first_name'):
@@ -894,7 +961,7 @@ class Root:
                                                .filter(Attendee.placeholder == True,
                                                        Attendee.staffing == True,
                                                        Attendee.badge_status.in_([c.NEW_STATUS, c.COMPLETED_STATUS]),
-                                                       Attendee.assigned_depts.contains(department))
+                                                       *[Attendee.assigned_depts.has_choice(department)] if department else [])
                                                .order_by(Attendee.full_name).all()]
         }
 
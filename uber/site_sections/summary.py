@@ -91,8 +91,8 @@ class Root:
         attendees = session.staffers().all()
         everything = []
         for department, name in c.JOB_LOCATION_OPTS:
-            assigned = [a for a in attendees if department in a.assigned_depts_ints]
-            unassigned = [a for a in attendees if department in a.requested_depts_ints and a not in assigned]
+            assigned = [a for a in attendees if a.assigned_to(department)]
+            unassigned = [a for a in attendees if a.requested(department) and not a.assigned_to(department)]
             everything.append([name, assigned, unassigned])
         return {'everything': everything}
 
@@ -136,7 +136,7 @@ class Root:
             'volunteers': len(attendees),
             'departments': [{
                 'department': desc,
-                'assigned': len([a for a in attendees if dept in a.assigned_depts_ints]),
+                'assigned': len([a for a in attendees if a.assigned_to(dept)]),
                 'total_hours': sum(j.weighted_hours * j.slots for j in jobs if j.location == dept),
                 'taken_hours': sum(j.weighted_hours * len(j.shifts) for j in jobs if j.location == dept)
             } for dept, desc in c.JOB_LOCATION_OPTS]
@@ -0,0 +1,139 @@
+from uber.common import *
+import timeit
+import tempfile
+import tracemalloc
+from sqlalchemy.orm import sessionmaker
+
+
+def _filler_value(column):
+    """
+    Returns a value we can insert for a column which has no default, since our Core inserts below bypass the
+    constructors and presave adjustments of our models.
+    """
+    if isinstance(column.type, UUID):
+        return str(uuid4())
+    elif isinstance(column.type, Boolean):
+        return False
+    elif isinstance(column.type, UTCDateTime):
+        return datetime.now(UTC)
+    elif isinstance(column.type, Date):
+        return date.today()
+    elif isinstance(column.type, (Integer, Float, Numeric, Choice)):
+        return 0
+    else:
+        return ''
+
+
+def _bulk_insert(engine, model, rows):
+    table = model.__table__
+    filler = {col.name: _filler_value(col) for col in table.columns
+              if not col.nullable and col.default is None and col.server_default is None}
+    for i in range(0, len(rows), 5000):
+        engine.execute(table.insert(), [dict(filler, **row) for row in rows[i:i + 5000]])
+
+
+def _make_synthetic_db(path, num_attendees):
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    MagModel.metadata.create_all(engine)
+
+    group_ids = [str(uuid4()) for i in range(num_attendees // 10)]
+    job_ids = [str(uuid4()) for i in range(num_attendees // 100)]
+    attendees = [{
+        'id': str(uuid4()),
+        'first_name': 'First{}'.format(i),
+        'last_name': 'Last{}'.format(i),
+        'email': 'attendee{}@mailinator.com'.format(i),
+        'badge_type': c.ATTENDEE_BADGE,
+        'badge_status': c.COMPLETED_STATUS,
+        'paid': c.HAS_PAID,
+        'group_id': group_ids[i % len(group_ids)] if i % 3 == 0 else None
+    } for i in range(num_attendees)]
+
+    _bulk_insert(engine, Group, [{'id': id, 'name': 'Group {}'.format(i)} for i, id in enumerate(group_ids)])
+    _bulk_insert(engine, Attendee, attendees)
+    _bulk_insert(engine, Job, [{'id': id, 'name': 'Job {}'.format(i), 'start_time': datetime.now(UTC)}
+                               for i, id in enumerate(job_ids)])
+    _bulk_insert(engine, Shift, [{'attendee_id': a['id'], 'job_id': job_ids[i % len(job_ids)]}
+                                 for i, a in enumerate(attendees) if i % 2 == 0])
+    return engine
+
+
+def _measure(engine, iterate):
+    BenchmarkSession = type('BenchmarkSession', (Session.SessionMixin, sqlalchemy.orm.Session), {})
+    session = sessionmaker(bind=engine, class_=BenchmarkSession, query_cls=Session.QuerySubclass)()
+    tracemalloc.start()
+    started = datetime.now()
+    try:
+        count = iterate(session)
+        elapsed = datetime.now() - started
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        session.close()
+    return count, elapsed.total_seconds(), peak
+
+
+def _iterate_all_at_once(session):
+    count = 0
+    for attendee in session.all_attendees():
+        count += bool(attendee.full_name and attendee.shifts is not None and (attendee.group is None or attendee.group.name))
+    return count
+
+
+def _iterate_in_chunks(session):
+    count = 0
+    for chunk in session.all_attendees().keyset_chunks(SendAllAutomatedEmailsJob.chunk_size):
+        for attendee in chunk:
+            count += bool(attendee.full_name and attendee.shifts is not None and (attendee.group is None or attendee.group.name))
+        session.expunge_all()
+    return count
+
+
+@entry_point
+def benchmark_email_daemon_memory():
+    """
+    Compares the peak memory used by the email daemon's old way of iterating over every attendee (loading them all
+    into one session with their groups, shifts, and jobs) with iterating over them in chunks and expunging each chunk
+    once we're done with it.  This runs against a throwaway SQLite database with 50,000 synthetic attendees; pass a
+    different number of attendees as an argument if you want.
+    """
+    num_attendees = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print('Creating a synthetic database with {} attendees...'.format(num_attendees))
+        engine = _make_synthetic_db(join(tmpdir, 'benchmark.db'), num_attendees)
+        for name, iterate in [('all at once', _iterate_all_at_once), ('in chunks', _iterate_in_chunks)]:
+            count, seconds, peak = _measure(engine, iterate)
+            print('{:<12} {:>7} attendees  {:>7.1f} seconds  {:>8.1f} MB peak'.format(name, count, seconds, peak / 2 ** 20))
+        engine.dispose()
+
+
+def _scan_class_attrs(instance):
+    """
+    Finds an instance's presave adjustments and cost properties by scanning every attribute of its class, which is how
+    MagModel did this on every presave before it compiled a registry of them once per class.
+    """
+    attrs = instance._class_attrs
+    callbacks = sorted((attr.presave_adjustment, name) for name, attr in attrs.items()
+                       if hasattr(attr, '__call__') and hasattr(attr, 'presave_adjustment'))
+    return callbacks, [name for name, attr in attrs.items() if isinstance(attr, cost_property)]
+
+
+def _use_class_registry(instance):
+    registry = instance._get_class_registry()
+    return registry['presave_adjustment'], registry['cost_property_names']
+
+
+@entry_point
+def benchmark_model_registry():
+    """
+    Compares how long it takes to look up an attendee's presave adjustments and cost properties by scanning every
+    attribute of the Attendee class with using the registry which MagModel now compiles once per class; we used to do
+    the former on every presave and on every default_cost.  Pass a number of lookups as an argument if you want;
+    the default is 1,000.
+    """
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    attendee = Attendee()
+    assert [name for order, name in _scan_class_attrs(attendee)[0]] == list(_use_class_registry(attendee)[0])
+    for name, lookup in [('dir() scan', _scan_class_attrs), ('registry', _use_class_registry)]:
+        seconds = timeit.timeit(lambda: lookup(attendee), number=number)
+        print('{:<12} {:>9.2f} microseconds per lookup'.format(name, seconds / number * 10 ** 6))
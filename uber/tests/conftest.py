@@ -206,6 +206,17 @@ def reset_threadlocal_cache():
     threadlocal.clear()
 
 
+@pytest.fixture(autouse=True)
+def reset_badge_num_index():
+    # each test restores the database file from a backup, so our in-memory index of badge numbers won't match it
+    badge_num_index.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_tracking_actors():
+    tracking_writer.actors.clear()
+
+
 @pytest.fixture
 def at_con(monkeypatch): monkeypatch.setattr(c, 'AT_THE_CON', True)
 
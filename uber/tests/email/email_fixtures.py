@@ -156,6 +156,13 @@ def set_previously_sent_emails_to_attendee1(monkeypatch):
     return list_of_emails_previously_sent
 
 
+@pytest.fixture
+def reset_email_daemon_watermark(monkeypatch):
+    # each test should start out as if the daemon had never run, which means doing a full sweep
+    monkeypatch.setattr(SendAllAutomatedEmailsJob, 'watermark', None)
+    monkeypatch.setattr(SendAllAutomatedEmailsJob, 'last_full_sweep', None)
+
+
 @pytest.fixture
 def reset_unapproved_emails_count(monkeypatch):
     for email_category in AutomatedEmail.instances.values():
@@ -169,6 +176,7 @@ def email_subsystem_sane_setup(
         setup_fake_test_attendees,
         set_previously_sent_emails_empty,
         reset_unapproved_emails_count,
+        reset_email_daemon_watermark,
         remove_approved_idents,
         amazon_send_email_mock):
     """
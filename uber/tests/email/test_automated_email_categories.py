@@ -139,3 +139,23 @@ class TestAutomatedEmailCategory:
         # this is slightly silly but, if this ever changes, we should be explicit about what the expected result is
         with pytest.raises(TypeError):
             AutomatedEmail(Attendee, '', '')
+
+
+@pytest.mark.usefixtures("email_subsystem_sane_setup")
+class TestQueryFilter:
+    def test_filter_candidates(self, get_test_email_category):
+        get_test_email_category.query_filter = Attendee.badge_type == c.STAFF_BADGE
+        with Session() as session:
+            candidates = get_test_email_category.filter_candidates(session.query(Attendee)).all()
+            assert candidates and all(a.badge_type == c.STAFF_BADGE for a in candidates)
+
+    def test_filter_candidates_excludes_already_sent(self, get_test_email_category):
+        get_test_email_category.query_filter = Attendee.badge_type == c.STAFF_BADGE
+        with Session() as session:
+            before = get_test_email_category.filter_candidates(session.query(Attendee)).all()
+            session.add(Email(model='Attendee', fk_id=before[0].id, ident=E.IDENT_TO_FIND,
+                              subject='', dest='', body=''))
+            session.flush()
+            after = get_test_email_category.filter_candidates(session.query(Attendee)).all()
+            assert len(after) == len(before) - 1 and before[0] not in after
+            session.rollback()
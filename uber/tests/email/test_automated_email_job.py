@@ -49,3 +49,148 @@ class TestSendAllAutomatedEmailsJob:
         assert SendAllAutomatedEmailsJob.last_result['categories'][get_test_email_category.ident]['unsent_because_unapproved'] == 2
         assert not SendAllAutomatedEmailsJob.last_result['running']
         assert SendAllAutomatedEmailsJob.last_result['completed']
+
+    def test_second_run_is_incremental(self, amazon_send_email_mock, set_test_approved_idents, render_fake_email):
+        SendAllAutomatedEmailsJob().run()
+        assert SendAllAutomatedEmailsJob.last_result['full_sweep']
+        assert amazon_send_email_mock.call_count == 2
+
+        # none of our fake attendees show up in the Tracking table, so they shouldn't be looked at again
+        SendAllAutomatedEmailsJob().run()
+        assert not SendAllAutomatedEmailsJob.last_result['full_sweep']
+        assert amazon_send_email_mock.call_count == 2
+
+    def test_full_sweep_when_due(self, monkeypatch, amazon_send_email_mock, set_test_approved_idents, render_fake_email):
+        monkeypatch.setattr(c, 'AUTOMATED_EMAIL_FULL_SWEEP_MINUTES', 0)
+        SendAllAutomatedEmailsJob().run()
+        SendAllAutomatedEmailsJob().run()
+        assert SendAllAutomatedEmailsJob.last_result['full_sweep']
+        assert amazon_send_email_mock.call_count == 4
+
+    def test_inactive_categories_skipped(self, amazon_send_email_mock, set_datebase_now_to_sept_15th, set_test_approved_idents, render_fake_email):
+        AutomatedEmail(Attendee, 'Too late for this one', 'unrest_in_the_house_of_light.html',
+                       lambda a: True, when=before(sept_15th - timedelta(days=1)), needs_approval=False)
+
+        SendAllAutomatedEmailsJob().run()
+
+        assert amazon_send_email_mock.call_count == 2
+        assert SendAllAutomatedEmailsJob.last_result['skipped_evaluations'] == 3
+
+    def test_run_records_sent_emails(self, amazon_send_email_mock, set_test_approved_idents, render_fake_email):
+        SendAllAutomatedEmailsJob().run()
+
+        with Session() as session:
+            assert session.query(EmailOutbox).count() == 0
+            sent = session.query(Email).filter_by(ident=E.IDENT_TO_FIND).all()
+            assert {email.fk_id for email in sent} == {'b699bfd3-1ada-4f47-b07f-cb7939783afa', 'e91e6c7e-699e-4784-b43f-303acc419dd5'}
+            for email in sent:
+                session.delete(email)
+
+
+@pytest.mark.usefixtures("email_subsystem_sane_setup")
+class TestSendQueuedEmailsJob:
+    def queue(self, **params):
+        params = dict(dict(fk_id=str(uuid4()), model='Attendee', ident='test_queued', sender='a@example.com',
+                           dest='b@example.com', subject='Hello', body='Hi'), **params)
+        with Session() as session:
+            session.add(EmailOutbox(**params))
+        return params['fk_id']
+
+    def outbox(self):
+        with Session() as session:
+            return [(qe.fk_id, qe.attempts, qe.failed, qe.claim) for qe in session.query(EmailOutbox)]
+
+    def cleanup(self):
+        with Session() as session:
+            session.query(EmailOutbox).delete()
+            session.query(Email).filter_by(ident='test_queued').delete()
+
+    def test_sends_and_records(self, amazon_send_email_mock):
+        self.queue()
+        self.queue()
+        SendQueuedEmailsJob().run()
+        assert amazon_send_email_mock.call_count == 2
+        assert self.outbox() == []
+        with Session() as session:
+            assert session.query(Email).filter_by(ident='test_queued').count() == 2
+        self.cleanup()
+
+    def test_retries_with_backoff(self, amazon_send_email_mock):
+        amazon_send_email_mock.side_effect = ConnectionError('oops')
+        fk_id = self.queue()
+        SendQueuedEmailsJob().run()
+        SendQueuedEmailsJob().run()  # not retried yet because of the backoff
+        assert amazon_send_email_mock.call_count == 1
+        assert self.outbox() == [(fk_id, 1, False, None)]
+        self.cleanup()
+
+    def test_throttling_is_retried(self, amazon_send_email_mock):
+        from uber.amazon_ses import AmazonError
+        amazon_send_email_mock.side_effect = AmazonError('Sender', 'Throttling', 'Maximum sending rate exceeded.')
+        fk_id = self.queue()
+        SendQueuedEmailsJob().run()
+        assert self.outbox() == [(fk_id, 1, False, None)]
+        self.cleanup()
+
+    def test_rejections_are_not_retried(self, amazon_send_email_mock):
+        from uber.amazon_ses import AmazonError
+        amazon_send_email_mock.side_effect = AmazonError('Sender', 'MessageRejected', 'Email address is not verified.')
+        fk_id = self.queue()
+        SendQueuedEmailsJob().run()
+        assert self.outbox() == [(fk_id, 1, True, None)]
+        self.cleanup()
+
+    def test_unsent_batch_is_released(self, amazon_send_email_mock, monkeypatch):
+        monkeypatch.setattr(uber.automated_emails, 'get_email_transport', Mock(side_effect=Exception('no transport')))
+        fk_id = self.queue()
+        SendQueuedEmailsJob().run()
+        assert amazon_send_email_mock.call_count == 0
+        assert self.outbox() == [(fk_id, 0, False, None)]
+        self.cleanup()
+
+    def test_failed_emails_are_queued_again(self):
+        fk_id = self.queue(failed=True)
+        job = SendAllAutomatedEmailsJob()
+        job.outbox = [EmailOutbox(fk_id=fk_id, model='Attendee', ident='test_queued', sender='a@example.com',
+                                  dest='fixed@example.com', subject='Hello', body='Hi')]
+        job._flush_outbox()
+        with Session() as session:
+            [queued_email] = session.query(EmailOutbox).all()
+            assert not queued_email.failed and queued_email.dest == 'fixed@example.com'
+        self.cleanup()
+
+    def test_stale_claims_are_not_resent(self, amazon_send_email_mock):
+        fk_id = self.queue(claim='crashed', claimed=datetime.now(UTC) - timedelta(days=1))
+        SendQueuedEmailsJob().run()
+        assert amazon_send_email_mock.call_count == 0
+        assert self.outbox() == [(fk_id, 0, True, 'crashed')]
+        self.cleanup()
+
+
+@pytest.mark.usefixtures("email_subsystem_sane_setup")
+class TestPendingStats:
+    def test_pending_stats_recorded(self, amazon_send_email_mock, get_test_email_category):
+        SendAllAutomatedEmailsJob().run()
+
+        stats = SendAllAutomatedEmailsJob.pending_stats[get_test_email_category.ident]
+        assert stats['count'] == 2
+        assert set(stats['sample']) == {'b699bfd3-1ada-4f47-b07f-cb7939783afa', 'e91e6c7e-699e-4784-b43f-303acc419dd5'}
+        assert SendAllAutomatedEmailsJob.pending_stats_computed
+
+    def test_reservoir_sample_size(self, monkeypatch, get_test_email_category):
+        monkeypatch.setattr(SendAllAutomatedEmailsJob, 'pending_sample_size', 1)
+        job = SendAllAutomatedEmailsJob()
+        job.pending_stats = defaultdict(lambda: {'count': 0, 'sample': []})
+        for attendee in AutomatedEmail.queries[Attendee](None):
+            job._add_pending_match(get_test_email_category, attendee)
+
+        stats = job.pending_stats[get_test_email_category.ident]
+        assert stats['count'] == 3 and len(stats['sample']) == 1
+
+    def test_dry_run_sends_nothing(self, monkeypatch, amazon_send_email_mock, set_test_approved_idents, get_test_email_category):
+        monkeypatch.setattr(c, 'SEND_EMAILS', False)
+        SendAllAutomatedEmailsJob().run(dry_run=True)
+
+        assert amazon_send_email_mock.call_count == 0
+        assert SendAllAutomatedEmailsJob.pending_stats[get_test_email_category.ident]['count'] == 2
+        assert SendAllAutomatedEmailsJob.watermark is None
@@ -0,0 +1,181 @@
+from uber.tests import *
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+SEND_EMAIL_RESPONSE = '''<SendEmailResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <SendEmailResult><MessageId>00000131d51d2292-159ad6eb</MessageId></SendEmailResult>
+  <ResponseMetadata><RequestId>d5964849-c866-11e0-9beb-01a62d68c57f</RequestId></ResponseMetadata>
+</SendEmailResponse>'''
+
+GET_SEND_QUOTA_RESPONSE = '''<GetSendQuotaResponse xmlns="http://ses.amazonaws.com/doc/2010-12-01/">
+  <GetSendQuotaResult>
+    <SentLast24Hours>127.0</SentLast24Hours>
+    <Max24HourSend>200.0</Max24HourSend>
+    <MaxSendRate>50.0</MaxSendRate>
+  </GetSendQuotaResult>
+  <ResponseMetadata><RequestId>273021c6-c866-11e0-b926-699e21c3af9e</RequestId></ResponseMetadata>
+</GetSendQuotaResponse>'''
+
+
+class FakeSESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        params = dict(parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+        self.server.actions.append(params['Action'])
+        body = (GET_SEND_QUOTA_RESPONSE if params['Action'] == 'GetSendQuota' else SEND_EMAIL_RESPONSE).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = self.server.close_connections
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSESServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeSESHandler)
+        self.connections = 0
+        self.actions = []
+        self.close_connections = False
+
+
+@pytest.fixture
+def fake_ses():
+    server = FakeSESServer()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_transport(fake_ses, workers=1):
+    return SESTransport('fake-key', 'fake-secret', host='127.0.0.1', port=fake_ses.server_address[1],
+                        secure=False, workers=workers, default_rate=1000)
+
+
+def test_connections_reused(fake_ses):
+    transport = make_transport(fake_ses)
+    for i in range(5):
+        result = transport.send(source='a@example.com', to=['b@example.com'], subject='Hi', body='Hello')
+        assert result.messageId == '00000131d51d2292-159ad6eb'
+    transport.close()
+
+    assert fake_ses.actions == ['GetSendQuota'] + ['SendEmail'] * 5
+    assert fake_ses.connections == 1
+
+
+def test_closed_connections_not_reused(fake_ses):
+    fake_ses.close_connections = True
+    transport = make_transport(fake_ses)
+    for i in range(3):
+        transport.send(source='a@example.com', to=['b@example.com'], subject='Hi', body='Hello')
+        sleep(0.1)
+    transport.close()
+
+    assert fake_ses.actions == ['GetSendQuota'] + ['SendEmail'] * 3
+    assert fake_ses.connections == 4
+
+
+def test_rate_taken_from_send_quota(fake_ses):
+    transport = make_transport(fake_ses)
+    transport.send(source='a@example.com', to=['b@example.com'], subject='Hi', body='Hello')
+    transport.close()
+    assert transport.bucket.rate == 50.0
+
+
+def test_send_batch(fake_ses):
+    transport = make_transport(fake_ses, workers=3)
+    emails = [dict(source='a@example.com', to=['b{}@example.com'.format(i)], subject='Hi', body='Hello') for i in range(9)]
+    results = transport.send_batch(emails)
+    transport.close()
+
+    assert len(results) == 9 and all(result.messageId for result in results)
+    assert fake_ses.actions.count('SendEmail') == 9
+    assert fake_ses.connections <= 3 + 1
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(20)
+    start = monotonic()
+    for i in range(30):
+        bucket.acquire()
+    # 20 tokens are available immediately and the other 10 take half a second at 20 per second
+    assert monotonic() - start >= 0.45
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 localhost ESMTP\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                data = []
+                for line in iter(self.rfile.readline, b'.\r\n'):
+                    data.append(line)
+                self.server.messages.append(b''.join(data).decode())
+                self.wfile.write(b'250 ok\r\n')
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                break
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+        self.connections = 0
+        self.messages = []
+
+
+@pytest.fixture
+def fake_smtp():
+    server = FakeSMTPServer()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_smtp_connection_reused(fake_smtp):
+    transport = SMTPTransport('127.0.0.1', fake_smtp.server_address[1])
+    emails = [dict(source='a@example.com', to=['b{}@example.com'.format(i)], subject='Hi', body='Hello') for i in range(4)]
+    results = transport.send_batch(emails)
+    transport.close()
+
+    assert not any(isinstance(result, Exception) for result in results)
+    assert len(fake_smtp.messages) == 4 and 'Subject: Hi' in fake_smtp.messages[0]
+    assert fake_smtp.connections == 1
+
+
+def test_file_transport(tmpdir):
+    transport = FileTransport(str(tmpdir))
+    filename = transport.send(source='a@example.com', to=['b@example.com'], subject='Hi', body='<p>Hello</p>', format='html', bcc=['c@example.com'])
+    with open(filename) as f:
+        contents = f.read()
+    assert 'Subject: Hi' in contents and 'Bcc: c@example.com' in contents and 'text/html' in contents
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_transport_chosen_from_config(monkeypatch, tmpdir):
+    monkeypatch.setattr(c, 'EMAIL_TRANSPORT', 'file')
+    monkeypatch.setattr(c, 'EMAIL_FILE_DIR', str(tmpdir))
+    assert isinstance(get_email_transport(), FileTransport)
+    assert get_email_transport() is get_email_transport()
@@ -0,0 +1,55 @@
+from uber.tests import *
+
+IDS = [str(uuid4()) for i in range(5)]
+
+
+@pytest.fixture
+def sent_emails():
+    with Session() as session:
+        for fk_id in IDS[:3]:
+            session.add(Email(model='Attendee', fk_id=fk_id, ident='index_test', subject='', dest='', body=''))
+    yield
+    with Session() as session:
+        session.query(Email).filter_by(ident='index_test').delete()
+
+
+def test_rebuild(sent_emails):
+    index = SentEmailIndex()
+    with Session() as session:
+        index.refresh(session)
+    assert all(('Attendee', fk_id, 'index_test') in index for fk_id in IDS[:3])
+    assert ('Attendee', IDS[3], 'index_test') not in index
+    assert ('Group', IDS[0], 'index_test') not in index
+    assert ('Attendee', IDS[0], 'other_ident') not in index
+
+
+def test_incremental_refresh(sent_emails):
+    index = SentEmailIndex()
+    with Session() as session:
+        index.refresh(session)
+        session.add(Email(model='Attendee', fk_id=IDS[3], ident='index_test', subject='', dest='', body=''))
+        session.commit()
+        index.refresh(session)
+    assert ('Attendee', IDS[3], 'index_test') in index
+
+
+def test_add_and_merge(monkeypatch):
+    index = SentEmailIndex()
+    monkeypatch.setattr(index, 'max_pending', 2)
+    for fk_id in IDS:
+        index.add('Attendee', fk_id, 'index_test')
+    assert len(index) == 5
+    assert len(index.sent['Attendee', 'index_test']) >= 4 * 16
+    assert all(('Attendee', fk_id, 'index_test') in index for fk_id in IDS)
+    assert ('Attendee', str(uuid4()), 'index_test') not in index
+    assert ('Attendee', None, 'index_test') not in index
+
+
+def test_failed_outbox_rows_not_counted():
+    with Session() as session:
+        session.add(EmailOutbox(model='Attendee', fk_id=IDS[4], ident='index_test', failed=True, sender='', subject='', dest='', body=''))
+    index = SentEmailIndex()
+    with Session() as session:
+        index.refresh(session)
+        session.query(EmailOutbox).filter_by(ident='index_test').delete()
+    assert ('Attendee', IDS[4], 'index_test') not in index
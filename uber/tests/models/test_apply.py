@@ -155,3 +155,11 @@ def test_ignored_csrf(attendee, post, check_csrf):
 def test_ignored_csrf_nonposted(attendee, check_csrf):
     attendee.apply({'csrf_token': 'foo'}, ignore_csrf=False)
     assert not check_csrf.called
+
+
+def test_binding_plan_cached_per_mode():
+    restricted, unrestricted = Attendee._get_binding_plan(True), Attendee._get_binding_plan(False)
+    assert restricted is Attendee._get_binding_plan(True) and unrestricted is Attendee._get_binding_plan(False)
+    assert 'paid' in unrestricted.coercers and 'paid' not in restricted.coercers
+    assert 'id' not in unrestricted.coercers and 'first_name' in restricted.coercers
+    assert Job._get_binding_plan(False) is not unrestricted
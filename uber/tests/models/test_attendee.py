@@ -39,6 +39,20 @@ class TestCosts:
         assert 10 == Attendee(overridden_price=10).total_cost
         assert 15 == Attendee(overridden_price=10, amount_extra=5).total_cost
 
+    def test_cost_property_from_mixin(self, request):
+        default_cost = Attendee().default_cost
+
+        class Attendee_:
+            @cost_property
+            def mixin_fee(self):
+                return 7
+        Attendee_.__name__ = 'Attendee'
+        Session.model_mixin(Attendee_)
+        request.addfinalizer(lambda: delattr(Attendee, 'mixin_fee') or Attendee._compile_class_registry())
+
+        assert 'mixin_fee' in Attendee().cost_property_names
+        assert default_cost + 7 == Attendee().default_cost
+
 
 def test_is_unpaid():
     assert Attendee().is_unpaid
@@ -156,6 +156,10 @@ class TestGetNextBadgeNum:
         session.add(Attendee(badge_type=c.STAFF_BADGE, badge_num=under_min))
         assert 6 == session.get_next_badge_num(c.STAFF_BADGE)
 
+    def test_auto_badge_num_overridden(self, session, monkeypatch):
+        monkeypatch.setattr(Session.SessionMixin, 'auto_badge_num', lambda self, badge_type: 42)
+        assert 42 == session.get_next_badge_num(c.STAFF_BADGE)
+
     def test_badge_range_full(self, session, monkeypatch):
         monkeypatch.setitem(c.BADGE_RANGES, c.STAFF_BADGE, [1, 5])
         with pytest.raises(AssertionError) as message:
@@ -253,6 +257,15 @@ class TestShiftBadges:
         session.shift_badges(c.STAFF_BADGE, 5, up=True)
         assert [1, 2, 3, 4, 6] == self.staff_badges(session)
 
+    def test_shift_tracked_once(self, session):
+        session.shift_badges(c.STAFF_BADGE, 3, up=True)
+        session.commit()
+        [tracked] = session.query(Tracking).filter_by(action=c.AUTO_BADGE_SHIFT).all()
+        assert {a.id for a in [session.staff_three, session.staff_four, session.staff_five]} \
+            == set(re.findall(r'attendee\(([^)]+)\)', tracked.links))
+        assert [4, 5, 6] == [num for [num] in session.query(Attendee.badge_num).filter(Attendee.id.in_(
+            [session.staff_three.id, session.staff_four.id, session.staff_five.id])).order_by(Attendee.badge_num)]
+
 
 class TestBadgeTypeChange:
     def test_end_to_next(self, session):
@@ -449,3 +462,131 @@ class TestDupeFixes:
     def test_dont_fill_dupe_gap(self, session):
         session.update_badge(session.staff_five, c.STAFF_BADGE, 1)
         assert 2 == session.staff_two.badge_num
+
+
+class TestDuplicateAttendees:
+    def make_attendee(self, session, **params):
+        attendee = Attendee(**dict({'placeholder': True, 'badge_status': c.COMPLETED_STATUS}, **params))
+        session.add(attendee)
+        session.commit()
+        return attendee
+
+    def test_duplicates_ignore_case(self, session):
+        first = self.make_attendee(session, first_name='Dupe', last_name='Person', email='dupe@mailinator.com')
+        second = self.make_attendee(session, first_name='DUPE', last_name='person', email='Dupe@Mailinator.com')
+        self.make_attendee(session, first_name='Dupe', last_name='Person', email='other@mailinator.com')
+        self.make_attendee(session, first_name='Dupe', last_name='Person', email='dupe@mailinator.com',
+                           badge_status=c.INVALID_STATUS)
+        assert [a.id for a in session.duplicate_attendees() if a.last_name.lower() == 'person'] == [first.id, second.id]
+
+    def test_no_email(self, session):
+        assert session.no_email('Duplicates Report')
+        session.add(Email(subject='Duplicates Report', dest='regdesk@mailinator.com', body='', model='n/a'))
+        session.commit()
+        assert not session.no_email('Duplicates Report')
+
+
+class TestBadgeNumberIndex:
+    def test_range_lowest_free(self):
+        badge_range = BadgeNumberRange(10, 20, [10, 11, 13, 13])
+        assert 12 == badge_range.lowest_free()
+        badge_range.add(12)
+        assert 14 == badge_range.lowest_free()
+        badge_range.remove(13)
+        assert 14 == badge_range.lowest_free()
+        badge_range.remove(13)
+        assert 13 == badge_range.lowest_free()
+
+    def test_range_full(self):
+        assert 21 == BadgeNumberRange(10, 20, range(10, 21)).lowest_free()
+
+    def test_updated_on_commit(self, session):
+        assert 6 == badge_num_index.lowest_free(c.STAFF_BADGE)
+        session.supporter_five.badge_type, session.supporter_five.badge_num = c.STAFF_BADGE, 6
+        session.commit()
+        assert 7 == badge_num_index.lowest_free(c.STAFF_BADGE) == session.auto_badge_num(c.STAFF_BADGE)
+
+        old_badge_num, session.staff_two.badge_num = session.staff_two.badge_num, 12
+        session.commit()
+        assert old_badge_num == badge_num_index.lowest_free(c.STAFF_BADGE) == session.auto_badge_num(c.STAFF_BADGE)
+
+    def test_not_updated_on_rollback(self, session):
+        assert 6 == badge_num_index.lowest_free(c.STAFF_BADGE)
+        session.supporter_five.badge_type, session.supporter_five.badge_num = c.STAFF_BADGE, 6
+        session.flush()
+        session.rollback()
+        assert 6 == badge_num_index.lowest_free(c.STAFF_BADGE)
+
+    def test_stale_index_falls_back(self, session):
+        badge_num_index.lowest_free(c.STAFF_BADGE)
+        badge_num_index.apply([(c.STAFF_BADGE, 3, -1)])
+        assert 3 == badge_num_index.lowest_free(c.STAFF_BADGE)
+        assert 6 == badge_num_index.next_badge_num(session, c.STAFF_BADGE)
+        assert 6 == badge_num_index.lowest_free(c.STAFF_BADGE)
+
+    def test_freed_elsewhere_falls_back(self, session):
+        assert 6 == badge_num_index.lowest_free(c.STAFF_BADGE)
+        # a bulk UPDATE skips our listeners, like a change made by another process
+        session.query(Attendee).filter_by(id=session.staff_three.id).update({'badge_num': None}, synchronize_session=False)
+        assert 3 == badge_num_index.next_badge_num(session, c.STAFF_BADGE)
+        assert c.STAFF_BADGE not in badge_num_index.ranges
+
+
+class TestBadgeLocks:
+    def acquired(self, badge_type):
+        return badge_locks.stats.get(badge_type, {}).get('acquired', 0)
+
+    def test_unrelated_flush_not_locked(self, session):
+        before = {badge_type: self.acquired(badge_type) for badge_type in c.BADGE_RANGES}
+        session.staff_one.comments = 'Not a badge change'
+        session.add(Job(name='Unrelated Job', start_time=c.EPOCH, slots=1, weight=1, duration=1, location=c.ARCADE))
+        session.commit()
+        assert before == {badge_type: self.acquired(badge_type) for badge_type in c.BADGE_RANGES}
+
+    def test_badge_types_locked(self, session):
+        session.supporter_five.badge_type = c.STAFF_BADGE
+        assert {c.STAFF_BADGE, c.SUPPORTER_BADGE} == badge_locks.badge_types_for(session)
+
+        before = self.acquired(c.STAFF_BADGE)
+        session.commit()
+        assert before + 1 == self.acquired(c.STAFF_BADGE)
+        assert not badge_locks._held[c.STAFF_BADGE] and not session.info.get('badge_locks')
+
+    def test_pg_lock_shared_by_sessions_in_thread(self, monkeypatch):
+        monkeypatch.setattr(BadgeLocks, 'uses_postgres', True)
+        first, second = Mock(info={}), Mock(info={})
+        for session in [first, second]:
+            session.execute.return_value.scalar.return_value = True
+            with badge_locks.locked(session, c.STAFF_BADGE):
+                pass
+        assert first.execute.call_count == 1 and second.execute.call_count == 0
+
+        # once the first session's transaction ends, the second takes the advisory lock for itself
+        badge_locks.end_transaction(first)
+        assert second.execute.call_count == 1
+        badge_locks.end_transaction(second)
+        assert badge_locks._pg_holders[c.STAFF_BADGE] == []
+        assert not badge_locks._held[c.STAFF_BADGE]
+
+    def test_shift_locked(self, session, before_printed_badge_deadline):
+        before = self.acquired(c.STAFF_BADGE)
+        session.shift_badges(c.STAFF_BADGE, 3, up=True)
+        assert before + 1 <= self.acquired(c.STAFF_BADGE)
+        assert not badge_locks._held[c.STAFF_BADGE]
+
+
+class TestBadgeConsistencyCheck:
+    def test_consistent(self, session):
+        assert [] == [error for error in badge_consistency_check(session) if 'Staff' in error]
+
+    def test_gap(self, session):
+        session.staff_five.badge_num = 10
+        session.commit()
+        name = session.staff_five.full_name
+        assert ['gap in badge sequence between Staff badge# 4({}) and badge# 10({})'.format(session.staff_four.full_name, name)] \
+            == [error for error in badge_consistency_check(session) if 'Staff' in error]
+
+    def test_out_of_range(self, session, monkeypatch):
+        monkeypatch.setitem(c.BADGE_RANGES, c.STAFF_BADGE, [1, 4])
+        assert '{}: badge #5: Staff badge numbers must fall within the range 1 - 4'.format(session.staff_five.full_name) \
+            in badge_consistency_check(session)
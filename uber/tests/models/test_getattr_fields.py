@@ -26,3 +26,36 @@ def test_multi_checks():
     assert not AdminAccount().PEOPLE
     assert AdminAccount(access='{},{}'.format(c.PEOPLE, c.STUFF)).PEOPLE
     assert not AdminAccount(access='{},{}'.format(c.PEOPLE, c.STUFF)).ACCOUNTS
+
+
+def test_is_model():
+    assert Attendee().is_attendee
+    assert not Attendee().is_group
+    pytest.raises(AttributeError, lambda: Attendee()._is_attendee)
+
+
+def test_dispatch_cached():
+    attendee = Attendee(interests=str(c.ARCADE))
+    for i in range(2):
+        assert attendee.ARCADE and attendee.interests_labels == [c.INTERESTS[c.ARCADE]]
+        pytest.raises(AttributeError, lambda: attendee.not_a_real_attribute)
+    assert 'interests_labels' in Attendee._getattr_dispatch
+    assert () == Attendee._getattr_dispatch['not_a_real_attribute']
+
+
+def test_multichoice_cache_follows_value():
+    attendee = Attendee(interests=str(c.ARCADE))
+    assert [c.ARCADE] == attendee.interests_ints
+    attendee.interests = '{},{}'.format(c.ARCADE, c.CONSOLE)
+    assert [c.ARCADE, c.CONSOLE] == attendee.interests_ints
+    attendee.interests_ints.append(-1)
+    assert [c.ARCADE, c.CONSOLE] == attendee.interests_ints
+
+
+def test_multichoice_mask():
+    interests = Attendee.get_field('interests').type
+    attendee = Attendee(interests='{},{}'.format(c.ARCADE, c.CONSOLE))
+    assert interests.mask([c.ARCADE, c.CONSOLE, -1]) == attendee.interests_mask
+    assert attendee.multichoice_contains('interests', c.CONSOLE)
+    assert not Attendee().multichoice_contains('interests', c.CONSOLE)
+    assert 0 == Attendee().interests_mask
@@ -47,3 +47,11 @@ def test_ignore_csrf(request):
         request.addfinalizer(lambda: setattr(cherrypy.request, 'method', 'GET'))
         cherrypy.request.method = 'POST'
         session.attendee({'paid': c.NEED_NOT_PAY})
+
+
+def test_keyset_chunks():
+    with Session() as session:
+        expected = sorted(a.id for a in session.all_attendees())
+        chunks = list(session.all_attendees().keyset_chunks(3))
+        assert all(len(chunk) == 3 for chunk in chunks[:-1]) and 0 < len(chunks[-1]) <= 3
+        assert [a.id for chunk in chunks for a in chunk] == expected
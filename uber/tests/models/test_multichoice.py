@@ -0,0 +1,75 @@
+from uber.tests import *
+
+
+def staffers_in(session, department):
+    return {a.last_name for a in session.query(Attendee).filter(Attendee.first_name == 'Multi',
+                                                                Attendee.assigned_depts.has_choice(department))}
+
+
+def test_has_choice():
+    with Session() as session:
+        session.add_all([
+            Attendee(placeholder=True, first_name='Multi', last_name='Arcade', assigned_depts=str(c.ARCADE)),
+            Attendee(placeholder=True, first_name='Multi', last_name='Both', assigned_depts='{},{}'.format(c.ARCADE, c.CONSOLE))
+        ])
+
+    with Session() as session:
+        assert {'Arcade', 'Both'} == staffers_in(session, c.ARCADE)
+        assert {'Both'} == staffers_in(session, c.CONSOLE)
+        assert {'Both'} == staffers_in(session, str(c.CONSOLE))
+
+
+def test_has_choice_follows_changes():
+    with Session() as session:
+        attendee = Attendee(placeholder=True, first_name='Multi', last_name='Changed', assigned_depts=str(c.ARCADE))
+        session.add(attendee)
+        attendee_id = attendee.id
+
+    with Session() as session:
+        session.attendee(attendee_id).assigned_depts = str(c.CONSOLE)
+    with Session() as session:
+        assert not staffers_in(session, c.ARCADE)
+        assert {'Changed'} == staffers_in(session, c.CONSOLE)
+        session.delete(session.attendee(attendee_id))
+    with Session() as session:
+        assert not staffers_in(session, c.CONSOLE)
+        assert not session.query(MultiChoiceValue).filter_by(row_id=attendee_id).count()
+
+
+def test_has_choice_postgres_sql():
+    clause = Attendee.assigned_depts.has_choice(c.ARCADE)
+    sql = str(clause.compile(dialect=postgresql.dialect()))
+    assert "string_to_array(attendee.assigned_depts, ',')" in sql and '@>' in sql
+
+
+def test_has_choice_falls_back_when_stale():
+    with Session() as session:
+        attendee = Attendee(placeholder=True, first_name='Multi', last_name='Bulk', assigned_depts=str(c.ARCADE))
+        session.add(attendee)
+        attendee_id = attendee.id
+
+    with Session() as session:
+        session.query(Attendee).filter_by(id=attendee_id).update({'assigned_depts': str(c.CONSOLE)},
+                                                                 synchronize_session=False)
+    MultiChoiceValue.mark_stale([('attendee', 'assigned_depts')])
+    with Session() as session:
+        assert {'Bulk'} == staffers_in(session, c.CONSOLE)
+
+    with Session.engine.begin() as connection:
+        MultiChoiceValue.rebuild(connection)
+    with Session() as session:
+        assert {'Bulk'} == staffers_in(session, c.CONSOLE)
+        assert not staffers_in(session, c.ARCADE)
+        assert not session.query(MultiChoiceValue).filter_by(row_id=MultiChoiceValue.stale_row_id).count()
+
+
+def test_index_failure_marks_stale(monkeypatch):
+    monkeypatch.setattr(MultiChoiceValue, 'values', Mock(side_effect=Exception('unindexable')))
+    with Session() as session:
+        session.add(Attendee(placeholder=True, first_name='Multi', last_name='Failed', assigned_depts=str(c.ARCADE)))
+    with Session() as session:
+        assert {'Failed'} == staffers_in(session, c.ARCADE)
+
+    monkeypatch.undo()
+    with Session.engine.begin() as connection:
+        MultiChoiceValue.rebuild(connection)
@@ -0,0 +1,131 @@
+from uber.tests import *
+
+
+@pytest.fixture
+def asynchronous_tracking(monkeypatch):
+    monkeypatch.setattr(tracking_writer, 'synchronous', False)
+    monkeypatch.setattr(tracking_writer, 'queue', Queue(maxsize=tracking_writer.max_queued))
+
+
+def tracked(session, first_name):
+    return session.query(Tracking).filter(Tracking.which.contains(first_name)).all()
+
+
+def test_synchronous():
+    with Session() as session:
+        session.add(Attendee(placeholder=True, first_name='Tracked', last_name='Synchronously'))
+    with Session() as session:
+        [tracking] = tracked(session, 'Tracked')
+        assert tracking.action == c.CREATED and "first_name='Tracked'" in tracking.data
+
+
+def test_queued_until_written(asynchronous_tracking):
+    with Session() as session:
+        session.add(Attendee(placeholder=True, first_name='Tracked', last_name='Later'))
+    with Session() as session:
+        assert not tracked(session, 'Tracked')
+        assert tracking_writer.queue.qsize() == 1
+
+    tracking_writer.write_queued()
+    with Session() as session:
+        [tracking] = tracked(session, 'Tracked')
+        assert tracking.action == c.CREATED and tracking.snapshot_values['last_name'] == 'Later'
+
+
+def test_rollback_not_tracked(asynchronous_tracking):
+    session = Session().session
+    session.add(Attendee(placeholder=True, first_name='Tracked', last_name='Never'))
+    session.flush()
+    session.rollback()
+    session.close()
+    assert tracking_writer.queue.empty()
+
+
+def test_updates_tracked_as_differences(asynchronous_tracking):
+    with Session() as session:
+        staff_one = session.query(Attendee).filter_by(first_name='One', badge_type=c.STAFF_BADGE).one()
+        staff_one.comments = 'Changed'
+        staff_one_id = staff_one.id
+    tracking_writer.write_queued()
+    with Session() as session:
+        [tracking] = session.query(Tracking).filter_by(fk_id=staff_one_id, action=c.UPDATED).all()
+        assert tracking.data == "comments=''' -> 'Changed''"
+
+
+def test_changes_only_modified():
+    with Session() as session:
+        staff_one = session.query(Attendee).filter_by(first_name='One', badge_type=c.STAFF_BADGE).one()
+        staff_one.comments = 'Changed'
+        staff_one.last_name = staff_one.last_name
+        assert {'comments': ('', 'Changed')} == Tracking.changes(staff_one)
+        session.rollback()
+
+
+def test_choice_reprs():
+    columns = Attendee.__table__.columns
+    assert repr(c.BADGES[c.STAFF_BADGE]) == Tracking.repr(columns['badge_type'], c.STAFF_BADGE)
+    assert repr('<nonstandard>') == Tracking.repr(columns['badge_type'], -1)
+    assert repr(c.INTERESTS[c.ARCADE]) == Tracking.repr(columns['interests'], str(c.ARCADE))
+
+
+def test_tracked_changes_include_links():
+    with Session() as session:
+        attendee = Attendee(placeholder=True, first_name='Tracked', last_name='Shifts', staffing=True)
+        session.add(attendee)
+        session.add(Shift(attendee_id=attendee.id, job_id=session.query(Job).filter_by(name='Job One').one().id))
+        attendee_id = attendee.id
+
+    with Session() as session:
+        changes = session.tracked_changes(Attendee, attendee_id).all()
+        assert {'Attendee', 'Shift'} == {tracking.model for tracking in changes}
+        assert 1 == session.query(TrackingLink).filter_by(table_name='attendee', fk_id=attendee_id).count()
+
+
+def test_actors_recorded_once():
+    for last_name in ['Once', 'Twice']:
+        with Session() as session:
+            session.add(Attendee(placeholder=True, first_name='Tracked', last_name=last_name))
+    with Session() as session:
+        [who] = {tracking.who for tracking in tracked(session, 'Tracked')}
+        assert [who] == [actor.who for actor in session.query(TrackingActor).filter_by(who=who)]
+    assert who in tracking_writer.actors
+
+
+def test_snapshots_compressed():
+    with Session() as session:
+        session.add(Attendee(placeholder=True, first_name='Tracked', last_name='Compressed'))
+    with Session() as session:
+        [tracking] = tracked(session, 'Tracked')
+        assert tracking.snapshot.startswith(Tracking.snapshot_prefix)
+        assert tracking.snapshot_values['last_name'] == 'Compressed'
+
+
+def test_archived(monkeypatch, tmpdir):
+    monkeypatch.setattr(c, 'TRACKING_RETENTION_DAYS', 30)
+    monkeypatch.setattr(c, 'TRACKING_ARCHIVE_DIR', str(tmpdir))
+    with Session() as session:
+        attendee = Attendee(placeholder=True, first_name='Tracked', last_name='Archived')
+        session.add(attendee)
+        attendee_id = attendee.id
+    with Session() as session:
+        [tracking] = tracked(session, 'Tracked')
+        tracking.when -= timedelta(days=31)
+
+    assert tracking_archive.run()['Tracking'] == 1
+    with Session() as session:
+        assert not tracked(session, 'Tracked')
+        assert not session.tracked_changes(Attendee, attendee_id).all()
+    [archived] = tracking_archive.tracked_changes(Attendee, attendee_id)
+    assert archived.action == c.CREATED and archived.snapshot_values['last_name'] == 'Archived'
+    assert tracking_archive.run() == {'Tracking': 0, 'PageViewTracking': 0}
+
+
+def test_latest_tracking_cached(monkeypatch):
+    with Session() as session:
+        session.add(Attendee(placeholder=True, first_name='Tracked', last_name='Cached'))
+
+    with Session() as session:
+        [attendee] = session.query(Attendee).filter_by(first_name='Tracked').all()
+        assert attendee.created.fk_id == attendee.id and attendee.last_updated is None
+        monkeypatch.setattr(Attendee, 'get_tracking_by_instance', lambda *args, **kwargs: pytest.fail('not cached'))
+        assert attendee.created.who and attendee.created.when and attendee.last_updated is None
@@ -174,20 +174,11 @@ def send_email(source, dest, subject, body, format='text', cc=(), bcc=(), model=
     subject = subject.format(EVENT_NAME=c.EVENT_NAME)
     to, cc, bcc = map(listify, [dest, cc, bcc])
     ident = ident or subject
-    if c.DEV_BOX:
-        for xs in [to, cc, bcc]:
-            xs[:] = [email for email in xs if email.endswith('mailinator.com') or c.DEVELOPER_EMAIL in email]
+    to, cc, bcc = map(allowed_recipients, [to, cc, bcc])
 
     if c.SEND_EMAILS and to:
-        message = EmailMessage(subject=subject, **{'bodyText' if format == 'text' else 'bodyHtml': body})
-        AmazonSES(c.AWS_ACCESS_KEY, c.AWS_SECRET_KEY).sendEmail(
-            source=source,
-            toAddresses=to,
-            ccAddresses=cc,
-            bccAddresses=bcc,
-            message=message
-        )
-        sleep(0.1)  # avoid hitting rate limit
+        # the transport takes care of staying under our SES rate limit
+        get_email_transport().send(source=source, to=to, cc=cc, bcc=bcc, subject=subject, body=body, format=format)
     else:
         log.error('email sending turned off, so unable to send {}', locals())
 
@@ -197,6 +188,18 @@ def send_email(source, dest, subject, body, format='text', cc=(), bcc=(), model=
         _record_email_sent(sa.Email(subject=subject, dest=','.join(listify(dest)), body=body, ident=ident, **fk))
 
 
+def allowed_recipients(addresses):
+    """
+    Dev boxes are only allowed to send emails to mailinator.com addresses and to
+    c.DEVELOPER_EMAIL, so this returns the list of addresses we can actually send
+    to out of the ones passed in.
+    """
+    addresses = listify(addresses)
+    if c.DEV_BOX:
+        return [email for email in addresses if email.endswith('mailinator.com') or c.DEVELOPER_EMAIL in email]
+    return addresses
+
+
 def _record_email_sent(email):
     """
     Save in our database the contents of the Email model passed in.
@@ -204,8 +207,11 @@ def _record_email_sent(email):
 
     note: This is in a separate function so we can unit test it
     """
+    model, fk_id, ident = email.model, email.fk_id, email.ident
     with sa.Session() as session:
         session.add(email)
+    if fk_id:
+        sa.sent_email_index.add(model, fk_id, ident)
 
 
 class Charge: